@@ -0,0 +1,46 @@
+"""
+Micro-benchmark of the command dispatch overhead.
+
+Measures the time spent between process_command receiving a line and the command function being
+called, using no-op commands so only parsing, lookup and argument conversion are timed.
+"""
+import os
+import timeit
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+from terminal import PygameTerminal, Argument
+
+
+def noop(*args, term):
+    return None
+
+
+def bench_dispatch(number: int = 100_000, repeat: int = 5) -> dict[str, float]:
+    """Return the best time per call in nanoseconds for each dispatch scenario."""
+    terminal = PygameTerminal(app_state=None)
+    terminal.register_command(["noargs", "na"], noop)
+    terminal.register_command(
+        ["typed", "ty"],
+        noop,
+        [Argument("count", int, False), Argument("ratio", float, False), Argument("flag", bool, True),
+         Argument("label", str, True)]
+    )
+    command = terminal.commands["typed"]
+
+    scenarios = {
+        "process_command_no_args": lambda: terminal.process_command("na"),
+        "process_command_typed_args": lambda: terminal.process_command("ty 42 0.5 true label"),
+        "command_call_typed_args": lambda: command("42", "0.5", "true", "label", terminal=terminal),
+        "parse_arguments_typed_args": lambda: command.parse_arguments(("42", "0.5", "true", "label")),
+    }
+    results = {}
+    for name, scenario in scenarios.items():
+        best = min(timeit.repeat(scenario, number=number, repeat=repeat))
+        results[name] = best / number * 1e9
+    return results
+
+
+if __name__ == "__main__":
+    for scenario_name, ns_per_call in bench_dispatch().items():
+        print(f"{scenario_name}: {ns_per_call:.0f} ns/call")
@@ -0,0 +1,209 @@
+"""
+Benchmark suite for the terminal hot paths.
+
+Runs with SDL's dummy video driver, so it works on machines without a display, and prints the
+results as JSON. Save the output of two commits and pass one of them to --compare to see the ratios.
+
+    python run_benchmarks.py --output results.json
+    python run_benchmarks.py --quick --compare results.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import pygame
+
+from terminal import PygameTerminal, Argument
+from bench_dispatch import bench_dispatch
+
+
+def best_time(function, repeat: int) -> float:
+    """Best wall time in seconds of several runs of a function."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def noop(*args, term):
+    return None
+
+
+def bench_frames(line_counts, font_sizes, frames: int) -> dict[str, float]:
+    """Full frames per second, forcing a redraw of every line each frame."""
+    results = {}
+    for use_glyph_atlas in (False, True):
+        for font_size in font_sizes:
+            for line_count in line_counts:
+                terminal = PygameTerminal(app_state=None, font_size=font_size, use_glyph_atlas=use_glyph_atlas,
+                                          scrollback_capacity=line_count)
+                terminal.write_many(f"line {i}: the quick brown fox jumps over the lazy dog" for i in range(line_count))
+                terminal.draw_terminal(force=True)  # Warm up caches
+
+                elapsed = best_time(lambda: [terminal.draw_terminal(force=True) for _ in range(frames)], 3)
+                renderer = "atlas" if use_glyph_atlas else "font"
+                results[f"frames_per_second[{renderer},font={font_size},lines={line_count}]"] = frames / elapsed
+    return results
+
+
+def bench_idle_frames(frames: int) -> dict[str, float]:
+    """Frames per second when nothing changed, which should skip rendering entirely."""
+    terminal = PygameTerminal(app_state=None)
+    terminal.write_many(f"line {i}" for i in range(1000))
+    terminal.draw_terminal()
+    elapsed = best_time(lambda: [terminal.draw_terminal() for _ in range(frames)], 3)
+    return {"idle_frames_per_second": frames / elapsed}
+
+
+def bench_write(line_count: int) -> dict[str, float]:
+    """Lines per second appended with write and write_many."""
+    lines = [f"row {i}: value={i * 7}" for i in range(line_count)]
+    results = {}
+
+    def write_each():
+        terminal = PygameTerminal(app_state=None, headless=True, scrollback_capacity=line_count)
+        for line in lines:
+            terminal.write(line)
+
+    def write_many():
+        terminal = PygameTerminal(app_state=None, headless=True, scrollback_capacity=line_count)
+        terminal.write_many(lines)
+
+    results["write_lines_per_second"] = line_count / best_time(write_each, 3)
+    results["write_many_lines_per_second"] = line_count / best_time(write_many, 3)
+    return results
+
+
+def bench_dispatch_latency(number: int) -> dict[str, float]:
+    return {f"dispatch_ns[{name}]": ns for name, ns in bench_dispatch(number=number, repeat=3).items()}
+
+
+def bench_validate_arguments(number: int) -> dict[str, float]:
+    """Nanoseconds per Command.validate_arguments call on a typed signature."""
+    terminal = PygameTerminal(app_state=None, headless=True)
+    terminal.register_command(
+        ["typed"], noop,
+        [Argument("count", int, False), Argument("ratio", float, False), Argument("flag", bool, True)]
+    )
+    command = terminal.commands["typed"]
+    args = ("42", "0.5", "true")
+    elapsed = best_time(lambda: [command.validate_arguments(args) for _ in range(number)], 3)
+    return {"validate_arguments_ns": elapsed / number * 1e9}
+
+
+MATCHING_COMMANDS = 10
+
+
+def bench_tab_completion(registry_sizes, number: int) -> dict[str, float]:
+    """
+    Microseconds per tab completion with registries of increasing size.
+
+    The completed prefix matches the same MATCHING_COMMANDS commands at every size, so the timings
+    only grow with the lookup cost and not with the number of candidates.
+    """
+    results = {}
+    for registry_size in registry_sizes:
+        terminal = PygameTerminal(app_state=None, headless=True)
+        for i in range(MATCHING_COMMANDS):
+            terminal.register_command([f"match{i}"], noop)
+        for i in range(registry_size - MATCHING_COMMANDS):
+            terminal.register_command([f"command{i}", f"alias{i}"], noop)
+
+        def complete():
+            for _ in range(number):
+                terminal.current_line = "mat"
+                terminal.cursor_pos = len(terminal.current_line)
+                terminal._completion_cycle = None
+                terminal.handle_tab()
+
+        elapsed = best_time(complete, 3)
+        results[f"tab_completion_us[registry={registry_size}]"] = elapsed / number * 1e6
+    return results
+
+
+def bench_draw_table(row_counts) -> dict[str, float]:
+    """Milliseconds per draw_table call with large datasets, including the frame that shows it."""
+    results = {}
+    terminal = PygameTerminal(app_state=None)
+    headers = ["id", "name", "score", "ratio", "status"]
+
+    def draw_table(data):
+        terminal.draw_table(data, headers)
+        terminal.draw_terminal(force=True)
+
+    for row_count in row_counts:
+        data = [[i, f"name {i}", i * 3, i / 7, "ok" if i % 3 else "failed"] for i in range(row_count)]
+        elapsed = best_time(lambda: draw_table(data), 3)
+        results[f"draw_table_ms[rows={row_count}]"] = elapsed * 1000
+    return results
+
+
+def collect_metadata() -> dict[str, str]:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "pygame": pygame.version.ver,
+        "platform": platform.platform(),
+        "video_driver": os.environ.get("SDL_VIDEODRIVER", ""),
+    }
+
+
+def run_benchmarks(quick: bool = False) -> dict:
+    scale = 10 if quick else 1
+    results = {}
+    results.update(bench_frames([1_000, 100_000] if quick else [1_000, 100_000, 1_000_000],
+                                [14, 28] if quick else [14, 20, 28, 40], 60 // scale))
+    results.update(bench_idle_frames(10_000 // scale))
+    results.update(bench_write(200_000 // scale))
+    results.update(bench_dispatch_latency(100_000 // scale))
+    results.update(bench_validate_arguments(100_000 // scale))
+    results.update(bench_tab_completion([100, 10_000] if quick else [100, 10_000, 100_000], 1000 // scale))
+    results.update(bench_draw_table([100, 10_000] if quick else [100, 10_000, 100_000]))
+    return {"metadata": collect_metadata(), "results": results}
+
+
+def compare(current: dict, baseline: dict) -> None:
+    """Print each result next to the baseline value and the current/baseline ratio."""
+    for name, value in current["results"].items():
+        previous = baseline["results"].get(name)
+        ratio = f"{value / previous:.2f}x" if previous else "n/a"
+        print(f"{name}: {value:.1f} (baseline {previous if previous is not None else 'n/a'}, {ratio})",
+              file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the terminal hot paths.")
+    parser.add_argument("--quick", action="store_true", help="Smaller datasets and fewer iterations")
+    parser.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare against")
+    args = parser.parse_args()
+
+    report = run_benchmarks(quick=args.quick)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
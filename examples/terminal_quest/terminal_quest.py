@@ -1,20 +1,19 @@
-import pickle
 import random
 
-from terminal import PygameTerminal, Argument
+from terminal import PygameTerminal, Argument, StateRecord, StateSchema
 
 
 class Character:
     def __init__(self, name, hp, attack, defense):
         self.name = name
-        self.hp: float = hp
-        self.max_hp: float = hp
-        self.attack: float = attack
-        self.defense: float = defense
-        self.exp: float = 0
-        self.exp_to_level: float = 100
+        self.hp: int = hp
+        self.max_hp: int = hp
+        self.attack: int = attack
+        self.defense: int = defense
+        self.exp: int = 0
+        self.exp_to_level: int = 100
         self.level: int = 1
-        self.gold: float = 0
+        self.gold: int = 0
 
     def level_up(self):
         self.level += 1
@@ -23,7 +22,7 @@ class Character:
         self.attack += 2
         self.defense += 1
         self.exp = 0
-        self.exp_to_level *= 1.1
+        self.exp_to_level = round(self.exp_to_level * 1.1)
 
     def attack_cmd(self, target: 'Enemy', term: PygameTerminal):
         damage = self.attack - target.defense
@@ -146,10 +145,10 @@ def fight(term: PygameTerminal):
         player.gold += enemy.gold_reward
         term.write(f"You gained {enemy.exp_reward} exp and {enemy.gold_reward} gold.")
         if player.exp > player.exp_to_level:
-            old_stats: list[float] = player.get_stats()
+            old_stats: list[int] = player.get_stats()
             player.level_up()
-            new_stats: list[float] = player.get_stats()
-            stats_difference: list[float] = [stat - old_stats[i] for i, stat in enumerate(new_stats)]
+            new_stats: list[int] = player.get_stats()
+            stats_difference: list[int] = [stat - old_stats[i] for i, stat in enumerate(new_stats)]
             term.write(f"You have advanced to level {player.level}!")
             term.write(
                 f"New stats ->  Max HP: {player.max_hp} (+{stats_difference[1]}) / Attack: {player.attack} (+{stats_difference[2]}) / Defense: {player.defense} ({+stats_difference[3]})")
@@ -166,9 +165,9 @@ def run(term):
         fight(term)
 
 
-def rest(rest_time: int, term: PygameTerminal):
+def rest(rest_time: int = 1, term: PygameTerminal = None):
     player = term.app_state.player
-    heal_amount = min(player.max_hp - player.hp, round(random.uniform(2, 5), 2) + int(rest_time))
+    heal_amount = min(player.max_hp - player.hp, random.randint(2, 5) + rest_time)
     player.hp += heal_amount
     term.write(
         f"You rest for {rest_time} hours and recover {heal_amount} HP. Your current HP: {player.hp}/{player.max_hp}")
@@ -178,40 +177,55 @@ def rest(rest_time: int, term: PygameTerminal):
 def status(term):
     player = term.app_state.player
     if player:
-        term.write(f"Name: {player.name}")
-        term.write(f"Class: {player.__class__.__name__}")
-        term.write(f"Level: {player.level}")
-        term.write(f"HP: {player.hp}/{player.max_hp}")
-        term.write(f"Attack: {player.attack}")
-        term.write(f"Defense: {player.defense}")
-        term.write(f"EXP: {player.exp}/{player.exp_to_level}")
-        term.write(f"Current room: {term.app_state.current_room}/{term.app_state.total_rooms}")
+        term.write_many([
+            f"Name: {player.name}",
+            f"Class: {player.__class__.__name__}",
+            f"Level: {player.level}",
+            f"HP: {player.hp}/{player.max_hp}",
+            f"Attack: {player.attack}",
+            f"Defense: {player.defense}",
+            f"EXP: {player.exp}/{player.exp_to_level}",
+            f"Current room: {term.app_state.current_room}/{term.app_state.total_rooms}",
+        ])
     else:
         term.write("No character created yet. Use the 'create' command to start your adventure.")
 
 
 def help_command(term):
     term.write("Available commands:")
-    for command_name in term.app_state.commands.keys():
-        term.write(f"  {command_name}")
+    term.write_many(f"  {command_name}" for command_name in term.commands)
 
 
-def save_game(filename: str, term):
-    with open(f"{filename}.json", 'wb') as f:
-        try:
-            pickle.dump(term.app_state, f)
-            term.write(f"Game saved to {filename}.json")
-        except Exception as e:
-            term.write(f"Error saving game: {e}")
+# Layout of the saved games, bump the version whenever the stored fields change
+GAME_SCHEMA = StateSchema(1, StateRecord(GameState, {
+    "player": StateRecord(Character, {
+        "name": str, "hp": int, "max_hp": int, "attack": int, "defense": int,
+        "exp": int, "exp_to_level": int, "level": int, "gold": int,
+    }, optional=True),
+    "current_room": int,
+    "total_rooms": int,
+}))
 
 
-def load_game(filename: str, term):
-    with open(f"{filename}.json", 'rb') as f:
-        try:
-            term.app_state = pickle.load(f)
-            term.write(f"Game loaded from {filename}.json")
-        except Exception as e:
-            term.write(f"Error loading game: {e}")
+def save_game(filename: str = "savegame", term: PygameTerminal = None):
+    def report(future):
+        if future.exception() is not None:
+            term.write(f"Error saving game: {future.exception()}")
+        else:
+            term.write(f"Game saved to {filename}.sav")
+
+    try:
+        term.save_state(f"{filename}.sav", GAME_SCHEMA).add_done_callback(report)
+    except ValueError as e:
+        term.write(f"Error saving game: {e}")
+
+
+def load_game(filename: str = "savegame", term: PygameTerminal = None):
+    try:
+        term.load_state(f"{filename}.sav", GAME_SCHEMA)
+        term.write(f"Game loaded from {filename}.sav")
+    except (OSError, ValueError) as e:
+        term.write(f"Error loading game: {e}")
 
 
 def main():
@@ -237,6 +251,7 @@ def main():
 
     terminal.register_command(["save", "sv"], save_game, argument_list=[Argument("filename", str, True)])
     terminal.register_command(["load", "ld"], load_game, argument_list=[Argument("filename", str, True)])
+    terminal.register_profiler_commands()  # 'profile' and 'stats', F12 toggles the frame overlay
 
     terminal.write("Welcome to Terminal Dungeon Crawler!")
     terminal.write("Create your character using the 'create' command.")
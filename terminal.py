@@ -1,11 +1,41 @@
-from dataclasses import dataclass, field
+import asyncio
+import codecs
+import cProfile
+import hashlib
+import heapq
+import inspect
+import io
+import os
+import pstats
+import queue
+import re
+import struct
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
+from itertools import count, islice
 from math import floor
-from typing import Callable, Any
+from typing import Callable, Any, Iterable, Iterator, Sequence, get_args, get_origin
 
 import pygame
 
 from src.pygameterm import color_data
 
+# Posted by other threads to wake the main loop when they queue work for it
+WAKE_EVENT = pygame.event.custom_type()
+
+
+def now_ms() -> int:
+    """Monotonic milliseconds, available without initializing pygame, used by the scheduler."""
+    return int(time.monotonic() * 1000)
+
 
 @dataclass
 class Argument:
@@ -14,83 +44,2167 @@ class Argument:
     is_optional: bool
     positional_index: int | None = None
     custom_validator: Callable[[Any], bool] | None = None
+    # Returns the candidate values for tab completion, called with (prefix, terminal)
+    completer: Callable[[str, 'PygameTerminal'], Iterable[str]] | None = None
+
+
+_BOOL_VALUES = {'true': True, 'false': False, '1': True, '0': False}
+
+
+class CompletionTrie:
+    """
+    Prefix trie over the registered command names.
+
+    Lookups walk one node per character of the prefix, so completion cost depends on the prefix
+    and the number of matches, never on the size of the registry.
+    """
+
+    def __init__(self, words: Iterable[str] = ()) -> None:
+        self.root: dict = {}
+        for word in words:
+            self.insert(word)
+
+    # The end-of-word marker can't collide with a character key, which are one character long
+    _END = "end"
+
+    def insert(self, word: str) -> None:
+        node = self.root
+        for char in word:
+            node = node.setdefault(char, {})
+        node[self._END] = True
+
+    def __contains__(self, word: str) -> bool:
+        node = self._find(word)
+        return node is not None and self._END in node
+
+    def _find(self, prefix: str) -> dict | None:
+        node = self.root
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return None
+        return node
+
+    def longest_common_prefix(self, prefix: str) -> str:
+        """Extend the prefix for as long as every word starting with it agrees on the next character."""
+        node = self._find(prefix)
+        if node is None:
+            return prefix
+        chars = [prefix]
+        while self._END not in node and len(node) == 1:
+            char, node = next(iter(node.items()))
+            chars.append(char)
+        return "".join(chars)
+
+    def words_with_prefix(self, prefix: str) -> Iterator[str]:
+        """Iterate over the words starting with the prefix, in sorted order."""
+        node = self._find(prefix)
+        if node is None:
+            return
+        stack = [(prefix, node)]
+        while stack:
+            word, node = stack.pop()
+            if self._END in node:
+                yield word
+            for char in sorted((key for key in node if key != self._END), reverse=True):
+                stack.append((word + char, node[char]))
+
+
+@dataclass
+class Command:
+    function: Callable
+    arguments: list[Argument] = field(default_factory=list)
+    background: bool = False  # Run in the terminal's worker pool instead of the main loop
+    number_of_arguments: int = field(init=False)
+    is_async: bool = field(init=False)  # ``async def`` commands run as asyncio tasks
+
+    def get_required_arguments(self):
+        return [arg for arg in self.arguments if not arg.is_optional]
+
+    def get_optional_arguments(self):
+        return [arg for arg in self.arguments if arg.is_optional]
+
+    def __post_init__(self):
+        self.number_of_arguments = len(self.arguments)
+        self.is_async = inspect.iscoroutinefunction(self.function)
+        # Compile the argument pipeline once, parse_arguments only runs the prepared converters
+        self._required_count = len(self.get_required_arguments())
+        self._converters = [self._compile_converter(i, arg) for i, arg in enumerate(self.arguments, start=1)]
+
+    @staticmethod
+    def _compile_converter(i: int, arg: Argument) -> Callable[[str], Any]:
+        """Build the function that converts and validates the raw string of a single argument."""
+        if arg.type == int:
+            convert, error = int, f"Argument {i} ({arg.name}) must be an integer."
+        elif arg.type == float:
+            convert, error = float, f"Argument {i} ({arg.name}) must be a float."
+        elif arg.type == bool:
+            convert = lambda value: _BOOL_VALUES[value.lower()]
+            error = f"Argument {i} ({arg.name}) must be a boolean value (true/false or 1/0)."
+        elif arg.type == str:
+            convert, error = None, ""
+        else:
+            def convert(value):
+                if not value:
+                    raise ValueError
+                return value
+            error = f"Argument {i} ({arg.name}) cannot be empty."
+
+        validator = arg.custom_validator
+        if convert is None and validator is None:
+            return str
+
+        def converter(value):
+            if convert is not None:
+                try:
+                    value = convert(value)
+                except (ValueError, KeyError):
+                    raise ValueError(error) from None
+            if validator is not None and not validator(value):
+                raise ValueError(f"Argument {i} ({arg.name}) is not valid.")
+            return value
+
+        return converter
+
+    def parse_arguments(self, args) -> list:
+        """
+        Convert the raw string arguments to their declared types.
+
+        :raise ValueError: If an argument is missing, superfluous or invalid
+        """
+        if len(args) < self._required_count:
+            missing = next(arg for arg in self.arguments[len(args):] if not arg.is_optional)
+            raise ValueError(f"Missing required argument: {missing.name}")
+        if len(args) > self.number_of_arguments:
+            raise ValueError("Too many arguments provided.")
+        return [convert(value) for convert, value in zip(self._converters, args)]
+
+    def validate_arguments(self, args):
+        try:
+            self.parse_arguments(args)
+        except ValueError as e:
+            return False, str(e)
+        return True, ""
+
+    def __call__(self, *args, terminal: 'PygameTerminal'):
+        """Convert the arguments and call the function, coroutine functions return their coroutine."""
+        return self.function(*self.parse_arguments(args), term=terminal)
+
+
+@dataclass
+class BackgroundJob:
+    name: str
+    future: Future | asyncio.Task
+    cancel_event: threading.Event = field(default_factory=threading.Event)
+    started_ms: int = 0
+
+
+def typeof(value):
+    return type(value)
+
+
+# The 16 ANSI colors, from the color_data palette where it has them
+ANSI_COLORS = [
+    color_data.color['black'], color_data.color['red176'], color_data.color['green176'], (176, 176, 0),
+    color_data.color['blue176'], (176, 0, 176), (0, 176, 176), color_data.color['gray192'],
+    color_data.color['gray128'], color_data.color['red'], color_data.color['green'], (255, 255, 0),
+    color_data.color['blue'], (255, 0, 255), (0, 255, 255), color_data.color['white'],
+]
+
+# Escape sequences: CSI (group 1 parameters, group 2 final byte), OSC, and the two-byte ones
+_ESCAPE_SEQUENCE = r"\x1b\[([0-?]*)[ -/]*([@-~])|\x1b\][^\x07\x1b]*(?:\x07|\x1b\\)|\x1b[@-Z\\-_]"
+_ESCAPE_PATTERN = re.compile(_ESCAPE_SEQUENCE)
+# Inline markup: [red], [green on gray32] and [/] to go back to the default colors
+_MARKUP_PATTERN = re.compile(_ESCAPE_SEQUENCE + r"|\[(/|[a-z0-9]+(?: on [a-z0-9]+)?)\]")
+
+Style = tuple[tuple | None, tuple | None]  # (foreground, background), None for the terminal's colors
+DEFAULT_STYLE: Style = (None, None)
+
+
+class StyledLine(str):
+    """
+    A line of text with color runs, parsed once when it is written.
+
+    It is the plain text for everything but rendering, so searching, completion and history work
+    unchanged. ``runs`` holds the (length, foreground, background) spans covering the text.
+    """
+    runs: tuple[tuple[int, tuple | None, tuple | None], ...]
+
+    def __new__(cls, text: str, runs: Iterable[tuple[int, tuple | None, tuple | None]]) -> 'StyledLine':
+        line = super().__new__(cls, text)
+        line.runs = tuple(runs)
+        return line
+
+    def spans(self) -> Iterator[tuple[str, tuple | None, tuple | None]]:
+        """The (text, foreground, background) spans of the line."""
+        start = 0
+        for length, foreground, background in self.runs:
+            yield str.__getitem__(self, slice(start, start + length)), foreground, background
+            start += length
+
+    def slice(self, start: int, stop: int) -> 'StyledLine':
+        """The [start, stop) part of the line with its runs cut to match, used to draw wrapped rows."""
+        runs = []
+        position = 0
+        for length, foreground, background in self.runs:
+            run_start, run_stop = max(position, start), min(position + length, stop)
+            if run_start < run_stop:
+                runs.append((run_stop - run_start, foreground, background))
+            position += length
+            if position >= stop:
+                break
+        return StyledLine(str.__getitem__(self, slice(start, stop)), runs)
+
+
+def resolve_color(color) -> tuple:
+    """Turn a color_data palette name, a pygame.Color or an RGB(A) sequence into a tuple."""
+    if isinstance(color, str):
+        try:
+            return color_data.color[color]
+        except KeyError:
+            raise ValueError(f"Unknown color: {color}") from None
+    return tuple(color)
+
+
+def _ansi_256(index: int) -> tuple:
+    if index < 16:
+        return ANSI_COLORS[index]
+    if index < 232:
+        index -= 16
+        levels = [0 if level == 0 else 55 + level * 40 for level in (index // 36, index // 6 % 6, index % 6)]
+        return tuple(levels)
+    gray = 8 + (index - 232) * 10
+    return gray, gray, gray
+
+
+def _apply_sgr(parameters: str, style: Style) -> Style:
+    """Apply the parameters of an SGR (``ESC [ ... m``) sequence to a style."""
+    foreground, background = style
+    codes = [int(code) if code.isdigit() else 0 for code in parameters.replace(":", ";").split(";")]
+    i = 0
+    while i < len(codes):
+        code = codes[i]
+        if code == 0:
+            foreground = background = None
+        elif 30 <= code <= 37 or 90 <= code <= 97:
+            foreground = ANSI_COLORS[code - 30 if code < 90 else code - 82]
+        elif 40 <= code <= 47 or 100 <= code <= 107:
+            background = ANSI_COLORS[code - 40 if code < 100 else code - 92]
+        elif code == 39:
+            foreground = None
+        elif code == 49:
+            background = None
+        elif code in (38, 48) and i + 1 < len(codes):
+            # Extended colors, 5;n from the 256-color palette or 2;r;g;b
+            if codes[i + 1] == 5 and i + 2 < len(codes):
+                color = _ansi_256(min(codes[i + 2], 255))
+                i += 2
+            elif codes[i + 1] == 2 and i + 4 < len(codes):
+                color = tuple(min(value, 255) for value in codes[i + 2:i + 5])
+                i += 4
+            else:
+                color = None
+                i += 1
+            if code == 38:
+                foreground = color
+            else:
+                background = color
+        # Bold, underline, blinking and the others are ignored
+        i += 1
+    return foreground, background
+
+
+def _apply_markup(tag: str, style: Style) -> Style | None:
+    """The style selected by a markup tag, None if the tag doesn't name palette colors."""
+    if tag == "/":
+        return DEFAULT_STYLE
+    foreground, _, background = tag.partition(" on ")
+    if foreground not in color_data.color or (background and background not in color_data.color):
+        return None
+    return color_data.color[foreground], color_data.color[background] if background else style[1]
+
+
+def _sgr_transition(parameters: str, style: Style) -> Style:
+    key = (parameters, style)
+    new_style = _SGR_TRANSITIONS.get(key)
+    if new_style is None:
+        if len(_SGR_TRANSITIONS) > 4096:
+            _SGR_TRANSITIONS.clear()
+        new_style = _SGR_TRANSITIONS[key] = _apply_sgr(parameters, style)
+    return new_style
+
+
+_SGR_TRANSITIONS: dict[tuple[str, Style], Style] = {}  # Colored output repeats the same few sequences
+
+
+def style_line(text: str, style: Style = DEFAULT_STYLE, markup: bool = False) -> tuple[str, Style]:
+    """
+    Strip the escape sequences of a line and turn its SGR colors, and optionally its markup, into runs.
+
+    :param style: The style in effect at the start of the line, colors carry over from line to line
+    :param markup: Also parse the inline markup tags, unknown tags are kept as text
+    :return: The line, a plain str when it has no colors, and the style in effect at its end
+    """
+    if "\x1b" not in text and not (markup and "[" in text):
+        if style == DEFAULT_STYLE:
+            return text, style
+        return StyledLine(text, [(len(text), *style)]), style
+
+    # split interleaves the text between sequences with the groups of each sequence
+    if markup:
+        parts = _MARKUP_PATTERN.split(text)
+        step = 4
+    else:
+        parts = _ESCAPE_PATTERN.split(text)
+        step = 3
+    pieces = []
+    runs = []
+    run_style = style
+    run_length = 0
+    for i in range(0, len(parts), step):
+        chunk = parts[i]
+        if i + 1 < len(parts):
+            if markup and parts[i + 3] is not None:
+                new_style = _apply_markup(parts[i + 3], style)
+                if new_style is None:
+                    chunk += f"[{parts[i + 3]}]"  # Not a color tag, keep it as text
+                    new_style = style
+            elif parts[i + 2] == "m":
+                new_style = _sgr_transition(parts[i + 1], style)
+            else:
+                new_style = style  # Cursor movement and other control sequences are dropped
+        else:
+            new_style = style
+        if chunk:
+            if style != run_style:
+                if run_length:
+                    runs.append((run_length, *run_style))
+                run_style = style
+                run_length = 0
+            run_length += len(chunk)
+            pieces.append(chunk)
+        style = new_style
+    if run_length:
+        runs.append((run_length, *run_style))
+
+    plain = "".join(pieces)
+    if len(runs) == 1 and run_style == DEFAULT_STYLE or not runs:
+        return plain, style
+    return StyledLine(plain, runs), style
+
+
+class Scrollback:
+    """
+    Fixed-capacity ring buffer of terminal lines.
+
+    Appending is O(1) and evicts the oldest line once the buffer is full. Lines keep an absolute
+    index (the number of lines appended before them) so that positions stay stable across evictions.
+    """
+
+    def __init__(self, capacity: int = 100_000, lines: Iterable[str] = ()) -> None:
+        if capacity < 1:
+            raise ValueError("Scrollback capacity must be at least 1.")
+        self.capacity = capacity
+        self._lines: list[str] = []
+        self._start = 0  # Position of the oldest line in _lines once the buffer has wrapped
+        self._text_bytes = 0
+        self.total_appended = 0
+        self.rewritten: set[int] = set()  # Absolute indices of the lines replaced in place, for search indexes
+        self.search_index: ChunkedTextIndex | None = None  # Index of the lines built on the first search
+        self.extend(lines)
+
+    def __len__(self) -> int:
+        return len(self._lines)
+
+    def _position(self, index: int) -> int:
+        length = len(self._lines)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError("Scrollback index out of range")
+        return (self._start + index) % length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self._lines)))]
+        return self._lines[self._position(index)]
+
+    def __setitem__(self, index: int, line: str) -> None:
+        position = self._position(index)
+        self._text_bytes += sys.getsizeof(line) - sys.getsizeof(self._lines[position])
+        self._lines[position] = line
+        self.rewritten.add(self.first_index + (index if index >= 0 else index + len(self._lines)))
+
+    def __iter__(self) -> Iterator[str]:
+        return self.view(0, len(self._lines))
+
+    def append(self, line: str) -> None:
+        """Append a line, evicting the oldest one if the buffer is full."""
+        self._text_bytes += sys.getsizeof(line)
+        if len(self._lines) < self.capacity:
+            self._lines.append(line)
+        else:
+            self._text_bytes -= sys.getsizeof(self._lines[self._start])
+            self._lines[self._start] = line
+            self._start = (self._start + 1) % self.capacity
+        self.total_appended += 1
+
+    def extend(self, lines: Iterable[str], chunk_size: int = 65536) -> None:
+        """
+        Append several lines.
+
+        Lines are copied into the ring with slice assignments a chunk at a time, so bulk appends
+        run at list-copy speed instead of paying the per-line cost of append.
+        """
+        iterator = iter(lines)
+        while True:
+            chunk = list(islice(iterator, chunk_size))
+            if not chunk:
+                return
+            self._extend_chunk(chunk)
+
+    def _extend_chunk(self, chunk: list[str]) -> None:
+        getsizeof = sys.getsizeof
+        lines = self._lines
+        capacity = self.capacity
+        self.total_appended += len(chunk)
+        if len(chunk) >= capacity:
+            # Only the newest lines of the chunk survive, the whole buffer is replaced
+            self._lines = chunk[-capacity:]
+            self._start = 0
+            self._text_bytes = sum(map(getsizeof, self._lines))
+            return
+
+        free = capacity - len(lines)
+        if free:
+            head = chunk[:free]
+            lines.extend(head)
+            self._text_bytes += sum(map(getsizeof, head))
+            chunk = chunk[free:]
+        while chunk:
+            # Overwrite the oldest lines, in at most two runs when the write wraps around
+            end = min(self._start + len(chunk), capacity)
+            run = chunk[:end - self._start]
+            self._text_bytes += sum(map(getsizeof, run)) - sum(map(getsizeof, lines[self._start:end]))
+            lines[self._start:end] = run
+            self._start = end % capacity
+            chunk = chunk[len(run):]
+
+    def clear(self) -> None:
+        """Remove every line, absolute indexes keep counting from where they were."""
+        self._lines = []
+        self._start = 0
+        self._text_bytes = 0
+
+    @property
+    def first_index(self) -> int:
+        """Absolute index of the oldest line still held in the buffer."""
+        return self.total_appended - len(self._lines)
+
+    def view(self, start: int, stop: int) -> Iterator[str]:
+        """
+        Iterate over the lines in [start, stop) without copying them.
+
+        :param start: Index relative to the oldest line held
+        :param stop: Index relative to the oldest line held (exclusive)
+        """
+        lines = self._lines
+        length = len(lines)
+        start = max(start, 0)
+        stop = min(stop, length)
+        for i in range(start, stop):
+            yield lines[(self._start + i) % length]
+
+    def tail(self, count: int) -> Iterator[str]:
+        """Iterate over the last count lines without copying them."""
+        length = len(self._lines)
+        return self.view(length - count, length)
+
+    def memory_usage(self) -> int:
+        """Approximate number of bytes held by the buffer, its lines and their search index."""
+        index_bytes = self.search_index.memory_usage() if self.search_index is not None else 0
+        return sys.getsizeof(self._lines) + self._text_bytes + index_bytes
+
+
+class GapBuffer:
+    """
+    Gap buffer holding the characters of the input line.
+
+    Edits happen at a movable gap, so typing and pasting at the cursor cost time proportional to the
+    inserted text and the cursor movement instead of rebuilding the whole line on every keystroke.
+    """
+
+    def __init__(self, text: str = "", gap_size: int = 64) -> None:
+        self._chars: list[str] = list(text) + [""] * gap_size
+        self._gap_start = len(text)
+        self._gap_end = len(self._chars)
+        self.version = 0  # Incremented on every edit
+
+    def __len__(self) -> int:
+        return len(self._chars) - (self._gap_end - self._gap_start)
+
+    def __getitem__(self, index: int) -> str:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("GapBuffer index out of range")
+        if index >= self._gap_start:
+            index += self._gap_end - self._gap_start
+        return self._chars[index]
+
+    def _move_gap(self, position: int) -> None:
+        chars = self._chars
+        if position < self._gap_start:
+            moved = self._gap_start - position
+            chars[self._gap_end - moved:self._gap_end] = chars[position:self._gap_start]
+            self._gap_start = position
+            self._gap_end -= moved
+        elif position > self._gap_start:
+            moved = position - self._gap_start
+            chars[self._gap_start:self._gap_start + moved] = chars[self._gap_end:self._gap_end + moved]
+            self._gap_start += moved
+            self._gap_end += moved
+
+    def insert(self, position: int, text: str) -> None:
+        """Insert text before the character at position."""
+        self._move_gap(position)
+        if len(text) > self._gap_end - self._gap_start:
+            grow = max(len(text), len(self._chars))
+            self._chars[self._gap_end:self._gap_end] = [""] * grow
+            self._gap_end += grow
+        self._chars[self._gap_start:self._gap_start + len(text)] = text
+        self._gap_start += len(text)
+        self.version += 1
+
+    def delete(self, position: int, count: int = 1) -> None:
+        """Delete count characters starting at position."""
+        count = min(count, len(self) - position)
+        if count <= 0 or position < 0:
+            return
+        self._move_gap(position)
+        self._gap_end += count
+        self.version += 1
+
+    def slice(self, start: int, stop: int) -> str:
+        """Return the text in [start, stop) without materializing the whole line."""
+        stop = min(stop, len(self))
+        if start >= stop:
+            return ""
+        gap = self._gap_end - self._gap_start
+        if stop <= self._gap_start:
+            return "".join(self._chars[start:stop])
+        if start >= self._gap_start:
+            return "".join(self._chars[start + gap:stop + gap])
+        return "".join(self._chars[start:self._gap_start]) + "".join(self._chars[self._gap_end:stop + gap])
+
+    def text(self) -> str:
+        return self.slice(0, len(self))
+
+
+class ChunkedTextIndex:
+    """
+    Case-insensitive substring index over a growing sequence of texts.
+
+    Texts are grouped into chunks whose lowercased contents are joined into a single string, so a
+    search runs str.find/rfind in C over whole chunks instead of testing texts one by one in Python.
+    Ids must be added in increasing order. Matches are reported through a verify callback, which
+    lets callers skip ids whose text was removed or replaced since it was indexed.
+
+    Queries are either strings or compiled regular expressions. Patterns run over the lowercased
+    chunk strings as well, so they should be compiled with re.IGNORECASE, and with re.MULTILINE for
+    ^ and $ to match at the start and end of every text.
+    """
+
+    def __init__(self, chunk_size: int = 4096) -> None:
+        self.chunk_size = chunk_size
+        self._chunk_ids: list[array] = []  # Ids of the texts of each sealed chunk
+        self._chunk_offsets: list[array] = []  # Start offset of each text within the chunk string
+        self._chunk_texts: list[str] = []
+        self._open_ids = array("q")
+        self._open_texts: list[str] = []
+
+    def add(self, doc_id: int, text: str) -> None:
+        self._open_ids.append(doc_id)
+        self._open_texts.append(text)
+        if len(self._open_texts) >= self.chunk_size:
+            self._seal()
+
+    def _seal(self) -> None:
+        lowered = [text.lower() for text in self._open_texts]
+        offsets = array("q", [0])
+        for text in lowered[:-1]:
+            offsets.append(offsets[-1] + len(text) + 1)
+        self._chunk_ids.append(self._open_ids)
+        self._chunk_offsets.append(offsets)
+        self._chunk_texts.append("\n".join(lowered))
+        self._open_ids = array("q")
+        self._open_texts = []
+
+    def memory_usage(self) -> int:
+        """Approximate number of bytes held by the index, the open texts are shared with the caller."""
+        total = sys.getsizeof(self._open_ids) + sys.getsizeof(self._open_texts)
+        for ids, offsets, text in zip(self._chunk_ids, self._chunk_offsets, self._chunk_texts):
+            total += sys.getsizeof(ids) + sys.getsizeof(offsets) + sys.getsizeof(text)
+        return total
+
+    def discard_below(self, min_id: int) -> None:
+        """Drop the sealed chunks whose ids are all lower than min_id, such as evicted scrollback lines."""
+        drop = 0
+        while drop < len(self._chunk_ids) and self._chunk_ids[drop][-1] < min_id:
+            drop += 1
+        if drop:
+            del self._chunk_ids[:drop], self._chunk_offsets[:drop], self._chunk_texts[:drop]
+
+    @staticmethod
+    def _open_text_matches(query: str | re.Pattern, text: str) -> bool:
+        if isinstance(query, str):
+            return query in text.lower()
+        return query.search(text.lower()) is not None
+
+    def search_backward(self, query: str | re.Pattern, before_id: int, verify: Callable[[int], bool]) -> int | None:
+        """
+        Find the highest id lower than before_id whose text contains the query.
+
+        :param query: The text to look for, matched case-insensitively, or a compiled pattern
+        :param before_id: Exclusive upper bound of the ids to consider
+        :param verify: Called with each candidate id, returning False skips it
+        """
+        needle = query.lower() if isinstance(query, str) else query
+        for position in range(bisect_left(self._open_ids, before_id) - 1, -1, -1):
+            doc_id = self._open_ids[position]
+            if self._open_text_matches(needle, self._open_texts[position]) and verify(doc_id):
+                return doc_id
+
+        for chunk in range(len(self._chunk_ids) - 1, -1, -1):
+            ids = self._chunk_ids[chunk]
+            if ids[0] >= before_id:
+                continue
+            offsets = self._chunk_offsets[chunk]
+            text = self._chunk_texts[chunk]
+            last = bisect_left(ids, before_id)
+            end = offsets[last] - 1 if last < len(ids) else len(text)
+            if not isinstance(needle, str):
+                # Patterns cannot search backwards, collect the matching texts of the range instead
+                positions = {bisect_right(offsets, match.start()) - 1 for match in needle.finditer(text, 0, end)}
+                for position in sorted(positions, reverse=True):
+                    if verify(ids[position]):
+                        return ids[position]
+                continue
+            while end > 0:
+                found = text.rfind(needle, 0, end)
+                if found < 0:
+                    break
+                position = bisect_left(offsets, found + 1) - 1
+                if verify(ids[position]):
+                    return ids[position]
+                end = offsets[position] - 1  # Continue with the texts before this one
+        return None
+
+    def search_forward(self, query: str | re.Pattern, after_id: int, verify: Callable[[int], bool]) -> int | None:
+        """
+        Find the lowest id higher than after_id whose text contains the query.
+
+        :param query: The text to look for, matched case-insensitively, or a compiled pattern
+        :param after_id: Exclusive lower bound of the ids to consider
+        :param verify: Called with each candidate id, returning False skips it
+        """
+        needle = query.lower() if isinstance(query, str) else query
+        for ids, offsets, text in zip(self._chunk_ids, self._chunk_offsets, self._chunk_texts):
+            if ids[-1] <= after_id:
+                continue
+            start = offsets[bisect_right(ids, after_id)]
+            while True:
+                if isinstance(needle, str):
+                    found = text.find(needle, start)
+                else:
+                    match = needle.search(text, start)
+                    found = match.start() if match is not None else -1
+                if found < 0:
+                    break
+                position = bisect_right(offsets, found) - 1
+                if verify(ids[position]):
+                    return ids[position]
+                if position + 1 >= len(ids):
+                    break
+                start = offsets[position + 1]  # Continue with the texts after this one
+
+        for position in range(bisect_right(self._open_ids, after_id), len(self._open_ids)):
+            doc_id = self._open_ids[position]
+            if self._open_text_matches(needle, self._open_texts[position]) and verify(doc_id):
+                return doc_id
+        return None
+
+
+class CommandHistory:
+    """
+    Deduplicated command history, optionally persisted to an append-only file.
+
+    The file is read lazily on first use, only its tail is loaded, and it is rewritten once it grows
+    past twice the size cap. Entering a command that is already in the history moves it to the end.
+    """
+
+    def __init__(self, path: str | None = None, max_entries: int = 10_000, max_load_bytes: int = 4 * 1024 * 1024):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_load_bytes = max_load_bytes
+        self._entries: OrderedDict[str, int] = OrderedDict()  # Text to id of the live entries, oldest first
+        self._text_by_id: dict[int, str] = {}
+        self._next_id = 0
+        self._file_lines = 0
+        self._loaded = path is None
+        self._index: ChunkedTextIndex | None = None  # Built on the first search
+        self._dead_in_index = 0  # Indexed ids since deduplicated, the index is rebuilt once they dominate
+
+    def _ensure_loaded(self) -> None:
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(0, os.SEEK_END)
+                size = f.tell()
+                f.seek(max(size - self.max_load_bytes, 0))
+                data = f.read()
+        except FileNotFoundError:
+            return
+        lines = data.decode("utf-8", errors="replace").split("\n")
+        if size > self.max_load_bytes:
+            lines = lines[1:]  # The first line was cut by the tail read
+        for line in lines:
+            if line:
+                self._add(line)
+                self._file_lines += 1
+        if size > self.max_load_bytes:
+            # The lines before the tail were never counted, compact on the next append
+            self._file_lines = max(self._file_lines, 2 * self.max_entries)
+
+    def _add(self, entry: str) -> None:
+        old_id = self._entries.pop(entry, None)
+        if old_id is not None:
+            del self._text_by_id[old_id]
+            self._dead_in_index += self._index is not None
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry] = entry_id
+        self._text_by_id[entry_id] = entry
+        if self._index is not None:
+            self._index.add(entry_id, entry)
+        if len(self._entries) > self.max_entries:
+            _, evicted_id = self._entries.popitem(last=False)
+            del self._text_by_id[evicted_id]
+            if self._index is not None:
+                self._index.discard_below(next(iter(self._entries.values())))
+
+    def append(self, entry: str) -> None:
+        """Add an entry to the history and to the history file."""
+        self._ensure_loaded()
+        entry = entry.replace("\n", " ")
+        self._add(entry)
+        if self.path is None:
+            return
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(entry + "\n")
+        self._file_lines += 1
+        if self._file_lines > 2 * self.max_entries:
+            self._compact_file()
+
+    def _compact_file(self) -> None:
+        """Rewrite the history file with only the live entries, atomically."""
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as f:
+            f.writelines(entry + "\n" for entry in self)
+        os.replace(temporary_path, self.path)
+        self._file_lines = len(self._entries)
+
+    def __len__(self) -> int:
+        self._ensure_loaded()
+        return len(self._entries)
+
+    def __iter__(self) -> Iterator[str]:
+        self._ensure_loaded()
+        return iter(self._entries)
+
+    def __getitem__(self, index):
+        self._ensure_loaded()
+        length = len(self._entries)
+        if isinstance(index, slice):
+            start, stop, step = index.indices(length)
+            return list(islice(self._entries, start, stop, step)) if step > 0 else self[:][index]
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError("History index out of range")
+        # Walk from the nearer end, browsing with the arrow keys reads the newest entries
+        if index >= length // 2:
+            return next(islice(reversed(self._entries), length - 1 - index, None))
+        return next(islice(self._entries, index, None))
+
+    def search(self, query: str, before_id: int | None = None) -> tuple[int, str] | None:
+        """
+        Find the newest entry containing the query, case-insensitively.
+
+        :param query: The text to look for
+        :param before_id: Only consider entries older than this id, to step through older matches
+        :return: The id and text of the match, or None
+        """
+        self._ensure_loaded()
+        if self._index is None or self._dead_in_index > len(self._entries):
+            # Deduplicated entries leave dead ids behind in the index, rebuild it once they outnumber the live ones
+            self._index = ChunkedTextIndex()
+            self._dead_in_index = 0
+            for entry, entry_id in self._entries.items():
+                self._index.add(entry_id, entry)
+
+        needle = query.lower()
+        before_id = self._next_id if before_id is None else before_id
+
+        def verify(entry_id):
+            text = self._text_by_id.get(entry_id)
+            return text is not None and needle in text.lower()
+
+        entry_id = self._index.search_backward(query, before_id, verify)
+        if entry_id is None:
+            return None
+        return entry_id, self._text_by_id[entry_id]
+
+
+@dataclass
+class HistorySearch:
+    query: str = ""
+    match_id: int | None = None
+    original_line: str = ""
+    failed: bool = False
+
+
+@dataclass
+class ScrollbackSearch:
+    query: str = ""
+    regex: bool = False
+    pattern: str | re.Pattern | None = None  # The compiled query, None while it is empty or invalid
+    error: str | None = None
+    match_index: int | None = None  # Absolute index of the line with the current match
+    failed: bool = False
+    original_anchor: int | None = None
+    # Highlighted spans of the lines drawn so far by absolute index, cleared when the query changes
+    spans: dict[int, tuple[str, list[tuple[int, int]]]] = field(default_factory=dict)
+
+
+class TerminalWriter:
+    """
+    File-like writer that streams text into a terminal.
+
+    Text is buffered until complete lines are available and then handed to write_many in bulk,
+    so it can be used with print(..., file=writer) or any API expecting a text stream.
+    """
+
+    def __init__(self, terminal: 'PygameTerminal') -> None:
+        self.terminal = terminal
+        self._pending: list[str] = []
+        self._style_state = [DEFAULT_STYLE]  # ANSI colors carry over between writes
+
+    def write(self, text: str) -> int:
+        if "\n" not in text:
+            self._pending.append(text)
+            return len(text)
+        lines = text.split("\n")
+        lines[0] = "".join(self._pending) + lines[0]
+        tail = lines.pop()
+        self._pending = [tail] if tail else []
+        self.terminal.write_many(lines, style_state=self._style_state)
+        return len(text)
+
+    def writelines(self, lines: Iterable[str]) -> None:
+        for line in lines:
+            self.write(line)
+
+    def flush(self) -> None:
+        """Write out any partial line that is still buffered."""
+        if self._pending:
+            self.terminal.write_many(["".join(self._pending)], style_state=self._style_state)
+            self._pending = []
+
+    def close(self) -> None:
+        self.flush()
+
+    def __enter__(self) -> 'TerminalWriter':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class SurfaceCache:
+    """
+    LRU cache of rendered text surfaces with a byte-size budget.
+
+    Entries are keyed on (text, color, antialias, font), holding the font itself in the key so a
+    replaced font can never alias the entries of a new one.
+    """
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024) -> None:
+        self.max_bytes = max_bytes
+        self.bytes_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[tuple, pygame.Surface] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def surface_bytes(surface: pygame.Surface) -> int:
+        return surface.get_width() * surface.get_height() * surface.get_bytesize()
+
+    def render(self, font: pygame.font.Font, text: str, antialias: bool, color) -> pygame.Surface:
+        """Return the rendered surface for the text, rendering it only on a cache miss."""
+        key = (text, tuple(color), antialias, font)
+        surface = self._entries.get(key)
+        if surface is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return surface
+
+        self.misses += 1
+        surface = font.render(text, antialias, color)
+        size = self.surface_bytes(surface)
+        if size > self.max_bytes:
+            return surface  # Too large to ever fit, don't flush the whole cache for it
+        self._entries[key] = surface
+        self.bytes_used += size
+        while self.bytes_used > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.bytes_used -= self.surface_bytes(evicted)
+            self.evictions += 1
+        return surface
+
+    def clear(self) -> None:
+        """Drop every cached surface, the counters are kept."""
+        self._entries.clear()
+        self.bytes_used = 0
+
+    def stats(self) -> dict[str, int]:
+        """Counters describing the cache efficiency and memory use."""
+        return {
+            "entries": len(self._entries),
+            "bytes_used": self.bytes_used,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class HeadlessFont:
+    """
+    Stand-in for pygame.font.Font in headless mode.
+
+    Measures text as if every glyph were a fixed-width cell and never rasterizes anything, so no font
+    file is loaded and no SDL subsystem has to be initialized.
+    """
+
+    def __init__(self, size: int) -> None:
+        self.height = size
+        self.advance = max(size * 3 // 5, 1)
+
+    def get_height(self) -> int:
+        return self.height
+
+    def size(self, text: str) -> tuple[int, int]:
+        return len(text) * self.advance, self.height
+
+    def metrics(self, text: str) -> list[tuple[int, int, int, int, int]]:
+        return [(0, self.advance, 0, self.height, self.advance)] * len(text)
+
+    def render(self, text: str, antialias: bool, color, background=None) -> pygame.Surface:
+        return pygame.Surface((0, self.height))
+
+
+class GlyphAtlas:
+    """
+    A single surface holding pre-rasterized (glyph, color, antialias) cells of a font.
+
+    Lines are built by blitting cells out of the atlas instead of calling ``font.render`` for
+    every new line, and the composed lines go through the terminal's surface cache like rendered
+    ones. Glyphs are rasterized lazily the first time a (glyph, color, antialias)
+    cell is requested, and the atlas grows in height when it runs out of room. Colored output can ask
+    for any number of colors, so once growing would take the atlas past max_bytes it starts over
+    empty and the glyphs in use are rasterized again.
+    """
+
+    def __init__(self, font: pygame.font.Font, width: int = 1024, max_bytes: int = 16 * 1024 * 1024) -> None:
+        self.font = font
+        self.max_bytes = max_bytes
+        self.cell_height = font.get_height()
+        self.cell_width = max(font.size("M")[0], 1)
+        self.width = max(width, self.cell_width)
+        self.renders = 0  # font.render calls made for the cells, resets included
+        self.compositions = 0  # Line surfaces composed by render
+        self.resets = 0
+        self.cells: dict[tuple[str, tuple, bool], tuple[pygame.Rect, int]] = {}
+        self.reset()
+
+    def reset(self) -> None:
+        """Drop every cell and start over with a small atlas."""
+        self.surface = pygame.Surface((self.width, self.cell_height * 8), pygame.SRCALPHA)
+        self.cells.clear()
+        self._next_x = 0
+        self._next_y = 0
+
+    def _grow(self) -> None:
+        """Double the atlas height, keeping the already rasterized cells in place."""
+        old_surface = self.surface
+        self.surface = pygame.Surface((self.width, old_surface.get_height() * 2), pygame.SRCALPHA)
+        self.surface.blit(old_surface, (0, 0))
+
+    def _add_glyph(self, char: str, color: tuple, antialias: bool) -> tuple[pygame.Rect, int]:
+        glyph = self.font.render(char, antialias, color)
+        self.renders += 1
+        if not glyph.get_flags() & pygame.SRCALPHA:
+            # Solid renders are palette surfaces with a colorkey, which BLEND_RGBA_MAX ignores
+            solid = glyph
+            glyph = pygame.Surface(solid.get_size(), pygame.SRCALPHA)
+            glyph.blit(solid, (0, 0))
+        metrics = self.font.metrics(char)
+        # Step by the glyph advance rather than the surface width, which may include overhang
+        advance = metrics[0][4] if metrics and metrics[0] else glyph.get_width()
+        glyph_width = glyph.get_width()
+        if self._next_x + glyph_width > self.width:
+            self._next_x = 0
+            self._next_y += self.cell_height
+        if self._next_y + self.cell_height > self.surface.get_height():
+            if self.surface.get_height() * 2 * self.width * 4 > self.max_bytes:
+                self.reset()
+                self.resets += 1
+            else:
+                self._grow()
+
+        area = pygame.Rect(self._next_x, self._next_y, glyph_width, self.cell_height)
+        # BLEND_RGBA_MAX onto the zeroed atlas copies the glyph pixels (including alpha) unchanged
+        self.surface.blit(glyph, area.topleft, special_flags=pygame.BLEND_RGBA_MAX)
+        self._next_x += glyph_width
+        self.cells[(char, color, antialias)] = (area, advance)
+        return area, advance
+
+    def get_cell(self, char: str, color, antialias: bool = True) -> tuple[pygame.Rect, int]:
+        """Return the atlas area and advance of a glyph in a color, rasterizing it on first use."""
+        color = tuple(color)
+        cell = self.cells.get((char, color, antialias))
+        if cell is None:
+            cell = self._add_glyph(char, color, antialias)
+        return cell
+
+    def preload(self, chars: str, color, antialias: bool = True) -> None:
+        """Rasterize a set of glyphs for a color ahead of time."""
+        for char in chars:
+            self.get_cell(char, color, antialias)
+
+    def render(self, text: str, antialias: bool, color) -> pygame.Surface:
+        """
+        Compose a line surface out of the atlas cells.
+
+        Takes the arguments of Font.render, so a SurfaceCache can cache the composed lines and
+        frames reuse them instead of blitting every glyph again.
+        """
+        self.compositions += 1
+        color = tuple(color)
+        cells = self.cells
+        x, right = 0, 1
+        blit_sequence = []
+        antialias = bool(antialias)
+        for char in text:
+            cell = cells.get((char, color, antialias))
+            if cell is None:
+                cell = self._add_glyph(char, color, antialias)
+            # BLEND_RGBA_MAX copies the glyph pixels onto the transparent line instead of blending them
+            blit_sequence.append((self.surface, (x, 0), cell[0], pygame.BLEND_RGBA_MAX))
+            right = max(right, x + cell[0].width)
+            x += cell[1]
+        surface = pygame.Surface((right, self.cell_height), pygame.SRCALPHA)
+        surface.blits(blit_sequence, doreturn=False)
+        return surface
+
+
+@dataclass
+class CommandTiming:
+    count: int = 0
+    total_ms: float = 0.0
+    max_ms: float = 0.0
+    last_ms: float = 0.0
+
+
+class FrameProfiler:
+    """
+    Rolling timings of the main loop, used by the profiler overlay and frame_stats.
+
+    A frame is one main loop iteration, timed from the moment the events were received (the idle
+    wait is excluded) until the screen was updated. Only the last ``window`` frames are kept.
+    """
+    SECTIONS = ("handle_events", "draw_terminal", "flip")
+
+    def __init__(self, window: int = 600) -> None:
+        self.window = window
+        self.frames = 0
+        self.frame_times: deque[float] = deque(maxlen=window)
+        self.render_calls: deque[int] = deque(maxlen=window)
+        self.section_times: dict[str, deque[float]] = {name: deque(maxlen=window) for name in self.SECTIONS}
+        self.command_times: dict[str, CommandTiming] = {}
+
+    def record(self, section: str, seconds: float) -> None:
+        self.section_times[section].append(seconds * 1000)
+
+    def record_frame(self, seconds: float, render_calls: int) -> None:
+        self.frames += 1
+        self.frame_times.append(seconds * 1000)
+        self.render_calls.append(render_calls)
+
+    def record_command(self, name: str, milliseconds: float) -> None:
+        timing = self.command_times.get(name)
+        if timing is None:
+            timing = self.command_times[name] = CommandTiming()
+        timing.count += 1
+        timing.total_ms += milliseconds
+        timing.max_ms = max(timing.max_ms, milliseconds)
+        timing.last_ms = milliseconds
+
+    @staticmethod
+    def percentiles(samples: Iterable[float]) -> dict[str, float]:
+        """Nearest-rank p50, p95, p99 and max of the samples, zeros when there are none."""
+        ordered = sorted(samples)
+        if not ordered:
+            return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+        last = len(ordered) - 1
+        return {
+            "p50": ordered[round(last * 0.50)],
+            "p95": ordered[round(last * 0.95)],
+            "p99": ordered[round(last * 0.99)],
+            "max": ordered[last],
+        }
+
+    def stats(self) -> dict[str, Any]:
+        """Percentiles in milliseconds of the recent frames and sections, and the per-command totals."""
+        return {
+            "frames": self.frames,
+            "frame_ms": self.percentiles(self.frame_times),
+            "sections_ms": {name: self.percentiles(times) for name, times in self.section_times.items()},
+            "render_calls_per_frame": self.percentiles(self.render_calls),
+            "commands": {name: vars(timing).copy() for name, timing in self.command_times.items()},
+        }
+
+    def clear(self) -> None:
+        self.frames = 0
+        self.frame_times.clear()
+        self.render_calls.clear()
+        for times in self.section_times.values():
+            times.clear()
+        self.command_times.clear()
+
+
+class Widget:
+    """
+    Base class of the retained-mode widgets added to a terminal with add_widget.
+
+    Widgets never paint or flip on their own. They mark their area dirty when their state changes
+    and draw_terminal composites them over the terminal lines in the frame's single render pass.
+    """
+
+    def __init__(self, rect: pygame.Rect | None = None) -> None:
+        self.rect = rect
+        self.terminal: PygameTerminal | None = None  # Set while the widget is added to a terminal
+
+    def area(self, terminal: 'PygameTerminal') -> pygame.Rect:
+        """The screen area the widget draws in, the terminal lines area when it has no rect."""
+        return self.rect if self.rect is not None else terminal.lines_rect()
+
+    def draw(self, terminal: 'PygameTerminal') -> None:
+        raise NotImplementedError
+
+    def handle_keydown(self, event) -> bool:
+        """
+        Handle a key press while the widget has the focus.
+
+        :return: Whether the key changed the widget, which is then redrawn
+        """
+        return False
+
+    def invalidate(self) -> None:
+        """Redraw the widget on the next frame."""
+        if self.terminal is not None:
+            self.terminal.mark_dirty(self.area(self.terminal))
+
+    def close(self) -> None:
+        """Remove the widget from its terminal."""
+        if self.terminal is not None:
+            self.terminal.remove_widget(self)
+
+
+class MenuWidget(Widget):
+    """A vertical list of options, Up/Down move the selection and Return picks the selected one."""
+
+    def __init__(self, options: Sequence[str], x: int, y: int, selected_index: int = 0,
+                 on_select: Callable[[int, str], Any] | None = None,
+                 on_cancel: Callable[[], Any] | None = None, item_padding: int = 5, border_width: int = 1,
+                 border_color=pygame.Color('white'), selected_bg_color=pygame.Color('gray')) -> None:
+        """
+        :param on_select: Called with the index and text of the option picked with Return
+        :param on_cancel: Called when the menu is closed with Escape
+        """
+        super().__init__()
+        self.options = list(options)
+        self.x = x
+        self.y = y
+        self.selected_index = selected_index
+        self.on_select = on_select
+        self.on_cancel = on_cancel
+        self.item_padding = item_padding
+        self.border_width = border_width
+        self.border_color = border_color
+        self.selected_bg_color = selected_bg_color
+
+    def area(self, terminal: 'PygameTerminal') -> pygame.Rect:
+        font = terminal.font
+        width = max((font.size(option)[0] for option in self.options), default=0) + 2 * self.item_padding
+        height = len(self.options) * (font.get_height() + 2 * self.item_padding) + 2 * self.border_width
+        return pygame.Rect(self.x, self.y, width, height)
+
+    def select(self, index: int) -> None:
+        self.selected_index = index % len(self.options) if self.options else 0
+        self.invalidate()
+
+    def handle_keydown(self, event) -> bool:
+        if not self.options:
+            return False
+        if event.key == pygame.K_UP:
+            self.select(self.selected_index - 1)
+        elif event.key == pygame.K_DOWN:
+            self.select(self.selected_index + 1)
+        elif event.key in (pygame.K_RETURN, pygame.K_KP_ENTER):
+            self.close()
+            if self.on_select is not None:
+                self.on_select(self.selected_index, self.options[self.selected_index])
+        elif event.key == pygame.K_ESCAPE:
+            self.close()
+            if self.on_cancel is not None:
+                self.on_cancel()
+        else:
+            return False
+        return True
+
+    def draw(self, terminal: 'PygameTerminal') -> None:
+        screen = terminal.screen
+        font_height = terminal.font.get_height()
+        rect = self.area(terminal)
+        screen.fill(terminal.bg_color, rect)
+        pygame.draw.rect(screen, self.border_color, rect, self.border_width)
+
+        current_y = rect.y + self.border_width + self.item_padding
+        for i, option in enumerate(self.options):
+            if i == self.selected_index:
+                pygame.draw.rect(screen, self.selected_bg_color,
+                                 (rect.x + self.border_width, current_y - self.item_padding,
+                                  rect.width - 2 * self.border_width, font_height + 2 * self.item_padding))
+            screen.blit(terminal.render_text(option, terminal.fg_color),
+                        (rect.x + self.border_width + self.item_padding, current_y))
+            current_y += font_height + 2 * self.item_padding
+
+
+class ProgressBarWidget(Widget):
+    """
+    A progress bar that can be updated from any thread as often as needed.
+
+    update only stores the values. The bar is redrawn when its filled width or percentage actually
+    changes, and never more than once per frame however many updates happen in between.
+    """
+
+    def __init__(self, total: float, x: int, y: int, width: int = 200, height: int = 20,
+                 bg_color=pygame.Color('gray'), fg_color=pygame.Color('green')) -> None:
+        super().__init__(pygame.Rect(x, y, width, height))
+        self.current = 0
+        self.total = total
+        self.bg_color = bg_color
+        self.fg_color = fg_color
+        self._drawn_state: tuple[int, int] | None = None
+        self._redraw_pending = threading.Event()
+
+    @property
+    def progress(self) -> float:
+        return min(max(self.current / self.total, 0.0), 1.0) if self.total else 0.0
+
+    def _visible_state(self) -> tuple[int, int]:
+        progress = self.progress
+        return int(self.rect.width * progress), int(progress * 100)
+
+    def update(self, current: float, total: float | None = None) -> None:
+        """Set the progress, safe to call from background jobs."""
+        self.current = current
+        if total is not None:
+            self.total = total
+        terminal = self.terminal
+        if terminal is None or self._visible_state() == self._drawn_state or self._redraw_pending.is_set():
+            return
+        self._redraw_pending.set()
+        if terminal.in_main_thread():
+            self.invalidate()
+        else:
+            terminal.call_in_main_thread(self.invalidate)
+
+    def draw(self, terminal: 'PygameTerminal') -> None:
+        self._redraw_pending.clear()
+        self._drawn_state = progress_width, percentage = self._visible_state()
+        screen = terminal.screen
+        pygame.draw.rect(screen, self.bg_color, self.rect)
+        pygame.draw.rect(screen, self.fg_color, (self.rect.x, self.rect.y, progress_width, self.rect.height))
+        percentage_text = terminal.render_text(f"{percentage}%", terminal.fg_color)
+        screen.blit(percentage_text, percentage_text.get_rect(center=self.rect.center))
+
+
+class ImageWidget(Widget):
+    """An image panel, images larger than the panel are scaled down to fit it."""
+
+    def __init__(self, rect: pygame.Rect, image: pygame.Surface | None = None,
+                 bg_color=pygame.Color('black')) -> None:
+        super().__init__(rect)
+        self.bg_color = bg_color
+        self.image: pygame.Surface | None = None
+        self._scaled: pygame.Surface | None = None
+        if image is not None:
+            self.set_image(image)
+
+    def set_image(self, image: pygame.Surface) -> None:
+        """Show an image, it is scaled once here rather than on every frame."""
+        self.image = image
+        scale = min(self.rect.width / max(image.get_width(), 1), self.rect.height / max(image.get_height(), 1), 1.0)
+        if scale < 1.0:
+            size = (max(int(image.get_width() * scale), 1), max(int(image.get_height() * scale), 1))
+            # smoothscale only handles 24 and 32 bit surfaces
+            scaler = pygame.transform.smoothscale if image.get_bitsize() >= 24 else pygame.transform.scale
+            image = scaler(image, size)
+        self._scaled = image
+        self.invalidate()
+
+    def draw(self, terminal: 'PygameTerminal') -> None:
+        terminal.screen.fill(self.bg_color, self.rect)
+        if self._scaled is not None:
+            terminal.screen.blit(self._scaled, self._scaled.get_rect(center=self.rect.center))
+
+
+class TableView(Widget):
+    """
+    A scrollable, sortable table that only renders the rows in view.
+
+    Rows come from a sequence, which is indexed directly, or from any iterable, which is consumed
+    lazily as the view scrolls further down. Column widths are measured on a sample of the rows and
+    only grow as wider cells scroll into view. Sorting builds a permutation of row indices, so the
+    rows themselves are never copied or reordered.
+    """
+
+    def __init__(self, rows: Iterable[Sequence], headers: Sequence, rect: pygame.Rect | None = None,
+                 column_widths: list[int] | None = None, sample_size: int = 1000, cell_padding: int = 5,
+                 border_width: int = 1, border_color=pygame.Color('white'),
+                 header_bg_color=pygame.Color('gray')) -> None:
+        """
+        :param rows: The rows, a sequence or an iterable consumed on demand
+        :param headers: The column headers
+        :param rect: The screen area of the table, None uses the terminal lines area
+        :param column_widths: Fixed column widths in pixels, None measures them from the rows
+        :param sample_size: The number of rows measured up front to size the columns
+        """
+        super().__init__(rect)
+        self.headers = [str(header) for header in headers]
+        if isinstance(rows, Sequence):
+            self._rows: Sequence = rows
+            self._source: Iterator | None = None
+        else:
+            self._rows = []
+            self._source = iter(rows)
+        self.column_widths = column_widths
+        self._measure_rows = column_widths is None
+        self._longest = [0] * len(self.headers)  # Character count of the widest text measured per column
+        self.sample_size = sample_size
+        self.cell_padding = cell_padding
+        self.border_width = border_width
+        self.border_color = border_color
+        self.header_bg_color = header_bg_color
+        self.top = 0  # Index of the first visible row in display order
+        self.page_rows = 1  # Rows that fit in the area, updated when drawn
+        self.sort_column: int | None = None
+        self.sort_descending = False
+        self._sort_orders: dict[int, list[int]] = {}
+
+    @property
+    def exhausted(self) -> bool:
+        """Whether every row of the source has been loaded."""
+        return self._source is None
+
+    def __len__(self) -> int:
+        """The number of rows loaded so far, the total once the source is exhausted."""
+        return len(self._rows)
+
+    def _load(self, count: int) -> None:
+        """Pull rows from a lazy source until at least count rows are loaded or it runs dry."""
+        if self._source is None or len(self._rows) >= count:
+            return
+        self._rows.extend(islice(self._source, count - len(self._rows)))
+        if len(self._rows) < count:
+            self._source = None
+
+    def _load_all(self) -> None:
+        if self._source is not None:
+            self._rows.extend(self._source)
+            self._source = None
+
+    def row(self, index: int) -> Sequence:
+        """The row at a position in display order."""
+        if self.sort_column is None:
+            return self._rows[index]
+        order = self._sort_orders[self.sort_column]
+        return self._rows[order[-1 - index] if self.sort_descending else order[index]]
+
+    def sort_by(self, column: int, descending: bool | None = None) -> None:
+        """
+        Sort the view by a column, a lazy source is consumed entirely first.
+
+        :param descending: The direction, None toggles it when already sorted by this column
+        """
+        if descending is None:
+            descending = self.sort_column == column and not self.sort_descending
+        self._load_all()
+        if column not in self._sort_orders:
+            values = [row[column] for row in self._rows]
+            try:
+                self._sort_orders[column] = sorted(range(len(values)), key=values.__getitem__)
+            except TypeError:
+                # Mixed types in the column, fall back to comparing their text
+                values = [str(value) for value in values]
+                self._sort_orders[column] = sorted(range(len(values)), key=values.__getitem__)
+        self.sort_column = column
+        self.sort_descending = descending
+        self.top = 0
+
+    def _header_text(self, column: int) -> str:
+        if column != self.sort_column:
+            return self.headers[column]
+        return self.headers[column] + (" v" if self.sort_descending else " ^")
+
+    def _measure(self, font, rows: Iterable[Sequence]) -> bool:
+        """
+        Widen the columns to fit the rows, only text longer than the widest seen so far is measured.
+
+        :return: Whether any column grew
+        """
+        grew = False
+        longest = self._longest
+        for row in rows:
+            for i, cell in enumerate(row[:len(longest)]):
+                text = str(cell)
+                if len(text) > longest[i]:
+                    longest[i] = len(text)
+                    width = font.size(text)[0] + 2 * self.cell_padding
+                    if width > self.column_widths[i]:
+                        self.column_widths[i] = width
+                        grew = True
+        return grew
+
+    def _initial_measure(self, font) -> None:
+        self.column_widths = [0] * len(self.headers)
+        # The sort marker is included so sorting never has to widen a column
+        self._measure(font, [[header + " v" for header in self.headers]])
+        if isinstance(self._rows, list) and self._source is not None:
+            self._load(self.sample_size)
+            sample = self._rows[:self.sample_size]
+        else:
+            # Rows spread over the whole sequence rather than just its beginning
+            step = max(len(self._rows) // self.sample_size, 1)
+            sample = (self._rows[i] for i in range(0, len(self._rows), step))
+        self._measure(font, sample)
+
+    def row_height(self, font) -> int:
+        return font.get_height() + 2 * self.cell_padding
+
+    def scroll(self, count: int) -> None:
+        """Scroll by a number of rows, positive values move down."""
+        self.scroll_to(self.top + count)
+
+    def scroll_to(self, index: int) -> None:
+        """Make the row at index the first visible one, as far as the rows allow."""
+        self._load(index + self.page_rows)
+        self.top = max(min(index, len(self._rows) - self.page_rows), 0)
+
+    def handle_keydown(self, event) -> bool:
+        """
+        Scroll with the arrows, PgUp/PgDn and Home/End, sort with the digit keys 1-9 and close with Escape.
+
+        :return: Whether the key was used by the table
+        """
+        if event.key == pygame.K_ESCAPE:
+            self.close()
+        elif event.key == pygame.K_UP:
+            self.scroll(-1)
+        elif event.key == pygame.K_DOWN:
+            self.scroll(1)
+        elif event.key == pygame.K_PAGEUP:
+            self.scroll(-self.page_rows)
+        elif event.key == pygame.K_PAGEDOWN:
+            self.scroll(self.page_rows)
+        elif event.key == pygame.K_HOME:
+            self.scroll_to(0)
+        elif event.key == pygame.K_END:
+            self._load_all()
+            self.scroll_to(len(self._rows))
+        elif pygame.K_1 <= event.key <= pygame.K_9 and event.key - pygame.K_1 < len(self.headers):
+            self.sort_by(event.key - pygame.K_1)
+        else:
+            return False
+        return True
+
+    def draw(self, terminal: 'PygameTerminal') -> pygame.Rect:
+        """
+        Draw the header and the visible rows onto the terminal screen.
+
+        :return: The screen area covered by the table
+        """
+        font = terminal.font
+        screen = terminal.screen
+        area = self.area(terminal)
+        row_height = self.row_height(font)
+        border_width = self.border_width
+        self.page_rows = max((area.height - row_height - 2 * border_width) // (row_height + border_width), 1)
+
+        if self.column_widths is None:
+            self._initial_measure(font)
+        self._load(self.top + self.page_rows)
+        rows = [self.row(i) for i in range(self.top, min(self.top + self.page_rows, len(self._rows)))]
+        if self._measure_rows:
+            self._measure(font, rows)
+
+        column_widths = self.column_widths
+        num_rows = len(rows) + 1  # +1 for header row
+        table_width = sum(column_widths) + (len(column_widths) + 1) * border_width
+        table_height = num_rows * row_height + (num_rows + 1) * border_width
+        table_rect = pygame.Rect(area.x, area.y, table_width, table_height).clip(area)
+
+        previous_clip = screen.get_clip()
+        screen.set_clip(table_rect.clip(previous_clip))
+        screen.fill(terminal.bg_color, table_rect)
+        pygame.draw.rect(screen, self.border_color, (area.x, area.y, table_width, table_height), border_width)
+
+        # Draw header row
+        current_x = area.x + border_width
+        for i, width in enumerate(column_widths):
+            header_rect = pygame.Rect(current_x, area.y + border_width, width, row_height)
+            pygame.draw.rect(screen, self.header_bg_color, header_rect)
+            screen.blit(terminal.render_text(self._header_text(i), terminal.fg_color),
+                        (current_x + self.cell_padding, header_rect.y + self.cell_padding))
+            current_x += width + border_width
+
+        # Draw the visible rows, cell surfaces come from the terminal's surface cache
+        current_y = area.y + row_height + 2 * border_width
+        for row in rows:
+            current_x = area.x + border_width
+            for cell, width in zip(row, column_widths):
+                screen.blit(terminal.render_text(str(cell), terminal.fg_color),
+                            (current_x + self.cell_padding, current_y + self.cell_padding))
+                current_x += width + border_width
+            current_y += row_height + border_width
+
+        screen.set_clip(previous_clip)
+        return table_rect
+
+
+class OutputStream:
+    """
+    Lines read from pipes, subprocesses or growing files by daemon reader threads.
+
+    Readers push lines into a bounded queue and block while it is full, which in turn blocks a
+    process writing into a full pipe, so a chatty source is slowed down instead of filling memory.
+    The main loop moves at most ``stream_lines_per_frame`` lines per frame from all the streams into
+    the scrollback. Lines longer than ``max_line_length`` are truncated and their ANSI colors parsed
+    as they are read, so none of that work happens on the main loop.
+    """
+    truncation_marker = " [...]"
+
+    def __init__(self, terminal: 'PygameTerminal', name: str, max_queued_lines: int = 10_000,
+                 max_line_length: int = 4096, encoding: str = "utf-8") -> None:
+        self.terminal = terminal
+        self.name = name
+        self.max_line_length = max_line_length
+        self.encoding = encoding
+        self.process: subprocess.Popen | None = None
+        self.lines_read = 0
+        self.finished = False
+        self._lines: queue.Queue = queue.Queue(max_queued_lines)
+        self._stop = threading.Event()
+        self._wake_requested = threading.Event()
+        self._readers: list[threading.Thread] = []
+        self._open_readers = 0
+        self._readers_lock = threading.Lock()
+
+    def start_reader(self, file, prefix: str = "", follow: bool = False, poll_interval_ms: int = 250,
+                     close_file: bool = True) -> None:
+        """
+        Read lines from a file object, binary or text, on a new daemon thread.
+
+        :param prefix: Prepended to every line, to tell apart sources sharing a stream
+        :param follow: Keep polling for new lines at the end of the file instead of stopping, like tail -f
+        :param close_file: Close the file once the reader is done with it
+        """
+        with self._readers_lock:
+            self._open_readers += 1
+        reader = threading.Thread(target=self._read, args=(file, prefix, follow, poll_interval_ms, close_file),
+                                  name=f"terminal-stream-{self.name}", daemon=True)
+        self._readers.append(reader)
+        reader.start()
+
+    def _read(self, file, prefix: str, follow: bool, poll_interval_ms: int, close_file: bool) -> None:
+        decoder = codecs.getincrementaldecoder(self.encoding)(errors="replace")
+        style = DEFAULT_STYLE  # ANSI colors are parsed here, off the main loop, and carry over between lines
+        pending = ""  # The line being assembled, it may arrive in several chunks
+        truncated = False
+        try:
+            while not self._stop.is_set():
+                # Bounded reads, a single 100MB line never has to fit in memory
+                chunk = file.readline(self.max_line_length + 1)
+                if not chunk:
+                    if not follow:
+                        break
+                    if file.seekable() and os.fstat(file.fileno()).st_size < file.tell():
+                        file.seek(0)  # The file was truncated or rotated, start over
+                    self._stop.wait(poll_interval_ms / 1000)
+                    continue
+                if isinstance(chunk, bytes):
+                    chunk = decoder.decode(chunk)
+                complete = chunk.endswith("\n")
+                if not truncated:
+                    pending += chunk.rstrip("\r\n") if complete else chunk
+                    if len(pending) > self.max_line_length:
+                        pending = pending[:self.max_line_length] + self.truncation_marker
+                        truncated = True
+                if complete:
+                    line, style = style_line(prefix + pending, style)
+                    self._put(line)
+                    pending = ""
+                    truncated = False
+            if pending:
+                self._put(style_line(prefix + pending, style)[0])
+        except (OSError, ValueError) as e:
+            # ValueError is raised when the file is closed under the reader by close()
+            if not self._stop.is_set():
+                self._put(f"{prefix}[{self.name}: {e}]")
+        finally:
+            if close_file:
+                file.close()
+            with self._readers_lock:
+                self._open_readers -= 1
+                last_reader = self._open_readers == 0
+            if last_reader and self.process is not None:
+                self.process.wait()
+            self._put(None)  # Marks the end of this reader
+
+    def _put(self, line: str | None) -> None:
+        """Queue a line, blocking while the queue is full unless the stream is closed."""
+        while True:
+            try:
+                self._lines.put(line, timeout=0.1)
+                break
+            except queue.Full:
+                if self._stop.is_set() and line is not None:
+                    return
+        if not self._wake_requested.is_set():
+            self._wake_requested.set()
+            self.terminal.call_in_main_thread(self.terminal.drain_streams)
+
+    def take_lines(self, limit: int) -> list[str | StyledLine]:
+        """Take up to limit queued lines without blocking, marking the stream finished once every reader ended."""
+        self._wake_requested.clear()
+        lines = []
+        while len(lines) < limit:
+            try:
+                line = self._lines.get_nowait()
+            except queue.Empty:
+                break
+            if line is None:
+                with self._readers_lock:
+                    self.finished = self._open_readers == 0 and self._lines.empty()
+            else:
+                lines.append(line)
+        self.lines_read += len(lines)
+        return lines
+
+    @property
+    def pending(self) -> bool:
+        """Whether lines are waiting to be moved into the scrollback."""
+        return not self._lines.empty()
+
+    @property
+    def returncode(self) -> int | None:
+        return self.process.returncode if self.process is not None else None
+
+    def close(self) -> None:
+        """Stop reading, terminating the process if the stream belongs to one."""
+        self._stop.set()
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+
+
+class EventBus:
+    """
+    Named custom events with any number of subscribers.
+
+    Every name gets its own event type from pygame.event.custom_type, and handlers are kept in a
+    type -> handlers mapping, so dispatching an event is a single dict lookup. Events posted from
+    other threads, or in batches, go through a queue that the main loop drains after one wake-up.
+    """
+
+    def __init__(self, terminal: 'PygameTerminal') -> None:
+        self.terminal = terminal
+        self.types: dict[str, int] = {}
+        self._handlers: dict[int, list[Callable[[pygame.event.Event], Any]]] = {}
+        self._queued: queue.SimpleQueue[pygame.event.Event] = queue.SimpleQueue()
+        self._wake_requested = threading.Event()
+
+    def event_type(self, name: str) -> int:
+        """The event type of a name, allocated the first time the name is used."""
+        event_type = self.types.get(name)
+        if event_type is None:
+            event_type = self.types[name] = pygame.event.custom_type()
+            self._handlers[event_type] = []
+        return event_type
+
+    def subscribe(self, name: str, handler: Callable[[pygame.event.Event], Any]) -> int:
+        """
+        Call a handler with every event posted under a name.
+
+        :return: The event type of the name, events of that type posted with pygame directly are dispatched too
+        """
+        event_type = self.event_type(name)
+        self._handlers[event_type].append(handler)
+        return event_type
+
+    def unsubscribe(self, name: str, handler: Callable[[pygame.event.Event], Any]) -> None:
+        handlers = self._handlers.get(self.types.get(name))
+        if handlers and handler in handlers:
+            handlers.remove(handler)
+
+    def post(self, name: str, **attributes) -> None:
+        """Post an event to the subscribers of a name, safe to call from any thread."""
+        event = pygame.event.Event(self.event_type(name), attributes)
+        if self.terminal.in_main_thread() and not self.terminal.headless:
+            pygame.event.post(event)
+        else:
+            self._queued.put(event)
+            self._wake()
+
+    def post_many(self, name: str, payloads: Iterable[dict]) -> None:
+        """Post one event per payload with a single wake-up of the main loop, safe to call from any thread."""
+        event_type = self.event_type(name)
+        for attributes in payloads:
+            self._queued.put(pygame.event.Event(event_type, attributes))
+        self._wake()
+
+    def _wake(self) -> None:
+        if not self._wake_requested.is_set():
+            self._wake_requested.set()
+            self.terminal.call_in_main_thread(self.dispatch_queued)
+
+    def dispatch_queued(self) -> None:
+        """Dispatch the events queued by post_many and by other threads, called on the main thread."""
+        self._wake_requested.clear()
+        while True:
+            try:
+                event = self._queued.get_nowait()
+            except queue.Empty:
+                return
+            self.dispatch(event)
+
+    def dispatch(self, event: pygame.event.Event) -> bool:
+        """
+        Call the handlers subscribed to the type of an event.
 
+        :return: Whether the event type belongs to the bus
+        """
+        handlers = self._handlers.get(event.type)
+        if handlers is None:
+            return False
+        for handler in tuple(handlers):  # Handlers may unsubscribe themselves
+            handler(event)
+        return True
 
-@dataclass
-class Command:
-    function: Callable
-    arguments: list[Argument] = field(default_factory=list)
-    number_of_arguments: int = field(init=False)
 
-    def get_required_arguments(self):
-        return [arg for arg in self.arguments if not arg.is_optional]
+_FIXED_CODES = {int: "q", float: "d", bool: "?"}
+_LENGTH = struct.Struct("<I")
 
-    def get_optional_arguments(self):
-        return [arg for arg in self.arguments if arg.is_optional]
+
+class StateRecord:
+    """
+    Declares which attributes of a class are stored in a state snapshot, and their types.
+
+    Field types are int, float, bool, str, bytes, a nested StateRecord or ``list[...]`` of any of
+    them. Loading only creates instances of the declared classes and only sets the declared
+    attributes, ``__init__`` is not called. The encoders are compiled once, fixed-size fields are
+    packed together with a single struct call.
+    """
+
+    def __init__(self, cls: type, fields: dict[str, Any], optional: bool = False) -> None:
+        """
+        :param cls: The class of the stored objects
+        :param fields: The stored attribute names mapped to their types
+        :param optional: The object may be None
+        """
+        self.cls = cls
+        self.fields = fields
+        self.optional = optional
+        fixed_names = [name for name, kind in fields.items() if kind in _FIXED_CODES]
+        self._fixed_names = fixed_names
+        self._fixed = struct.Struct("<" + "".join(_FIXED_CODES[fields[name]] for name in fixed_names))
+        self._other = [(name, *_value_codec(kind)) for name, kind in fields.items() if kind not in _FIXED_CODES]
+
+    def describe(self) -> str:
+        """A canonical description of the layout, its checksum identifies the schema in snapshot files."""
+        fields = ",".join(f"{name}:{_describe_type(kind)}" for name, kind in self.fields.items())
+        return f"{self.cls.__name__}{'?' if self.optional else ''}({fields})"
+
+    def encode(self, obj, out: list[bytes]) -> None:
+        if self.optional:
+            if obj is None:
+                out.append(b"\0")
+                return
+            out.append(b"\1")
+        if self._fixed_names:
+            values = [getattr(obj, name) for name in self._fixed_names]
+            try:
+                out.append(self._fixed.pack(*values))
+            except struct.error:
+                # Pack the fields one by one to name the one that doesn't fit
+                for name, value in zip(self._fixed_names, values):
+                    _encode_field(name, _value_codec(self.fields[name])[0], value, out)
+                raise
+        for name, encode, _ in self._other:
+            _encode_field(name, encode, getattr(obj, name), out)
+
+    def decode(self, data: memoryview, offset: int) -> tuple[Any, int]:
+        if self.optional:
+            offset += 1
+            if not data[offset - 1]:
+                return None, offset
+        obj = self.cls.__new__(self.cls)
+        if self._fixed_names:
+            for name, value in zip(self._fixed_names, self._fixed.unpack_from(data, offset)):
+                setattr(obj, name, value)
+            offset += self._fixed.size
+        for name, _, decode in self._other:
+            value, offset = decode(data, offset)
+            setattr(obj, name, value)
+        return obj, offset
+
+
+def _describe_type(kind) -> str:
+    if isinstance(kind, StateRecord):
+        return kind.describe()
+    if get_origin(kind) is list:
+        return f"list[{_describe_type(get_args(kind)[0])}]"
+    return kind.__name__
+
+
+def _encode_field(name: str, encode: Callable[[Any, list[bytes]], None], value, out: list[bytes]) -> None:
+    """Encode a field value, reporting a value that doesn't fit the declared type as a ValueError naming the field."""
+    try:
+        encode(value, out)
+    except (struct.error, TypeError) as e:
+        raise ValueError(f"{name}: {e}") from None
+    except ValueError as e:
+        raise ValueError(f"{name}.{e}") from None  # From a nested record, prefix the path
+
+
+def _value_codec(kind) -> tuple[Callable[[Any, list[bytes]], None], Callable[[memoryview, int], tuple[Any, int]]]:
+    """Build the (encode, decode) functions of a snapshot field type."""
+    if kind in _FIXED_CODES:
+        fixed = struct.Struct("<" + _FIXED_CODES[kind])
+        return (lambda value, out: out.append(fixed.pack(value)),
+                lambda data, offset: (fixed.unpack_from(data, offset)[0], offset + fixed.size))
+    if kind is str or kind is bytes:
+        def encode(value, out):
+            if not isinstance(value, kind):
+                raise TypeError(f"expected {kind.__name__}, got {type(value).__name__}")
+            raw = value.encode() if kind is str else value
+            out.append(_LENGTH.pack(len(raw)))
+            out.append(raw)
+
+        def decode(data, offset):
+            length = _LENGTH.unpack_from(data, offset)[0]
+            offset += _LENGTH.size
+            raw = bytes(data[offset:offset + length])
+            return (raw.decode() if kind is str else raw), offset + length
+        return encode, decode
+    if isinstance(kind, StateRecord):
+        return kind.encode, kind.decode
+    if get_origin(kind) is list:
+        item_kind = get_args(kind)[0]
+        if item_kind in _FIXED_CODES:
+            # Lists of numbers are packed with a single struct call
+            code = _FIXED_CODES[item_kind]
+            item_size = struct.calcsize(code)
+
+            def encode(value, out):
+                out.append(_LENGTH.pack(len(value)))
+                out.append(struct.pack(f"<{len(value)}{code}", *value))
+
+            def decode(data, offset):
+                length = _LENGTH.unpack_from(data, offset)[0]
+                offset += _LENGTH.size
+                return list(struct.unpack_from(f"<{length}{code}", data, offset)), offset + length * item_size
+            return encode, decode
+
+        encode_item, decode_item = _value_codec(item_kind)
+
+        def encode(value, out):
+            out.append(_LENGTH.pack(len(value)))
+            for item in value:
+                encode_item(item, out)
+
+        def decode(data, offset):
+            length = _LENGTH.unpack_from(data, offset)[0]
+            offset += _LENGTH.size
+            items = []
+            for _ in range(length):
+                item, offset = decode_item(data, offset)
+                items.append(item)
+            return items, offset
+        return encode, decode
+    raise TypeError(f"Unsupported state field type: {kind!r}")
+
+
+@dataclass
+class StateSchema:
+    """
+    The versioned layout of an app_state, used by PygameTerminal.save_state and load_state.
+
+    Each field of the root record is stored as its own segment, and list fields are split into
+    segments of list_chunk_size items, so an incremental save only writes the segments that changed.
+    """
+    version: int
+    root: StateRecord
+    list_chunk_size: int = 1024
+    fingerprint: int = field(init=False)
 
     def __post_init__(self):
-        self.number_of_arguments = len(self.arguments)
+        self.fingerprint = zlib.crc32(self.root.describe().encode())
+        self._codecs = [(name, kind, *_value_codec(kind)) for name, kind in self.root.fields.items()]
 
-    def validate_arguments(self, args):
-        required_args = [arg for arg in self.arguments if not arg.is_optional]
-        if len(args) < len(required_args):
-            return False, "Not enough arguments provided."
-        if len(args) > len(self.arguments):
-            return False, "Too many arguments provided."
-
-        for i, (arg, value) in enumerate(zip(self.arguments, args), start=1):
-            if arg.type == int:
-                if not self._is_valid_int(value):
-                    return False, f"Argument {i} ({arg.name}) must be an integer."
-            elif arg.type == float:
-                if not self._is_valid_float(value):
-                    return False, f"Argument {i} ({arg.name}) must be a float."
-            elif arg.type == bool:
-                if not self._is_valid_bool(value):
-                    return False, f"Argument {i} ({arg.name}) must be a boolean value (true/false or 1/0)."
-            elif arg.type == str:
-                pass
+    def encode_segments(self, state) -> dict[tuple[int, int], bytes]:
+        """
+        Encode the state into segments keyed by (field index, chunk index).
+
+        :raise ValueError: If a field holds a value its declared type can't store, such as an out of range int
+        """
+        segments = {}
+        for i, (name, kind, encode, _) in enumerate(self._codecs):
+            value = getattr(state, name)
+            if get_origin(kind) is list:
+                # Chunk 0 holds the length, chunk c the items [(c - 1) * size, c * size)
+                segments[(i, 0)] = _LENGTH.pack(len(value))
+                size = self.list_chunk_size
+                for chunk in range(0, len(value), size):
+                    out = []
+                    _encode_field(name, encode, value[chunk:chunk + size], out)
+                    segments[(i, chunk // size + 1)] = b"".join(out)
             else:
-                if not value:
-                    return False, f"Argument {i} ({arg.name}) cannot be empty."
+                out = []
+                _encode_field(name, encode, value, out)
+                segments[(i, 0)] = b"".join(out)
+        return segments
 
-        return True, ""
+    def decode_segments(self, segments: dict[tuple[int, int], bytes]):
+        """Build the state back from its segments."""
+        state = self.root.cls.__new__(self.root.cls)
+        for i, (name, kind, _, decode) in enumerate(self._codecs):
+            if (i, 0) not in segments:
+                raise ValueError(f"The snapshot is missing the field '{name}'")
+            try:
+                if get_origin(kind) is list:
+                    length = _LENGTH.unpack(segments[(i, 0)])[0]
+                    value = []
+                    for chunk in range(1, -(-length // self.list_chunk_size) + 1):
+                        if (i, chunk) not in segments:
+                            raise ValueError(f"The snapshot is missing part {chunk} of the field '{name}'")
+                        items, _ = decode(memoryview(segments[(i, chunk)]), 0)
+                        value.extend(items)
+                    del value[length:]
+                else:
+                    value, _ = decode(memoryview(segments[(i, 0)]), 0)
+            except (struct.error, UnicodeDecodeError, IndexError) as e:
+                raise ValueError(f"The snapshot field '{name}' is corrupt: {e}") from None
+            setattr(state, name, value)
+        return state
 
-    @staticmethod
-    def _is_valid_int(value):
-        try:
-            int(value)
-            return True
-        except ValueError:
-            return False
 
-    @staticmethod
-    def _is_valid_float(value):
-        try:
-            float(value)
-            return True
-        except ValueError:
-            return False
+class StateStore:
+    """
+    A snapshot file holding the segments of a StateSchema.
+
+    The file is a header followed by records of (field, chunk, length, crc32, payload). A full save
+    rewrites the file atomically through a temporary file and os.replace, an incremental save
+    appends the records of the changed segments and the last record of a segment wins on load.
+    Every save ends with a commit record holding its sequence number, record count and the CRC of
+    its records, and a save without a valid commit, such as one torn by a crash during an append,
+    is ignored as a whole. Once the appended records outgrow the last full snapshot the next save
+    compacts the file.
+
+    Encoding and change detection run on the calling thread, so the state is captured consistently,
+    and the file I/O runs in order on a dedicated writer thread.
+    """
+    MAGIC = b"PTSNAP02"
+    HEADER = struct.Struct("<8sII")  # Magic, schema version, schema fingerprint
+    RECORD = struct.Struct("<IIII")  # Field index, chunk index, payload length, payload crc32
+    COMMIT_INDEX = 0xFFFFFFFF  # Field index of commit records, their chunk index is the save sequence number
+    COMMIT = struct.Struct("<II")  # Number of records in the save, crc32 of those records
+
+    def __init__(self, path: str, schema: StateSchema, compact_ratio: float = 2.0) -> None:
+        self.path = path
+        self.schema = schema
+        self.compact_ratio = compact_ratio
+        self._digests: dict[tuple[int, int], bytes] = {}  # Digests of the segments as saved on disk
+        self._base_size = 0  # Size of the last full snapshot
+        self._file_size = 0
+        self._sequence = 0  # Sequence number of the last committed save
+        self._failed = False
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix="terminal-state-writer")
 
     @staticmethod
-    def _is_valid_bool(value):
-        return value.lower() in ('true', 'false', '1', '0')
+    def _digest(payload: bytes) -> bytes:
+        return hashlib.blake2b(payload, digest_size=16).digest()
 
-    def __call__(self, *args, terminal: 'PygameTerminal'):
-        valid, message = self.validate_arguments(args)
-        if not valid:
-            raise ValueError(message)
-        return self.function(*args, term=terminal)
+    def _records(self, segments: Iterable[tuple[tuple[int, int], bytes]]) -> list[bytes]:
+        out = []
+        for (index, chunk), payload in segments:
+            out.append(self.RECORD.pack(index, chunk, len(payload), zlib.crc32(payload)))
+            out.append(payload)
+        return out
 
+    def _commit(self, records: list[bytes]) -> bytes:
+        """The records of a save followed by the commit record that makes them count on load."""
+        self._sequence += 1
+        body = b"".join(records)
+        payload = self.COMMIT.pack(len(records) // 2, zlib.crc32(body))
+        return body + self.RECORD.pack(self.COMMIT_INDEX, self._sequence, len(payload), zlib.crc32(payload)) + payload
 
-def typeof(value):
-    return type(value)
+    def save(self, state, full: bool = False) -> Future:
+        """
+        Save the state, only appending the changed segments unless a full snapshot is due.
+
+        :param full: Rewrite the whole file even if an incremental save is possible
+        :raise ValueError: If a field of the state can't be encoded, nothing is written
+        :return: A future resolving to the number of bytes written
+        """
+        segments = self.schema.encode_segments(state)
+        digests = {key: self._digest(payload) for key, payload in segments.items()}
+        full = (full or self._failed or not self._digests
+                or self._file_size > self._base_size * self.compact_ratio)
+        self._failed = False
+        if full:
+            self._sequence = 0
+            data = (self.HEADER.pack(self.MAGIC, self.schema.version, self.schema.fingerprint)
+                    + self._commit(self._records(sorted(segments.items()))))
+            self._base_size = self._file_size = len(data)
+            future = self._writer.submit(self._write_full, data)
+        else:
+            changed = sorted((key, payload) for key, payload in segments.items()
+                             if digests[key] != self._digests.get(key))
+            data = self._commit(self._records(changed)) if changed else b""
+            self._file_size += len(data)
+            future = self._writer.submit(self._append, data)
+        # Bookkept optimistically so the next save diffs against what will be on disk
+        self._digests = digests
+        future.add_done_callback(self._check_write)
+        return future
+
+    def _check_write(self, future: Future) -> None:
+        if future.cancelled() or future.exception() is not None:
+            self._failed = True  # What is on disk is unknown, the next save rewrites everything
+
+    def _write_full(self, data: bytes) -> int:
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, self.path)
+        return len(data)
+
+    def _append(self, data: bytes) -> int:
+        if data:
+            with open(self.path, "ab") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        return len(data)
+
+    def load(self):
+        """
+        Read the state back from the file.
+
+        :raise ValueError: If the file isn't a snapshot of this schema and version
+        """
+        self._writer.submit(lambda: None).result()  # Let the pending saves land first
+        with open(self.path, "rb") as f:
+            data = f.read()
+        if len(data) < self.HEADER.size:
+            raise ValueError(f"{self.path} is not a state snapshot")
+        magic, version, fingerprint = self.HEADER.unpack_from(data)
+        if magic != self.MAGIC:
+            raise ValueError(f"{self.path} is not a state snapshot")
+        if version != self.schema.version or fingerprint != self.schema.fingerprint:
+            raise ValueError(f"{self.path} was saved with schema version {version}, "
+                             f"expected version {self.schema.version}")
+
+        segments = {}
+        pending, pending_count = {}, 0  # Records of the save being read, applied once its commit checks out
+        offset = committed = self.HEADER.size
+        sequence = 0
+        view = memoryview(data)
+        while offset + self.RECORD.size <= len(data):
+            record_start = offset
+            index, chunk, length, crc = self.RECORD.unpack_from(data, offset)
+            payload = view[offset + self.RECORD.size:offset + self.RECORD.size + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break  # Torn write at the end of the file
+            offset += self.RECORD.size + length
+            if index != self.COMMIT_INDEX:
+                pending[(index, chunk)] = bytes(payload)
+                pending_count += 1
+                continue
+            if chunk != sequence + 1 or length != self.COMMIT.size:
+                break
+            count, body_crc = self.COMMIT.unpack(payload)
+            if count != pending_count or zlib.crc32(view[committed:record_start]) != body_crc:
+                break
+            segments.update(pending)
+            pending, pending_count = {}, 0
+            sequence = chunk
+            committed = offset
+        state = self.schema.decode_segments(segments)
+
+        self._digests = {key: self._digest(payload) for key, payload in segments.items()}
+        self._file_size = committed
+        self._sequence = sequence
+        # What a full snapshot of this content would take, the rest are superseded records
+        self._base_size = self.HEADER.size + sum(self.RECORD.size + len(payload) for payload in segments.values())
+        if committed < len(data):
+            self._failed = True  # Drop the uncommitted tail with a full rewrite on the next save
+        return state
+
+    def close(self) -> None:
+        """Wait for the pending writes to finish."""
+        self._writer.shutdown(wait=True)
 
 
 class PygameTerminal:
     def __init__(self, app_state, width: int = 1024, height: int = 600, font_size: int = 28,
                  initial_message: str = "", default_bg_color: pygame.Color = color_data.color['black'],
-                 default_fg_color: pygame.Color = color_data.color['white']) -> None:
+                 default_fg_color: pygame.Color = color_data.color['white'],
+                 use_glyph_atlas: bool = False, scrollback_capacity: int = 100_000,
+                 surface_cache_bytes: int = 32 * 1024 * 1024, history_file: str | None = None,
+                 history_size: int = 10_000, headless: bool = False,
+                 input_source: Iterable[str] | None = None) -> None:
         """
         Initialize the Pygame Terminal Emulator.
 
@@ -98,48 +2212,142 @@ class PygameTerminal:
         :param height: The height of the terminal emulator window.
         :param font_size: The font size of the terminal emulator window.
         :param initial_message: The initial message to display in the terminal emulator.
+        :param use_glyph_atlas: Compose text surfaces from a pre-rasterized glyph atlas instead of font.render.
+        :param scrollback_capacity: The number of lines kept before the oldest ones are discarded.
+        :param surface_cache_bytes: Memory budget of the rendered text surface cache.
+        :param history_file: File the command history is persisted to, None keeps it in memory only.
+        :param history_size: The number of distinct commands kept in the history.
+        :param headless: Run without a display, nothing is rasterized and input comes from input_source.
+        :param input_source: Lines fed as typed commands and prompt answers, mainly for headless mode.
         """
         self.terminal_margin_bottom = 40
         self.terminal_margin_left = 10
         self.terminal_margin_top = 10
         self.line_width = 2
         self.command_callback: Callable | None = None
-        pygame.init()
-        pygame.display.set_caption("Pygame Terminal Emulator")
+        self.headless = headless
+        self.input_source: Iterator[str] | None = iter(input_source) if input_source is not None else None
+        if not headless:
+            pygame.init()
+            pygame.display.set_caption("Pygame Terminal Emulator")
         self.app_state = app_state  # This is the state of the application, this will be passed to commands by default
         self.width: int = width  # The width of the terminal emulator window
         self.height: int = height  # The height of the terminal emulator window
-        self.screen: pygame.Surface = pygame.display.set_mode(
-            (self.width, self.height))  # The screen surface of the terminal emulator window
-        self.font: pygame.font.Font = pygame.font.Font(None, font_size)
+        if headless:
+            self.screen: pygame.Surface | None = None
+            self.font: pygame.font.Font | HeadlessFont = HeadlessFont(font_size)
+        else:
+            self.screen: pygame.Surface | None = pygame.display.set_mode(
+                (self.width, self.height), pygame.RESIZABLE)  # The screen surface of the terminal emulator window
+            self.font: pygame.font.Font | HeadlessFont = pygame.font.Font(None, font_size)
         self.default_bg_color: pygame.color.Color = default_bg_color
         self.bg_color: pygame.color.Color = self.default_bg_color
         self.default_fg_color: pygame.color.Color = default_fg_color
         self.fg_color: pygame.color.Color = self.default_fg_color
         self.custom_line_color = None
-        self.terminal_lines: list[str] = [initial_message]
+        self.markup = False  # Parse inline color markup such as [red]error[/] in written text
+        self.terminal_lines: Scrollback = Scrollback(scrollback_capacity, [initial_message])
+        # Absolute index just past the last visible line, None keeps the viewport on the newest output
+        self.scroll_anchor: int | None = None
+        self.mouse_wheel_lines = 3
+        self._input_generation = 0  # Incremented whenever the input buffer is replaced
         self.current_line: str = ""
         self.cursor_pos: int = 0
-        self.command_history: list[str] = []
+        self.input_scroll: int = 0  # First column of the input line that is visible
+        self._char_advance: int | None = None  # Column width of monospace fonts, None otherwise
+        self.soft_wrap = True  # Wrap long lines at the window width instead of letting them run off the edge
+        self._layout_generation = 0  # Incremented whenever the wrap width or the font changes
+        # Row breaks of recently shown lines by absolute index, entries from older generations are reflowed lazily
+        self._line_layouts: OrderedDict[int, tuple[str, int, tuple[int, ...]]] = OrderedDict()
+        self.line_layout_cache_size = 8192
+        self.command_history: CommandHistory = CommandHistory(history_file, history_size)
         self.history_index: int = -1
-        self.clock: pygame.time.Clock = pygame.time.Clock()
-        self.clock_tick_rate = 30
+        self.history_search: HistorySearch | None = None
+        self.scrollback_search: ScrollbackSearch | None = None
+        self.search_highlight_color = (90, 90, 0)
+        self.search_current_color = (170, 110, 0)
+        # Search index over the scrollback, built on the first search and then kept up to date
+        self._scrollback_index: ChunkedTextIndex | None = None
+        self._indexed_until = 0  # Absolute index of the first line not yet in the index
+        self._stale_lines: set[int] = set()  # Indexed lines replaced since, searched through their current text
+        self._index_timer: list | None = None
+        # Once the index exists new lines are indexed in slices from a timer, so a search only has to index the last few
+        self.scrollback_index_slice = 4096
+        self.scrollback_index_interval_ms = 10
+        self.clock_tick_rate = 60  # Frame rate cap while there is something to redraw
+        self.idle_timeout_ms = 500  # Longest time the main loop blocks waiting for events
+        self.input_poll_ms = 16  # How often run_async peeks at the pygame event queue while idle
+        self._timers: list[list] = []  # Heap of [deadline_ms, sequence, callback]
+        self._timer_sequence = count()
+        self._last_frame_ms = 0
+        self._modal_key_handlers: list[Callable[[pygame.event.Event], bool]] = []
+
+        # Background workers, other threads hand work to the main loop through _main_thread_calls
+        self.max_workers = 4
+        self.executor: ThreadPoolExecutor | None = None
+        self.background_jobs: list[BackgroundJob] = []
+        self._job_local = threading.local()
+        self._main_thread_id = threading.get_ident()
+        self._main_thread_calls: queue.SimpleQueue = queue.SimpleQueue()
+        self._wake_pending = threading.Event()
+        # asyncio loop running async commands, either run_async's loop or a private one pumped by step
+        self._async_loop: asyncio.AbstractEventLoop | None = None
+        self._owns_async_loop = False
+        self._async_wake: asyncio.Event | None = None  # Cuts run_async's sleep short, set while it runs
+        self._input_waiters: list[asyncio.Future] = []  # Resolved with the input line when input mode ends
         self.running: bool = True
         self.input_mode: bool = False
         self.input_prompt: str = ""
         self.input_callback: Callable | None = None
         self.line_margin_height = 5
         self.font_size = font_size
-        self.set_monospace_font()
-        self.lines_on_screen = floor(self.height / (self.font.get_height() + self.line_margin_height)) - 2
-        self.illustration_window = None
-        self.custom_event_handlers = {}
-        pygame.key.set_repeat(500, 50)
+        self.use_glyph_atlas = use_glyph_atlas
+        self.glyph_atlas: GlyphAtlas | None = None
+        self.surface_cache = SurfaceCache(surface_cache_bytes)
+        # Dirty-region tracking, only the regions that changed are redrawn and pushed to the display
+        self.dirty_rects: list[pygame.Rect] = []
+        self.full_redraw: bool = True
+        self._drawn_input_state: tuple | None = None
+        self._drawn_color_state: tuple | None = None
+        # Main loop instrumentation, shown by the F12 overlay and returned by frame_stats
+        self.profiler = FrameProfiler()
+        self.show_profiler_overlay = False
+        self.profiler_overlay_interval_ms = 500
+        self._profiler_overlay_lines: list[str] = []
+        self._profiler_overlay_rect: pygame.Rect | None = None
+        self._profiler_overlay_timer: list | None = None
+        self._retired_atlas_renders = 0  # Glyphs rasterized by atlases replaced after a font change
+        self._profile: cProfile.Profile | None = None
+        # Widgets composited over the terminal lines, the last focused one receives the key presses
+        self.widgets: list[Widget] = []
+        self.focused_widgets: list[Widget] = []
+        self._legacy_widgets: dict[tuple, Widget] = {}  # Widgets of draw_table/draw_menu/draw_progress_bar
+        # Streaming sources, drained into the scrollback at most stream_lines_per_frame lines per frame
+        self.streams: list[OutputStream] = []
+        self.stream_lines_per_frame = 2000
+        self._state_stores: dict[str, StateStore] = {}
+        self._autosave_timers: dict[str, list] = {}
+        self.set_monospace_font()  # Also computes lines_on_screen
+        self.illustration_window: ImageWidget | None = None
+        self.resize_debounce_ms = 100  # Window resizes are laid out once the size stops changing for this long
+        self._pending_size: tuple[int, int] | None = None
+        self._resize_timer: list | None = None
+        self.event_bus = EventBus(self)
+        if not headless:
+            pygame.key.set_repeat(500, 50)
 
         # Command registry
         self.commands: dict[str, Command] = {}
+        self.command_trie = CompletionTrie()
+        self.max_listed_completions = 100
+        # (line, cursor, candidates, index, word start) of the completion being cycled with Tab
+        self._completion_cycle: tuple | None = None
 
     def set_monospace_font(self):
+        if self.headless:
+            self.font = HeadlessFont(self.font_size)
+            self.on_font_changed()
+            return
         try:
             # Try to use 'Courier' font, which is available on most systems
             self.font = pygame.font.SysFont('courier', self.font_size)
@@ -153,14 +2361,307 @@ class PygameTerminal:
                 # If both fail, fall back to the default font
                 print("Warning: Monospace font not found. Using default font.")
                 self.font = pygame.font.Font(None, self.font_size)
+        self.on_font_changed()
+
+    def on_font_changed(self) -> None:
+        """Invalidate everything that depends on the current font."""
+        self.surface_cache.clear()
+        # Glyph advances rather than font.size, which includes the overhang of glyphs like W or _
+        advances = {metrics[4] for metrics in self.font.metrics("iMW.0_ ") if metrics}
+        self._char_advance = advances.pop() if len(advances) == 1 else None
+        if self.glyph_atlas is not None:
+            self._retired_atlas_renders += self.glyph_atlas.renders - self.glyph_atlas.compositions
+        if self.use_glyph_atlas and not self.headless:
+            self.glyph_atlas = GlyphAtlas(self.font)
+            # Printable ASCII in the default color covers the vast majority of terminal output
+            self.glyph_atlas.preload("".join(chr(c) for c in range(32, 127)), self.fg_color)
+        else:
+            self.glyph_atlas = None
+        self.update_geometry()
+
+    def update_geometry(self) -> None:
+        """
+        Recompute the layout that depends on the window size and the font.
+
+        Wrapped lines are not measured here, bumping the layout generation makes every line reflow
+        the next time it is shown, so only the lines in view pay for it.
+        """
+        self.lines_on_screen = max(floor(self.height / (self.font.get_height() + self.line_margin_height)) - 2, 1)
+        self._layout_generation += 1
+        self.mark_dirty()
+
+    def request_resize(self, width: int, height: int) -> None:
+        """
+        Resize the terminal once the window size has stopped changing for resize_debounce_ms.
+
+        Dragging a window border sends a storm of resize events, only the last size is laid out.
+        """
+        self._pending_size = (width, height)
+        if self._resize_timer is not None:
+            self.cancel_timer(self._resize_timer)
+        self._resize_timer = self.schedule(self.resize_debounce_ms, self._apply_pending_resize)
+
+    def _apply_pending_resize(self) -> None:
+        self._resize_timer = None
+        self.resize(*self._pending_size)
+
+    def resize(self, width: int, height: int) -> None:
+        """Resize the terminal right away and lay it out for the new size."""
+        width, height = max(width, 1), max(height, 1)
+        if (width, height) == (self.width, self.height):
+            return
+        self.width, self.height = width, height
+        if not self.headless:
+            # SDL already resized the display surface of a window resized by the user
+            surface = pygame.display.get_surface()
+            if surface is None or surface.get_size() != (width, height):
+                surface = pygame.display.set_mode((width, height), pygame.RESIZABLE)
+            self.screen = surface
+        self.update_geometry()
 
     def set_font_size(self, font_size: int) -> None:
         """Set the font size."""
         self.font_size = font_size
         self.set_monospace_font()
 
-    def color_current_line(self):
-        pass
+    @property
+    def current_line(self) -> str:
+        """The text of the input line, materialized from the gap buffer only when read."""
+        if self._current_line is None:
+            self._current_line = self.input_buffer.text()
+        return self._current_line
+
+    @current_line.setter
+    def current_line(self, text: str) -> None:
+        self.input_buffer = GapBuffer(text)
+        self._current_line = text
+        self._input_generation += 1
+
+    def insert_text(self, text: str) -> None:
+        """Insert text at the cursor."""
+        self.input_buffer.insert(self.cursor_pos, text)
+        self._current_line = None
+        self.cursor_pos += len(text)
+
+    def delete_text(self, position: int, count: int) -> None:
+        """Delete count characters of the input line starting at position."""
+        self.input_buffer.delete(position, count)
+        self._current_line = None
+
+    def mark_dirty(self, rect: pygame.Rect | None = None) -> None:
+        """
+        Schedule a region of the screen to be redrawn on the next frame.
+
+        :param rect: The region to redraw, or None to redraw the whole screen
+        """
+        if rect is None:
+            self.full_redraw = True
+        elif not self.full_redraw and rect not in self.dirty_rects:
+            self.dirty_rects.append(rect)
+
+    def mark_lines_dirty(self) -> None:
+        """Schedule the scrollback area for redraw."""
+        self.mark_dirty(self.lines_rect())
+
+    def mark_input_dirty(self) -> None:
+        """Schedule the input line for redraw."""
+        self.mark_dirty(self.input_rect())
+
+    def lines_rect(self) -> pygame.Rect:
+        """The screen area occupied by the terminal lines."""
+        return pygame.Rect(0, 0, self.width, self.height - self.terminal_margin_bottom)
+
+    def input_rect(self) -> pygame.Rect:
+        """The screen area occupied by the input line and the cursor."""
+        input_y = self.height - self.terminal_margin_bottom
+        return pygame.Rect(0, input_y, self.width, self.terminal_margin_bottom)
+
+    @property
+    def wrap_width(self) -> int:
+        """The width available to the terminal lines, long lines wrap at it."""
+        return max(self.width - 2 * self.terminal_margin_left, 1)
+
+    def wrap_text(self, text: str) -> tuple[int, ...]:
+        """
+        Break a line into display rows at the wrap width, preferring to break after a space.
+
+        :return: The start offset of every row, (0,) for lines that fit
+        """
+        if not self.soft_wrap or not text:
+            return (0,)
+        width = self.wrap_width
+        columns = max(width // self._char_advance, 1) if self._char_advance is not None else None
+        if columns is not None:
+            if len(text) <= columns:
+                return (0,)
+        elif self.font.size(text)[0] <= width:
+            return (0,)
+
+        breaks = [0]
+        start, length = 0, len(text)
+        while True:
+            if columns is not None:
+                end = start + columns
+            else:
+                # Furthest offset whose text still fits, every row takes at least one character
+                low, high = start + 1, min(length, start + width)
+                while low < high:
+                    middle = (low + high + 1) // 2
+                    if self.font.size(text[start:middle])[0] <= width:
+                        low = middle
+                    else:
+                        high = middle - 1
+                end = low
+            if end >= length:
+                return tuple(breaks)
+            space = text.rfind(" ", start, end + 1)
+            if space > start:
+                end = space + 1  # The space ends the row instead of starting the next one
+            breaks.append(end)
+            start = end
+
+    def line_breaks(self, index: int) -> tuple[int, ...]:
+        """
+        The row breaks of a scrollback line, from the layout cache when it is still current.
+
+        :param index: Index of the line in the scrollback, not its absolute index
+        """
+        line = self.terminal_lines[index]
+        key = self.terminal_lines.first_index + index
+        layout = self._line_layouts.get(key)
+        # Lines replaced in place keep their index, so the cached text must be the same object
+        if layout is not None and layout[0] is line and layout[1] == self._layout_generation:
+            self._line_layouts.move_to_end(key)
+            return layout[2]
+        breaks = self.wrap_text(line)
+        self._line_layouts[key] = (line, self._layout_generation, breaks)
+        self._line_layouts.move_to_end(key)
+        if len(self._line_layouts) > self.line_layout_cache_size:
+            self._line_layouts.popitem(last=False)
+        return breaks
+
+    def line_rows(self, index: int) -> int:
+        """The number of display rows a scrollback line occupies."""
+        return len(self.line_breaks(index)) if self.soft_wrap else 1
+
+    def _rows_back(self, stop: int, rows: int) -> tuple[int, int]:
+        """
+        Walk backwards from stop summing display rows until there are at least rows of them.
+
+        :return: The first line reached and the number of rows counted
+        """
+        start, counted = stop, 0
+        while start > 0 and counted < rows:
+            start -= 1
+            counted += self.line_rows(start)
+        return start, counted
+
+    def _min_stop(self) -> int:
+        """The smallest viewport stop that still fills the screen from the first line."""
+        length = len(self.terminal_lines)
+        stop, rows = 0, 0
+        while stop < length and rows < self.lines_on_screen:
+            rows += self.line_rows(stop)
+            stop += 1
+        return stop
+
+    def visible_line_range(self) -> tuple[int, int]:
+        """
+        The [start, stop) range of scrollback lines shown in the viewport.
+
+        Computed from the scroll anchor by walking back over the rows of the visible lines only, so
+        the cost is the same whatever the scrollback size.
+        """
+        length = len(self.terminal_lines)
+        if self.scroll_anchor is None:
+            stop = length
+        else:
+            # Never leave the viewport half empty, even if the anchored lines were evicted
+            stop = max(self.scroll_anchor - self.terminal_lines.first_index, self._min_stop())
+            stop = min(stop, length)
+        return self._rows_back(stop, self.lines_on_screen)[0], stop
+
+    def scroll_lines(self, count: int) -> None:
+        """
+        Scroll the viewport through the scrollback.
+
+        :param count: Number of lines to scroll, positive values move towards older output
+        """
+        length = len(self.terminal_lines)
+        _, stop = self.visible_line_range()
+        stop = min(max(stop - count, self._min_stop()), length)
+        if stop >= length:
+            self.scroll_anchor = None
+        else:
+            self.scroll_anchor = self.terminal_lines.first_index + stop
+        self.mark_lines_dirty()
+
+    def scroll_page(self, pages: int) -> None:
+        """
+        Scroll the viewport by whole screens, positive values move towards older output.
+
+        Wrapped lines move as a whole, so a page scrolls by as many lines as fit in a screen of rows,
+        and always by at least one line.
+        """
+        length = len(self.terminal_lines)
+        _, stop = self.visible_line_range()
+        direction = -1 if pages > 0 else 1
+        index = stop - 1 if pages > 0 else stop
+        rows_left = abs(pages) * max(self.lines_on_screen - 1, 1)
+        moved = 0
+        while 0 <= index < length:
+            rows = self.line_rows(index)
+            if moved and rows > rows_left:
+                break
+            rows_left -= rows
+            moved += 1
+            index += direction
+        self.scroll_lines(moved if pages > 0 else -moved)
+
+    def scroll_to_top(self) -> None:
+        """Show the oldest lines in the scrollback."""
+        self.scroll_lines(len(self.terminal_lines))
+
+    def scroll_to_bottom(self) -> None:
+        """Show the newest lines and follow new output again."""
+        if self.scroll_anchor is not None:
+            self.scroll_anchor = None
+            self.mark_lines_dirty()
+
+    def handle_scroll_keydown(self, event) -> bool:
+        """
+        Handle the viewport scrolling key bindings.
+
+        :return: Whether the key was a scrolling key
+        """
+        if event.key == pygame.K_PAGEUP:
+            self.scroll_page(1)
+        elif event.key == pygame.K_PAGEDOWN:
+            self.scroll_page(-1)
+        elif event.key == pygame.K_HOME and event.mod & pygame.KMOD_CTRL:
+            self.scroll_to_top()
+        elif event.key == pygame.K_END and event.mod & pygame.KMOD_CTRL:
+            self.scroll_to_bottom()
+        else:
+            return False
+        return True
+
+    def color_current_line(self, color, background=None) -> None:
+        """
+        Color the last written line, replacing any colors it had.
+
+        :param color: A color_data palette name, a pygame.Color or an RGB tuple
+        :param background: The background color, None keeps the terminal background
+        """
+        if not self.in_main_thread():
+            self.call_in_main_thread(self.color_current_line, color, background)
+            return
+        if not self.terminal_lines:
+            return
+        text = str(self.terminal_lines[-1])
+        background = resolve_color(background) if background is not None else None
+        self.terminal_lines[-1] = StyledLine(text, [(len(text), resolve_color(color), background)])
+        self.mark_lines_dirty()
 
     def quit(self):
         self.running = False
@@ -172,43 +2673,454 @@ class PygameTerminal:
         :param prompt: The prompt to display to the user
         :return: 's input as a string
         """
+        if not self.in_main_thread():
+            return self.run_in_main_thread(self.prompt_user, prompt)
+        if self.headless:
+            return self.next_scripted_line()
+
         self.input_mode = True
         self.input_prompt = prompt
         self.current_line = ""
         self.cursor_pos = 0
 
-        while self.input_mode:
-            self.handle_events()
-            self.draw_terminal()
-            self.clock.tick(self.clock_tick_rate)
+        self.run_until(lambda: not self.input_mode)
 
         return self.current_line
 
+    def in_main_thread(self) -> bool:
+        """Whether the caller runs on the thread that drives the main loop."""
+        return threading.get_ident() == self._main_thread_id
+
     def set_font_name(self, font_name: str) -> None:
         """Set the font name."""
-        self.font = pygame.font.Font(font_name, self.font.get_height())
+        if not self.headless:
+            self.font = pygame.font.Font(font_name, self.font.get_height())
+        self.on_font_changed()
 
     def set_font(self, font_name: str, font_size: int) -> None:
         """Set the font."""
-        self.font = pygame.font.Font(font_name, font_size)
+        self.font_size = font_size
+        self.font = HeadlessFont(font_size) if self.headless else pygame.font.Font(font_name, font_size)
+        self.on_font_changed()
+
+    def write_command_history(self, limit: int = -1) -> None:
+        """Write the command history to the terminal."""
+        self.terminal_lines.extend(self.command_history[-limit:])
+        self.mark_lines_dirty()
+
+    def run(self):
+        """The main loop to run the terminal emulator."""
+        try:
+            if self.headless:
+                while self.running and self.feed_scripted_input():
+                    self.run_until(lambda: not self.background_jobs)
+                self.run_until(lambda: not self.background_jobs)
+            else:
+                self.run_until(lambda: False)
+        finally:
+            self.shutdown_workers()
+
+    def next_scripted_line(self) -> str:
+        """
+        Take the next line from the input source, stopping the terminal once it is exhausted.
+
+        :return: The line, or an empty string when there is no input left
+        """
+        line = next(self.input_source, None) if self.input_source is not None else None
+        if line is None:
+            self.running = False
+            return ""
+        return line.rstrip("\r\n")
+
+    def feed_scripted_input(self) -> bool:
+        """
+        Enter the next line of the input source as if it was typed at the prompt.
+
+        :return: False once the input source is exhausted
+        """
+        line = self.next_scripted_line()
+        if not self.running:
+            return False
+        self.current_line = line
+        self.cursor_pos = len(line)
+        self.handle_return()
+        return True
+
+    def run_until(self, condition: Callable[[], bool]) -> None:
+        """
+        Run the main loop until the condition is met or the terminal stops running.
+
+        Every blocking helper (prompt_user, wait, countdown_with_message) is built on this loop, so
+        nested calls share the same timers and frame pacing.
+
+        :param condition: Checked before every iteration, the loop exits once it returns True
+        """
+        while self.running and not condition():
+            self.step()
+
+    def step(self) -> None:
+        """
+        Run a single iteration of the main loop.
+
+        Blocks in pygame.event.wait until an event arrives, a timer is due or a pending frame may be
+        drawn, then dispatches the events and timers and renders if anything is dirty.
+        """
+        timeout = self._next_timeout()
+        if self.headless:
+            # No event queue without a display, block on the calls queued by other threads instead
+            try:
+                call = self._main_thread_calls.get(timeout=timeout / 1000)
+            except queue.Empty:
+                call = None
+            self._run_iteration(None, call)
+        else:
+            events = []
+            if timeout > 0:
+                event = pygame.event.wait(timeout)
+                if event.type != pygame.NOEVENT:
+                    events.append(event)
+            events.extend(pygame.event.get())
+            self._run_iteration(events)
+
+    def _run_iteration(self, events: list[pygame.event.Event] | None, call: tuple | None = None) -> None:
+        """
+        The work of a main loop iteration once it stops waiting, shared by step and run_async.
+
+        The iteration is recorded as a frame of the profiler only when it actually drew something,
+        idle wake-ups for timers or stream output would skew the frame timings otherwise.
+
+        :param events: The pygame events to handle, None in headless mode
+        :param call: A call taken off the main thread queue while waiting, run first
+        """
+        frame_start = time.perf_counter()
+        render_calls = self.font_render_calls
+        if call is not None:
+            function, args = call
+            function(*args)
+        if events is not None:
+            self.handle_events(events)
+            self.profiler.record("handle_events", time.perf_counter() - frame_start)
+
+        self._drain_main_thread_calls()
+        self.drain_streams()
+        self._run_due_timers()
+        self._pump_async_loop()
+        if (self._scrollback_index is not None and self._index_timer is None
+                and self._indexed_until < self.terminal_lines.total_appended):
+            self._index_timer = self.schedule(self.scrollback_index_interval_ms, self._index_scrollback_slice)
+
+        if self.refresh():
+            self.profiler.record_frame(time.perf_counter() - frame_start, self.font_render_calls - render_calls)
+
+    async def run_async(self):
+        """
+        The main loop driven from asyncio, for apps that use ``async def`` commands or other coroutines.
+
+        Between iterations the loop yields to asyncio until a timer or frame is due, another thread
+        queues a call or an input event arrives, so async commands, sockets and subprocesses keep
+        progressing while the terminal stays responsive.
+        """
+        self._async_loop = asyncio.get_running_loop()
+        self._owns_async_loop = False
+        self._async_wake = asyncio.Event()
+        try:
+            while self.running:
+                if self.headless:
+                    if not self.background_jobs and not self.feed_scripted_input():
+                        break
+                    self._run_iteration(None)
+                else:
+                    self._run_iteration(pygame.event.get())
+                await self._wait_async()
+        finally:
+            self._resolve_input_waiters()  # Prompts still waiting get what was typed so far
+            self.shutdown_workers()
+            self._async_wake = None
+            self._async_loop = None
+
+    async def _wait_async(self) -> None:
+        """
+        Sleep until the next timer or frame is due, a call is queued from another thread or an input event arrives.
+
+        pygame can't wake asyncio up, so while idle the event queue is peeked every input_poll_ms. A
+        peek only pumps the events, the rest of the iteration waits until something actually arrived.
+        """
+        wake = self._async_wake
+        deadline = now_ms() + self._next_timeout()
+        while not wake.is_set() and self.running:
+            # Writes from coroutines may have made a frame due since the last check
+            timeout = min(self._next_timeout(), deadline - now_ms())
+            if timeout <= 0 or (not self.headless and pygame.event.peek()):
+                break
+            if not self.headless:
+                timeout = min(timeout, self.input_poll_ms)
+            try:
+                await asyncio.wait_for(wake.wait(), timeout / 1000)
+            except asyncio.TimeoutError:
+                pass
+        wake.clear()
+
+    async def prompt_user_async(self, prompt: str) -> str:
+        """
+        Awaitable version of prompt_user, other coroutines keep running while the user types.
+
+        :param prompt: The prompt to display to the user
+        :return: The user's input as a string
+        """
+        if self.headless:
+            return self.next_scripted_line()
+
+        # Prompts from concurrent commands take turns on the single input line
+        while self.input_mode and self.running:
+            await self._input_finished()
+        if not self.running:
+            return self.current_line
+
+        self.input_mode = True
+        self.input_prompt = prompt
+        self.current_line = ""
+        self.cursor_pos = 0
+        return await self._input_finished()
+
+    def _input_finished(self) -> asyncio.Future:
+        """A future resolved with the input line when the current input mode ends."""
+        future = asyncio.get_running_loop().create_future()
+        self._input_waiters.append(future)
+        return future
+
+    def _resolve_input_waiters(self) -> None:
+        waiters, self._input_waiters = self._input_waiters, []
+        for future in waiters:
+            if not future.done():
+                future.set_result(self.current_line)
+
+    @staticmethod
+    async def wait_async(duration_ms: int):
+        """Awaitable version of wait."""
+        await asyncio.sleep(duration_ms / 1000)
+
+    def start_async_job(self, name: str, coroutine) -> BackgroundJob:
+        """
+        Run a coroutine as an asyncio task tracked like a background job.
+
+        Under run_async the task runs on its loop, otherwise on a private loop pumped by the main loop.
+
+        :param name: The name shown in the running indicator
+        :param coroutine: The coroutine to run
+        """
+        if self._async_loop is None:
+            self._async_loop = asyncio.new_event_loop()
+            self._owns_async_loop = True
+
+        task = self._async_loop.create_task(coroutine)
+        job = BackgroundJob(name=name, future=task, started_ms=now_ms())
+        self.background_jobs.append(job)
+        task.add_done_callback(lambda _: self._finish_background_job(job))
+        return job
+
+    def _pump_async_loop(self) -> None:
+        """Run one iteration of the private asyncio loop when run_async isn't driving it."""
+        loop = self._async_loop
+        if self._owns_async_loop and loop is not None and not loop.is_running():
+            loop.call_soon(loop.stop)
+            loop.run_forever()
+
+    def _next_timeout(self) -> int:
+        """Milliseconds the loop may block before the next timer or pending frame is due."""
+        now = now_ms()
+        timeout = self.idle_timeout_ms
+        if self._timers:
+            timeout = min(timeout, self._timers[0][0] - now)
+        if (self.full_redraw or self.dirty_rects) and not self.headless:
+            timeout = min(timeout, self._last_frame_ms + 1000 // self.clock_tick_rate - now)
+        if any(stream.pending for stream in self.streams):
+            # More output than the per-frame budget is waiting, come back for it on the next frame
+            timeout = min(timeout, self._last_frame_ms + 1000 // self.clock_tick_rate - now)
+        if self._owns_async_loop and self.background_jobs:
+            # Async commands on the private loop need regular pumping to make progress
+            timeout = min(timeout, 1000 // self.clock_tick_rate)
+        return max(timeout, 0)
+
+    def schedule(self, delay_ms: int, callback: Callable[[], Any]) -> list:
+        """
+        Run a callback from the main loop after a delay.
+
+        :param delay_ms: The delay in milliseconds
+        :param callback: The function to call once the delay has passed
+        :return: A handle that can be passed to cancel_timer
+        """
+        timer = [now_ms() + delay_ms, next(self._timer_sequence), callback]
+        heapq.heappush(self._timers, timer)
+        if self._async_wake is not None:
+            self._async_wake.set()  # The timer may be due before run_async meant to wake up
+        return timer
+
+    @staticmethod
+    def cancel_timer(timer: list) -> None:
+        """Cancel a timer returned by schedule."""
+        timer[2] = None
+
+    def _run_due_timers(self) -> None:
+        now = now_ms()
+        while self._timers and self._timers[0][0] <= now:
+            callback = heapq.heappop(self._timers)[2]
+            if callback is not None:
+                callback()
+
+    def call_in_main_thread(self, function: Callable, *args) -> None:
+        """
+        Queue a call to run on the main loop thread and wake the loop up. Safe to call from any thread.
+        """
+        self._main_thread_calls.put((function, args))
+        if not self._wake_pending.is_set():
+            # One wake-up is enough however many calls are queued behind it
+            self._wake_pending.set()
+            loop, wake = self._async_loop, self._async_wake
+            if wake is not None:
+                try:
+                    loop.call_soon_threadsafe(wake.set)
+                except RuntimeError:
+                    pass  # run_async just finished and its loop is closed
+            if not self.headless:
+                pygame.event.post(pygame.event.Event(WAKE_EVENT))
+
+    def run_in_main_thread(self, function: Callable, *args) -> Any:
+        """Run a call on the main loop thread and block the calling worker until it returns."""
+        future = Future()
+
+        def call():
+            try:
+                future.set_result(function(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+        self.call_in_main_thread(call)
+        return future.result()
+
+    def _drain_main_thread_calls(self) -> None:
+        self._wake_pending.clear()
+        # Bounded so calls queued while draining wait for the next iteration
+        for _ in range(self._main_thread_calls.qsize()):
+            try:
+                function, args = self._main_thread_calls.get_nowait()
+            except queue.Empty:
+                return  # A nested loop, such as a prompt_user call, already ran the rest
+            function(*args)
+
+    def start_background_job(self, name: str, function: Callable, *args, **kwargs) -> BackgroundJob:
+        """
+        Run a function in the worker pool while the main loop keeps handling input and rendering.
+
+        Output written by the function is marshalled back to the main thread. Its return value is
+        written to the terminal when it finishes, like the result of a regular command.
+
+        :param name: The name shown in the running indicator
+        :param function: The function to run
+        :return: The job, which can be cancelled with cancel_background_jobs
+        """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="terminal-worker")
+
+        job = BackgroundJob(name=name, future=Future(), started_ms=now_ms())
+
+        def run_job():
+            self._job_local.job = job
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self._job_local.job = None
+
+        job.future = self.executor.submit(run_job)
+        self.background_jobs.append(job)
+        job.future.add_done_callback(lambda _: self.call_in_main_thread(self._finish_background_job, job))
+        return job
+
+    def _finish_background_job(self, job: BackgroundJob) -> None:
+        if job in self.background_jobs:
+            self.background_jobs.remove(job)
+        self.profiler.record_command(job.name, now_ms() - job.started_ms)
+        if job.future.cancelled():
+            self.write(f"'{job.name}' cancelled.")
+            return
+        error = job.future.exception()
+        if isinstance(error, ValueError):
+            self.write(str(error))
+        elif error is not None:
+            self.write(f"Error in '{job.name}': {error}")
+        elif job.future.result() is not None:
+            self.write(str(job.future.result()))
+
+    def cancelled(self) -> bool:
+        """
+        Whether the background job running on the calling thread was asked to stop.
+
+        Long-running background commands should check this periodically and return early.
+        """
+        job = getattr(self._job_local, "job", None)
+        return job is not None and job.cancel_event.is_set()
+
+    def cancel_background_jobs(self) -> None:
+        """Ask every running background job to stop, jobs that haven't started are dropped."""
+        for job in self.background_jobs:
+            if not job.cancel_event.is_set():
+                job.cancel_event.set()
+                job.future.cancel()
+                self.write(f"Cancelling '{job.name}'...")
+
+    def shutdown_workers(self) -> None:
+        """Cancel the background jobs, release the worker pool and finish the pending state saves."""
+        self.close_streams()
+        for store in self._state_stores.values():
+            store.close()
+        self._state_stores.clear()
+        self._drain_main_thread_calls()  # Deliver what the finished saves reported
+        for job in self.background_jobs:
+            job.cancel_event.set()
+            if isinstance(job.future, asyncio.Task):
+                job.future.cancel()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+        if self._owns_async_loop:
+            self._pump_async_loop()  # Let the cancelled tasks unwind
+            self._async_loop.close()
+            self._async_loop = None
+            self._owns_async_loop = False
 
-    def write_command_history(self, limit: int = -1) -> None:
-        """Write the command history to the terminal."""
-        for line in self.command_history[-limit:]:
-            self.terminal_lines.append(line)
+    def _run_modal(self, duration_ms: int, key_handler: Callable[[pygame.event.Event], bool],
+                   stop: Callable[[], bool] = lambda: False) -> bool:
+        """
+        Run the main loop for a fixed duration while key presses go to key_handler.
 
-    def run(self):
-        """The main loop to run the terminal emulator."""
-        while self.running:
-            self.handle_events()
-            self.draw_terminal()
-            self.clock.tick(self.clock_tick_rate)
+        :return: True if the whole duration elapsed, False if stopped early or the terminal quit
+        """
+        expired = []
+        timer = self.schedule(duration_ms, lambda: expired.append(True))
+        self._modal_key_handlers.append(key_handler)
+        try:
+            self.run_until(lambda: expired or stop())
+        finally:
+            self._modal_key_handlers.remove(key_handler)
+            self.cancel_timer(timer)
+        return bool(expired)
 
-    def handle_events(self):
+    def handle_events(self, events: list[pygame.event.Event] | None = None):
         """Handle events."""
-        for event in pygame.event.get():
+        if events is None:
+            events = pygame.event.get()
+        for event in events:
             if event.type == pygame.QUIT:
                 self.running = False
+            elif event.type == WAKE_EVENT:
+                pass  # Only there to unblock pygame.event.wait, the queued calls are drained by step
+            elif (event.type == pygame.KEYDOWN and event.key == pygame.K_c and event.mod & pygame.KMOD_CTRL
+                  and (self.background_jobs or self.streams)):
+                self.cancel_background_jobs()
+                self.close_streams()
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_F12:
+                self.toggle_profiler_overlay()
+            elif event.type == pygame.KEYDOWN and self._modal_key_handlers and self._modal_key_handlers[-1](event):
+                continue
             elif event.type == pygame.KEYDOWN:
                 if self.input_mode:
                     self.handle_input_keydown(event)
@@ -219,16 +3131,23 @@ class PygameTerminal:
                     self.handle_input_keyup()  # Handle key releases
                 else:
                     self.handle_keyup()  # Handle key releases
+            elif event.type == pygame.MOUSEWHEEL:
+                self.scroll_lines(event.y * self.mouse_wheel_lines)
+            elif event.type in (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED):
+                self.mark_dirty()
+            elif event.type == pygame.VIDEORESIZE:
+                self.request_resize(event.w, event.h)
+            elif event.type == pygame.WINDOWRESIZED:
+                self.request_resize(event.x, event.y)
             # Handle custom events
             elif event.type >= pygame.USEREVENT:
-                event_name = pygame.event.event_name(event.type)
-                if event_name in self.custom_event_handlers:
-                    self.custom_event_handlers[event_name](event)  # Pass the event object
+                self.event_bus.dispatch(event)
 
     def handle_return(self):
         """Handle the return key."""
         if self.current_line.strip():
             self.command_history.append(self.current_line)
+        self.scroll_to_bottom()
         self.process_command(self.current_line)
         self.current_line = ""
         self.cursor_pos = 0
@@ -241,8 +3160,72 @@ class PygameTerminal:
     def handle_backspace(self):
         """Handle the backspace key."""
         if self.cursor_pos > 0:
-            self.current_line = self.current_line[:self.cursor_pos - 1] + self.current_line[self.cursor_pos:]
             self.cursor_pos -= 1
+            self.delete_text(self.cursor_pos, 1)
+
+    def handle_delete(self):
+        """Handle the delete key."""
+        self.delete_text(self.cursor_pos, 1)
+
+    def handle_home(self):
+        """Move the cursor to the start of the input line."""
+        self.cursor_pos = 0
+
+    def handle_end(self):
+        """Move the cursor to the end of the input line."""
+        self.cursor_pos = len(self.input_buffer)
+
+    def handle_word_left(self):
+        """Move the cursor to the start of the previous word."""
+        buffer = self.input_buffer
+        position = self.cursor_pos
+        while position > 0 and buffer[position - 1] == " ":
+            position -= 1
+        while position > 0 and buffer[position - 1] != " ":
+            position -= 1
+        self.cursor_pos = position
+
+    def handle_word_right(self):
+        """Move the cursor past the end of the next word."""
+        buffer = self.input_buffer
+        position = self.cursor_pos
+        while position < len(buffer) and buffer[position] == " ":
+            position += 1
+        while position < len(buffer) and buffer[position] != " ":
+            position += 1
+        self.cursor_pos = position
+
+    def handle_paste(self):
+        """Insert the clipboard text at the cursor, line breaks become spaces."""
+        text = self.read_clipboard()
+        if text is None:
+            self.write("Paste failed: the clipboard is not available.")
+            return
+        if text:
+            self.insert_text(text.replace("\r\n", " ").replace("\n", " ").replace("\r", " "))
+
+    def read_clipboard(self) -> str | None:
+        """
+        The text on the clipboard.
+
+        :return: The text, empty when the clipboard holds no text, None when there is no clipboard
+        """
+        if self.headless:
+            return None
+        scrap = pygame.scrap
+        try:
+            if hasattr(scrap, "get_text"):  # pygame-ce
+                return scrap.get_text()
+            if not scrap.get_init():
+                scrap.init()
+            data = scrap.get(pygame.SCRAP_TEXT)
+        except pygame.error:
+            return None
+        if data is None:
+            return ""
+        if isinstance(data, bytes):
+            data = data.decode("utf-8", errors="replace")
+        return data.replace("\x00", "")
 
     def handle_left_arrow(self):
         """ Handle the left arrow key. """
@@ -251,8 +3234,8 @@ class PygameTerminal:
 
     def handle_right_arrow(self):
         """ Handle the right arrow key. """
-        if self.cursor_pos < len(self.current_line):
-            self.cursor_pos = min(len(self.current_line), self.cursor_pos + 1)
+        if self.cursor_pos < len(self.input_buffer):
+            self.cursor_pos = min(len(self.input_buffer), self.cursor_pos + 1)
 
     def handle_up_arrow(self):
         """ Handle the up arrow key. """
@@ -273,19 +3256,248 @@ class PygameTerminal:
 
     def handle_printable(self, char):
         """Handle r characters with autocompletion."""
-        self.current_line = self.current_line[:self.cursor_pos] + char + self.current_line[self.cursor_pos:]
-        self.cursor_pos += 1
+        self.insert_text(char)
+
+    def handle_editing_keydown(self, event) -> bool:
+        """
+        Handle the line editing keys shared by the command line and input mode.
+
+        :return: Whether the key was an editing key
+        """
+        ctrl = event.mod & pygame.KMOD_CTRL
+        if event.key == pygame.K_BACKSPACE:
+            self.handle_backspace()
+        elif event.key == pygame.K_DELETE:
+            self.handle_delete()
+        elif event.key == pygame.K_LEFT:
+            self.handle_word_left() if ctrl else self.handle_left_arrow()
+        elif event.key == pygame.K_RIGHT:
+            self.handle_word_right() if ctrl else self.handle_right_arrow()
+        elif event.key == pygame.K_HOME:
+            self.handle_home()
+        elif event.key == pygame.K_END:
+            self.handle_end()
+        elif event.key == pygame.K_v and ctrl:
+            self.handle_paste()
+        else:
+            return False
+        return True
+
+    def active_prompt(self) -> str:
+        """The prompt shown in front of the input line."""
+        if self.history_search is not None:
+            search = self.history_search
+            return f"({'failed ' if search.failed else ''}reverse-i-search)'{search.query}': "
+        if self.scrollback_search is not None:
+            search = self.scrollback_search
+            status = f" [{search.error}]" if search.error else ""
+            mode = f"{'failed ' if search.failed else ''}{'regex ' if search.regex else ''}find"
+            return f"({mode})'{search.query}'{status}"
+        return self.input_prompt if self.input_mode else "> "
+
+    def start_history_search(self):
+        """Enter incremental reverse search through the command history (Ctrl+R)."""
+        self.history_search = HistorySearch(original_line=self.current_line)
+        self._modal_key_handlers.append(self.handle_history_search_keydown)
+
+    def _end_history_search(self, line: str) -> None:
+        self._modal_key_handlers.remove(self.handle_history_search_keydown)
+        self.history_search = None
+        self.current_line = line
+        self.cursor_pos = len(line)
+
+    def _update_history_search(self, before_id: int | None = None) -> None:
+        search = self.history_search
+        match = self.command_history.search(search.query, before_id) if search.query else None
+        search.failed = match is None and bool(search.query)
+        if match is not None:
+            search.match_id, line = match
+            self.current_line = line
+            self.cursor_pos = line.lower().find(search.query.lower())
+
+    def handle_history_search_keydown(self, event) -> bool:
+        """Handle key presses during reverse search, the search narrows with every typed character."""
+        search = self.history_search
+        if event.key == pygame.K_r and event.mod & pygame.KMOD_CTRL:
+            self._update_history_search(search.match_id)  # Next older match
+        elif event.key == pygame.K_ESCAPE or (event.key == pygame.K_g and event.mod & pygame.KMOD_CTRL):
+            self._end_history_search(search.original_line)
+        elif event.key == pygame.K_RETURN or event.key == pygame.K_KP_ENTER:
+            self._end_history_search(self.current_line)
+            self.handle_return()
+        elif event.key == pygame.K_BACKSPACE:
+            search.query = search.query[:-1]
+            self._update_history_search()
+        elif event.key in (pygame.K_LEFT, pygame.K_RIGHT, pygame.K_HOME, pygame.K_END, pygame.K_TAB):
+            self._end_history_search(self.current_line)  # Keep the match for editing
+        elif event.unicode and event.unicode.isprintable():
+            search.query += event.unicode
+            # Extending the query can only match the current entry or older ones
+            before_id = search.match_id + 1 if search.match_id is not None else None
+            self._update_history_search(before_id)
+        return True
+
+    def _sync_scrollback_index(self, limit: int | None = None) -> ChunkedTextIndex:
+        """
+        Add the lines written since the last call to the scrollback index and forget evicted ones.
+
+        :param limit: Most lines to add, None brings the index fully up to date
+        """
+        lines = self.terminal_lines
+        first = lines.first_index
+        if self._scrollback_index is None:
+            self._scrollback_index = lines.search_index = ChunkedTextIndex()
+        if lines.rewritten:
+            # The index keeps the old text of lines replaced after they were indexed
+            self._stale_lines.update(i for i in lines.rewritten if i < self._indexed_until)
+            lines.rewritten.clear()
+        if self._stale_lines and min(self._stale_lines) < first:
+            self._stale_lines = {i for i in self._stale_lines if i >= first}
+        start = max(self._indexed_until, first)
+        stop = first + len(lines) if limit is None else min(first + len(lines), start + limit)
+        add = self._scrollback_index.add
+        for line_index, line in enumerate(lines.view(start - first, stop - first), start):
+            add(line_index, line)
+        self._indexed_until = stop
+        self._scrollback_index.discard_below(first)
+        return self._scrollback_index
+
+    def _index_scrollback_slice(self) -> None:
+        """Index the next slice of new scrollback lines, rescheduling itself until the index has caught up."""
+        self._index_timer = None
+        self._sync_scrollback_index(self.scrollback_index_slice)
+        if self._indexed_until < self.terminal_lines.total_appended:
+            self._index_timer = self.schedule(self.scrollback_index_interval_ms, self._index_scrollback_slice)
+
+    def find_in_scrollback(self, query: str | re.Pattern, start: int | None = None,
+                           backward: bool = True) -> int | None:
+        """
+        Find the next scrollback line matching a query.
+
+        The first search builds an index of the scrollback, after that new lines are indexed in slices
+        between frames and the call only indexes what is left, so searches over a large scrollback scan
+        the chunked index in C instead of every line in Python.
+
+        :param query: Text matched case-insensitively, or a pattern compiled with re.IGNORECASE
+        :param start: Absolute index to search from, exclusive, None searches the whole scrollback
+        :param backward: Search towards older lines
+        :return: The absolute index of the matching line, or None
+        """
+        index = self._sync_scrollback_index()
+        lines = self.terminal_lines
+        first = lines.first_index
+        if isinstance(query, str):
+            needle = query.lower()
+
+            def verify(line_index):
+                return line_index >= first and needle in lines[line_index - first].lower()
+        else:
+            def verify(line_index):
+                return line_index >= first and query.search(lines[line_index - first]) is not None
+
+        # Lines replaced since they were indexed are matched directly, they win when closer than the index match
+        if backward:
+            before = first + len(lines) if start is None else start
+            match = index.search_backward(query, before, verify)
+            low = first - 1 if match is None else match
+            return max((i for i in self._stale_lines if low < i < before and verify(i)), default=match)
+        after = first - 1 if start is None else start
+        match = index.search_forward(query, after, verify)
+        high = first + len(lines) if match is None else match
+        return min((i for i in self._stale_lines if after < i < high and verify(i)), default=match)
+
+    def scroll_to_line(self, index: int) -> None:
+        """Scroll the viewport so that the line with this absolute index is around the middle of the screen."""
+        lines = self.terminal_lines
+        stop = index - lines.first_index + 1
+        rows, half = 0, self.lines_on_screen // 2
+        while stop < len(lines) and rows + self.line_rows(stop) <= half:
+            rows += self.line_rows(stop)
+            stop += 1
+        self.scroll_anchor = None if stop >= len(lines) else lines.first_index + stop
+        self.mark_lines_dirty()
+
+    def start_scrollback_search(self):
+        """Enter find mode over the scrollback (Ctrl+F), matches are highlighted as the query is typed."""
+        self.scrollback_search = ScrollbackSearch(original_anchor=self.scroll_anchor)
+        self._modal_key_handlers.append(self.handle_scrollback_search_keydown)
+        if self._scrollback_index is None and self._index_timer is None:
+            # Start indexing in slices while the query is typed
+            self._index_scrollback_slice()
+
+    def _end_scrollback_search(self, restore: bool) -> None:
+        self._modal_key_handlers.remove(self.handle_scrollback_search_keydown)
+        if restore:
+            self.scroll_anchor = self.scrollback_search.original_anchor
+        self.scrollback_search = None
+        self.mark_lines_dirty()
+
+    def _compile_scrollback_search(self) -> None:
+        search = self.scrollback_search
+        search.spans.clear()
+        search.pattern, search.error = None, None
+        if search.regex and search.query:
+            try:
+                search.pattern = re.compile(search.query, re.IGNORECASE | re.MULTILINE)
+            except re.error as e:
+                search.error = str(e)
+        elif search.query:
+            search.pattern = search.query
+
+    def _update_scrollback_search(self, start: int | None = None, backward: bool = True) -> None:
+        search = self.scrollback_search
+        match = self.find_in_scrollback(search.pattern, start, backward) if search.pattern is not None else None
+        search.failed = match is None and bool(search.query)
+        if match is not None:
+            search.match_index = match
+            self.scroll_to_line(match)
+        self.mark_lines_dirty()
+
+    def handle_scrollback_search_keydown(self, event) -> bool:
+        """
+        Handle key presses in find mode.
+
+        Return, Up and Ctrl+F move to the previous (older) match, Shift+Return and Down to the next one.
+        Tab toggles regular expressions, Escape leaves find mode at the match and Ctrl+G goes back to
+        where the search started.
+        """
+        search = self.scrollback_search
+        ctrl = event.mod & pygame.KMOD_CTRL
+        enter = event.key in (pygame.K_RETURN, pygame.K_KP_ENTER)
+        if event.key == pygame.K_ESCAPE:
+            self._end_scrollback_search(restore=False)
+        elif event.key == pygame.K_g and ctrl:
+            self._end_scrollback_search(restore=True)
+        elif ((enter and not event.mod & pygame.KMOD_SHIFT) or event.key == pygame.K_UP
+              or (event.key == pygame.K_f and ctrl)):
+            self._update_scrollback_search(search.match_index)
+        elif enter or event.key == pygame.K_DOWN:
+            if search.match_index is not None:
+                self._update_scrollback_search(search.match_index, backward=False)
+        elif event.key == pygame.K_TAB:
+            search.regex = not search.regex
+            self._compile_scrollback_search()
+            self._update_scrollback_search()
+        elif self.handle_scroll_keydown(event):
+            pass
+        elif event.key == pygame.K_BACKSPACE:
+            search.query = search.query[:-1]
+            self._compile_scrollback_search()
+            self._update_scrollback_search()
+        elif event.unicode and event.unicode.isprintable():
+            search.query += event.unicode
+            self._compile_scrollback_search()
+            # Extending the query can only match the current line or older ones
+            self._update_scrollback_search(search.match_index + 1 if search.match_index is not None else None)
+        return True
 
     def handle_input_keydown(self, event):
         """Handle key presses during input mode."""
+        if self.handle_scroll_keydown(event) or self.handle_editing_keydown(event):
+            return
         if event.key == pygame.K_RETURN or event.key == pygame.K_KP_ENTER:
             self.input_mode = False
-        elif event.key == pygame.K_BACKSPACE or event.key == pygame.K_DELETE:
-            self.handle_backspace()
-        elif event.key == pygame.K_LEFT:
-            self.handle_left_arrow()
-        elif event.key == pygame.K_RIGHT:
-            self.handle_right_arrow()
+            self._resolve_input_waiters()
         elif event.unicode.isprintable():
             self.handle_printable(event.unicode)
 
@@ -296,14 +3508,14 @@ class PygameTerminal:
 
     def handle_keydown(self, event_param):
         """Handle key presses."""
+        if self.handle_scroll_keydown(event_param) or self.handle_editing_keydown(event_param):
+            return
         if event_param.key == pygame.K_RETURN or event_param.key == pygame.K_KP_ENTER:
             self.handle_return()
-        elif event_param.key == pygame.K_BACKSPACE or event_param.key == pygame.K_DELETE:
-            self.handle_backspace()
-        elif event_param.key == pygame.K_LEFT:
-            self.handle_left_arrow()
-        elif event_param.key == pygame.K_RIGHT:
-            self.handle_right_arrow()
+        elif event_param.key == pygame.K_r and event_param.mod & pygame.KMOD_CTRL:
+            self.start_history_search()
+        elif event_param.key == pygame.K_f and event_param.mod & pygame.KMOD_CTRL:
+            self.start_scrollback_search()
         elif event_param.key == pygame.K_UP:
             self.handle_up_arrow()
         elif event_param.key == pygame.K_DOWN:
@@ -325,12 +3537,17 @@ class PygameTerminal:
         Write text to the terminal in-place (overwrite the last rendered line).
         Useful for dynamic updates like progress bars.
         """
+        if not self.in_main_thread():
+            self.call_in_main_thread(self.write_in_place, text)
+            return
+        text, _ = style_line(text, DEFAULT_STYLE, self.markup)
         if self.terminal_lines:
             self.terminal_lines[-1] = text  # Replace the last line
         else:
             self.terminal_lines.append(text)  # In case it's the first line
 
-        self.draw_terminal()
+        self.mark_lines_dirty()
+        self.refresh()
 
     def wait(self, duration_ms: int):
         """
@@ -338,19 +3555,14 @@ class PygameTerminal:
 
         :param duration_ms: Duration to wait in milliseconds
         """
-        start_time = pygame.time.get_ticks()
-        while pygame.time.get_ticks() - start_time < duration_ms:
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    pygame.quit()
-                    return
-
-            # Update and draw the terminal
-            self.draw_terminal()
-            pygame.display.flip()
+        job = getattr(self._job_local, "job", None)
+        if job is not None:
+            # Background jobs just sleep, waking early if they get cancelled
+            job.cancel_event.wait(duration_ms / 1000)
+            return
 
-            # Control the frame rate
-            pygame.time.Clock().tick(self.clock_tick_rate)
+        # Key presses are swallowed while waiting
+        self._run_modal(duration_ms, lambda event: True)
 
     def countdown_with_message(self,
                                start_value: float,
@@ -371,60 +3583,395 @@ class PygameTerminal:
         :param on_complete: Optional callback function to execute when countdown completes
         :param can_interrupt: Whether the countdown can be interrupted by the user
         """
+        interrupted = []
+
+        def handle_key(event):
+            if event.key == pygame.K_ESCAPE:
+                if can_interrupt:
+                    self.write("Operation interrupted by user.")
+                    interrupted.append(True)
+                else:
+                    self.write("Cannot interrupt.")
+            return True
+
         current_value = start_value
         while current_value >= end_value:
             message = message_template.format(current_value)
             self.write(message)
-            self.draw_terminal()
-            pygame.display.flip()
 
-            wait_start = pygame.time.get_ticks()
-            while pygame.time.get_ticks() - wait_start < int(wait_time * 1000):
-                for event in pygame.event.get():
-                    if event.type == pygame.QUIT:
-                        pygame.quit()
-                        return
-                    # Handle other events if needed
-                    if event.type == pygame.KEYDOWN:
-                        if event.key == pygame.K_ESCAPE:
-                            if can_interrupt:
-                                self.write("Operation interrupted by user.")
-                                return
-                            else:
-                                self.write("Cannot interrupt.")
-
-                # Control the frame rate
-                pygame.time.Clock().tick(self.clock_tick_rate)
+            if not self._run_modal(int(wait_time * 1000), handle_key, lambda: bool(interrupted)):
+                return
 
             current_value = round(current_value - step, 1)  # Round to avoid floating point errors
         on_complete()
 
-    def draw_terminal(self):
-        """Renders the terminal interface on the screen."""
-        self.screen.fill(self.bg_color)
+    def render_text(self, text: str, color, antialias: bool = True) -> pygame.Surface:
+        """Render text with the current font through the shared surface cache."""
+        return self.surface_cache.render(self.font, text, antialias, color)
+
+    def refresh(self) -> bool:
+        """
+        Draw the pending changes now if a frame is due.
+
+        Meant for code that blocks the main loop, redraws are coalesced to at most clock_tick_rate
+        frames per second no matter how often this is called.
+
+        :return: Whether a frame was drawn
+        """
+        now = now_ms()
+        if now - self._last_frame_ms >= 1000 // self.clock_tick_rate:
+            if self.draw_terminal():
+                self._last_frame_ms = now
+                return True
+        return False
+
+    def draw_text(self, text: str, color, position: tuple[int, int]) -> int:
+        """
+        Draw a single line of text onto the screen, through the glyph atlas when enabled.
+
+        :return: The x coordinate right after the text
+        """
+        if self.glyph_atlas is not None:
+            # Lines composed from the atlas are cached like rendered ones, keyed on the atlas
+            surface = self.surface_cache.render(self.glyph_atlas, text, True, color)
+        else:
+            surface = self.render_text(text, color)
+        self.screen.blit(surface, position)
+        if self._char_advance is not None:
+            return position[0] + len(text) * self._char_advance
+        return position[0] + surface.get_width()
+
+    def draw_styled_text(self, line: StyledLine, default_color, position: tuple[int, int]) -> int:
+        """
+        Draw a line run by run, every run surface comes from the cache or the glyph atlas.
+
+        :return: The x coordinate right after the text
+        """
+        x, y = position
+        for text, foreground, background in line.spans():
+            if background is not None:
+                width = len(text) * self._char_advance if self._char_advance is not None else self.font.size(text)[0]
+                self.screen.fill(background, (x, y, width, self.font.get_height()))
+            x = self.draw_text(text, foreground or default_color, (x, y))
+        return x
+
+    def draw_terminal(self, force: bool = False) -> bool:
+        """
+        Renders the terminal interface on the screen.
+
+        Only the regions marked dirty since the last frame are redrawn, and idle frames return
+        without touching the display at all.
+
+        :param force: Redraw and flip the whole screen even if nothing changed
+        :return: Whether anything was drawn
+        """
+        if self.headless:
+            # Nothing to draw, but pending redraws must not keep the main loop from blocking
+            self.full_redraw = False
+            self.dirty_rects = []
+            return False
+
+        # Input edits, cursor moves and color changes are detected by comparing against the last frame
+        input_state = (self.input_mode, self.active_prompt(), self._input_generation, self.input_buffer.version,
+                       self.cursor_pos, len(self.background_jobs))
+        if input_state != self._drawn_input_state:
+            self._drawn_input_state = input_state
+            self.mark_input_dirty()
+        color_state = (tuple(self.bg_color), tuple(self.fg_color), self.custom_line_color)
+        if color_state != self._drawn_color_state:
+            self._drawn_color_state = color_state
+            self.mark_dirty()
+
+        if force:
+            self.full_redraw = True
+        if not self.full_redraw and not self.dirty_rects:
+            return False
+
+        if self.full_redraw:
+            regions = [self.screen.get_rect()]
+        else:
+            regions = self.dirty_rects
+
+        draw_start = time.perf_counter()
+        lines_rect = self.lines_rect()
+        input_rect = self.input_rect()
+        overlay_rect = self._profiler_overlay_rect if self.show_profiler_overlay else None
+        for region in regions:
+            self.screen.set_clip(region)
+            self.screen.fill(self.bg_color, region)
+            if region.colliderect(lines_rect):
+                self._draw_lines()
+            if region.colliderect(input_rect):
+                self._draw_input_line()
+            for widget in self.widgets:
+                if region.colliderect(widget.area(self)):
+                    widget.draw(self)
+            if overlay_rect is not None and region.colliderect(overlay_rect):
+                self._draw_profiler_overlay()
+        self.screen.set_clip(None)
+
+        flip_start = time.perf_counter()
+        if self.full_redraw:
+            pygame.display.flip()
+        else:
+            pygame.display.update(regions)
+        flip_end = time.perf_counter()
+        self.profiler.record("flip", flip_end - flip_start)
+        self.profiler.record("draw_terminal", flip_end - draw_start)
+        self.full_redraw = False
+        self.dirty_rects = []
+        return True
 
-        # Draw previous terminal lines
+    def _draw_lines(self):
+        """Draw the previous terminal lines."""
         line_y = self.terminal_margin_top
-        for line in self.terminal_lines[-self.lines_on_screen:]:
-            line_color = self.custom_line_color or self.fg_color
-            line_surface = self.font.render(line, True, line_color)
-            self.screen.blit(line_surface, (self.terminal_margin_left, line_y))
-            line_y += self.font.get_height() + self.line_margin_height
-
-        # Draw current input line
-        input_prompt = self.input_prompt if self.input_mode else "> "
-        input_line = input_prompt + self.current_line
-        input_surface = self.font.render(input_line, True, self.fg_color)
+        line_color = self.custom_line_color or self.fg_color
+        row_height = self.font.get_height() + self.line_margin_height
+        start, stop = self.visible_line_range()
+        # The first line may only partly fit, its leading rows are scrolled off the top
+        skipped = max(self._rows_back(stop, self.lines_on_screen)[1] - self.lines_on_screen, 0)
+        highlight = self.scrollback_search is not None and self.scrollback_search.pattern is not None
+        for index in range(start, stop):
+            line = self.terminal_lines[index]
+            breaks = self.line_breaks(index) if self.soft_wrap else (0,)
+            styled = type(line) is StyledLine
+            for row in range(skipped, len(breaks)):
+                row_start = breaks[row]
+                row_stop = breaks[row + 1] if row + 1 < len(breaks) else len(line)
+                if len(breaks) == 1:
+                    text = line
+                else:
+                    text = line.slice(row_start, row_stop) if styled else line[row_start:row_stop]
+                if highlight:
+                    self._draw_search_highlights(self.terminal_lines.first_index + index, line, row_start, row_stop,
+                                                 line_y)
+                if styled:
+                    self.draw_styled_text(text, line_color, (self.terminal_margin_left, line_y))
+                else:
+                    self.draw_text(text, line_color, (self.terminal_margin_left, line_y))
+                line_y += row_height
+            skipped = 0
+
+    def _search_spans(self, index: int, line: str) -> list[tuple[int, int]]:
+        """The [start, stop) spans of a line matching the find mode query, computed once per line."""
+        search = self.scrollback_search
+        cached = search.spans.get(index)
+        if cached is not None and cached[0] is line:
+            return cached[1]
+        if isinstance(search.pattern, str):
+            needle, text = search.pattern.lower(), line.lower()
+            spans = []
+            found = text.find(needle)
+            while found >= 0:
+                spans.append((found, found + len(needle)))
+                found = text.find(needle, found + len(needle))
+        else:
+            spans = [match.span() for match in search.pattern.finditer(line) if match.end() > match.start()]
+        if len(search.spans) >= 4096:
+            search.spans.clear()
+        search.spans[index] = (line, spans)
+        return spans
+
+    def _text_width(self, text: str, start: int, stop: int) -> int:
+        if self._char_advance is not None:
+            return (stop - start) * self._char_advance
+        return self.font.size(text[start:stop])[0]
+
+    def _draw_search_highlights(self, index: int, line: str, row_start: int, row_stop: int, y: int) -> None:
+        """Fill the background of the find mode matches within one display row of a line."""
+        current = index == self.scrollback_search.match_index
+        color = self.search_current_color if current else self.search_highlight_color
+        for start, stop in self._search_spans(index, line):
+            start, stop = max(start, row_start), min(stop, row_stop)
+            if start < stop:
+                x = self.terminal_margin_left + self._text_width(line, row_start, start)
+                self.screen.fill(color, (x, y, self._text_width(line, start, stop), self.font.get_height()))
+
+    def _draw_input_line(self):
+        """Draw the current input line and the cursor."""
+        input_prompt = self.active_prompt()
         input_y = self.height - self.terminal_margin_bottom
-        self.screen.blit(input_surface, (self.terminal_margin_left, input_y))
+        self.draw_text(input_prompt, self.fg_color, (self.terminal_margin_left, input_y))
+        if self.scrollback_search is not None:
+            return  # The find mode prompt replaces the input line
 
-        # Draw cursor
-        cursor_x = self.terminal_margin_left + self.font.size(input_prompt + self.current_line[:self.cursor_pos])[0]
+        # Scroll the input line horizontally so the cursor stays visible, and only draw what fits
+        line_x = self.terminal_margin_left + self.font.size(input_prompt)[0]
+        available_width = max(self.width - self.terminal_margin_left - line_x, 1)
+        self._scroll_input_to_cursor(available_width - self.line_width)
+        if self._char_advance is not None:
+            last_column = self.input_scroll + available_width // self._char_advance
+        else:
+            last_column = self._last_fitting_column(self.input_scroll, available_width)
+        visible_text = self.input_buffer.slice(self.input_scroll, last_column)
+        self.draw_text(visible_text, self.fg_color, (line_x, input_y))
+
+        cursor_x = line_x + self.input_text_width(self.input_scroll, self.cursor_pos)
         cursor_top = input_y
         cursor_bottom = self.height - self.terminal_margin_top
         pygame.draw.line(self.screen, self.fg_color, (cursor_x, cursor_top), (cursor_x, cursor_bottom), self.line_width)
 
-        pygame.display.flip()
+        if self.background_jobs:
+            names = ", ".join(job.name for job in self.background_jobs)
+            indicator = self.render_text(f"[running: {names}] Ctrl+C to cancel", self.fg_color)
+            self.screen.blit(indicator, (self.width - self.terminal_margin_left - indicator.get_width(), input_y))
+
+    @property
+    def font_render_calls(self) -> int:
+        """The number of font.render calls made so far by the surface cache and glyph atlases."""
+        # Lines composed from the atlas are surface cache misses that made no font.render call
+        atlas = self.glyph_atlas
+        atlas_renders = atlas.renders - atlas.compositions if atlas is not None else 0
+        return self.surface_cache.misses + self._retired_atlas_renders + atlas_renders
+
+    def frame_stats(self) -> dict[str, Any]:
+        """
+        Timings of the recent frames, see FrameProfiler.stats, along with the surface cache counters.
+        """
+        stats = self.profiler.stats()
+        stats["surface_cache"] = self.surface_cache.stats()
+        return stats
+
+    def format_frame_stats(self) -> list[str]:
+        """The main figures of frame_stats as short lines of text."""
+        stats = self.profiler.stats()
+        frame = stats["frame_ms"]
+        lines = [f"frame ms p50 {frame['p50']:.2f} p95 {frame['p95']:.2f} p99 {frame['p99']:.2f} "
+                 f"max {frame['max']:.2f}"]
+        for name, times in stats["sections_ms"].items():
+            lines.append(f"{name} ms p50 {times['p50']:.2f} p99 {times['p99']:.2f}")
+        renders = stats["render_calls_per_frame"]
+        lines.append(f"font.render/frame p50 {renders['p50']} max {renders['max']}")
+        return lines
+
+    def toggle_profiler_overlay(self) -> None:
+        """Show or hide the frame profiler overlay in the top-right corner of the screen."""
+        self.show_profiler_overlay = not self.show_profiler_overlay
+        self._update_profiler_overlay()
+
+    def _update_profiler_overlay(self) -> None:
+        # Refreshed on a timer rather than every frame, redrawing it would otherwise never let the loop idle
+        if self._profiler_overlay_timer is not None:
+            self.cancel_timer(self._profiler_overlay_timer)
+            self._profiler_overlay_timer = None
+        if self._profiler_overlay_rect is not None:
+            self.mark_dirty(self._profiler_overlay_rect)
+            self._profiler_overlay_rect = None
+        if not self.show_profiler_overlay or self.headless:
+            return
+
+        self._profiler_overlay_lines = self.format_frame_stats()
+        line_height = self.font.get_height()
+        width = max(self.font.size(line)[0] for line in self._profiler_overlay_lines) + 2 * self.line_margin_height
+        height = len(self._profiler_overlay_lines) * line_height + 2 * self.line_margin_height
+        self._profiler_overlay_rect = pygame.Rect(self.width - width, 0, width, height)
+        self.mark_dirty(self._profiler_overlay_rect)
+        self._profiler_overlay_timer = self.schedule(self.profiler_overlay_interval_ms,
+                                                     self._update_profiler_overlay)
+
+    def _draw_profiler_overlay(self) -> None:
+        rect = self._profiler_overlay_rect
+        self.screen.fill(self.fg_color, rect)
+        y = rect.y + self.line_margin_height
+        for line in self._profiler_overlay_lines:
+            # Rendered directly, the overlay shouldn't churn the cache or show up in its own render count
+            self.screen.blit(self.font.render(line, True, self.bg_color), (rect.x + self.line_margin_height, y))
+            y += self.font.get_height()
+
+    def start_profile_capture(self, duration_ms: int = 5000, path: str | None = None) -> None:
+        """
+        Profile the main thread with cProfile for a while, then write the slowest functions.
+
+        :param duration_ms: How long to profile for
+        :param path: File the raw profile is dumped to for pstats or snakeviz, None skips it
+        """
+        if self._profile is not None:
+            self.write("A profile capture is already running.")
+            return
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        self.schedule(duration_ms, lambda: self.stop_profile_capture(path))
+        self.write(f"Profiling for {duration_ms / 1000:g}s...")
+
+    def stop_profile_capture(self, path: str | None = None, limit: int = 15) -> pstats.Stats | None:
+        """
+        Stop the running cProfile capture and write its top functions by cumulative time.
+
+        :param path: File the raw profile is dumped to, None skips it
+        :param limit: The number of functions written to the terminal
+        :return: The profile statistics, or None if no capture was running
+        """
+        profile, self._profile = self._profile, None
+        if profile is None:
+            return None
+        profile.disable()
+        if path:
+            profile.dump_stats(path)
+        stream = io.StringIO()
+        stats = pstats.Stats(profile, stream=stream)
+        stats.sort_stats("cumulative").print_stats(limit)
+        self.write_many(line for line in stream.getvalue().splitlines() if line.strip())
+        return stats
+
+    def register_profiler_commands(self, profile_names: list[str] | None = None,
+                                   stats_names: list[str] | None = None) -> None:
+        """
+        Register the commands starting a cProfile capture and writing the frame statistics.
+
+        :param profile_names: Names of the capture command, ``profile [seconds] [path]`` by default
+        :param stats_names: Names of the statistics command, ``stats`` by default
+        """
+        def profile(seconds: float = 5.0, path: str = "", term: PygameTerminal = None):
+            term.start_profile_capture(int(seconds * 1000), path or None)
+
+        def stats(term: PygameTerminal = None):
+            term.write_many(term.format_frame_stats())
+            for name, timing in sorted(term.profiler.command_times.items()):
+                term.write(f"{name}: {timing.count} calls, avg {timing.total_ms / timing.count:.2f} ms, "
+                           f"max {timing.max_ms:.2f} ms")
+
+        self.register_command(profile_names or ["profile"], profile,
+                              [Argument("seconds", float, True), Argument("path", str, True)])
+        self.register_command(stats_names or ["stats"], stats)
+
+    def input_text_width(self, start: int, stop: int) -> int:
+        """
+        The width of the input line columns in [start, stop).
+
+        Monospace fonts need a single multiplication by the column width, other fonts measure the
+        slice, which is never wider than the visible part of the line.
+        """
+        if self._char_advance is not None:
+            return (stop - start) * self._char_advance
+        return self.font.size(self.input_buffer.slice(start, stop))[0]
+
+    def _last_fitting_column(self, start: int, width: int) -> int:
+        """Binary search the furthest column whose text from start still fits within width."""
+        low, high = start, min(len(self.input_buffer), start + width)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.input_text_width(start, middle) <= width:
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+    def _scroll_input_to_cursor(self, available_width: int) -> None:
+        self.input_scroll = min(self.input_scroll, self.cursor_pos, len(self.input_buffer))
+        if self.input_text_width(self.input_scroll, self.cursor_pos) <= available_width:
+            return
+        if self._char_advance is not None:
+            self.input_scroll = self.cursor_pos - available_width // self._char_advance
+            return
+        # Smallest scroll that brings the cursor back into view
+        low, high = max(self.input_scroll, self.cursor_pos - available_width), self.cursor_pos
+        while low < high:
+            middle = (low + high) // 2
+            if self.input_text_width(middle, self.cursor_pos) <= available_width:
+                high = middle
+            else:
+                low = middle + 1
+        self.input_scroll = low
 
     def process_command(self, command: str):
         parts = command.strip().split()
@@ -438,14 +3985,19 @@ class PygameTerminal:
             command_struct: Command = self.commands[command_name]
 
             try:
-                for i, arg in enumerate(command_struct.arguments):
-                    if i < len(input_args):
-                        pass
-                    elif not arg.is_optional:
-                        raise ValueError(f"Missing required argument: {arg.name}")
-
-                # Execute the command with the original string arguments and pass the terminal
-                result = command_struct(*input_args, terminal=self)
+                if command_struct.is_async:
+                    self.start_async_job(command_name, command_struct(*input_args, terminal=self))
+                    return
+                if command_struct.background:
+                    self.start_background_job(command_name, command_struct, *input_args, terminal=self)
+                    return
+
+                # Execute the command with the converted arguments and pass the terminal
+                start = time.perf_counter()
+                try:
+                    result = command_struct(*input_args, terminal=self)
+                finally:
+                    self.profiler.record_command(command_name, (time.perf_counter() - start) * 1000)
                 if result is not None:
                     self.write(str(result))
             except ValueError as e:
@@ -472,39 +4024,217 @@ class PygameTerminal:
             return False  # Unsupported type
 
     def register_command(self, command_names: list[str], command_function: Callable,
-                         argument_list: list[Argument] | None = None):
+                         argument_list: list[Argument] | None = None, background: bool = False):
         """
         Register a command that maps a command name to a function.
 
         :param command_names: The list of names of the command (e.g., ['help', 'h'], ['exit', 'h'])
         :param command_function: A callable function that will be executed when the command is entered
         :param argument_list: A list of Argument objects that describe the arguments of the command
+        :param background: Run the command in the worker pool so it doesn't freeze the terminal
         """
+        # A single Command, with its compiled argument pipeline, is shared by every alias
+        arguments = [
+            replace(arg, positional_index=i) if arg.positional_index is None else arg
+            for i, arg in enumerate(argument_list or [])
+        ]
+        command = Command(function=command_function, arguments=arguments, background=background)
         for name in command_names:
-            argument_struct_list_with_index = []
-            for i, arg in enumerate(argument_list or []):
-                if arg.positional_index is None:
-                    # If positional_index is not set, create a new Argument with the index
-                    new_arg = Argument(
-                        name=arg.name,
-                        type=arg.type,
-                        is_optional=arg.is_optional,
-                        positional_index=i,
-                        custom_validator=arg.custom_validator if hasattr(arg, 'custom_validator') else None
-                    )
-                    argument_struct_list_with_index.append(new_arg)
-                else:
-                    # If positional_index is already set, use the original Argument
-                    argument_struct_list_with_index.append(arg)
+            self.commands[name] = command
+            self.command_trie.insert(name)
+
+    def write(self, text: str, debug_flag: bool = False, markup: bool | None = None):
+        """
+        Write text to the terminal.
 
-            self.commands[name] = Command(function=command_function, arguments=argument_struct_list_with_index)
+        ANSI color escapes are turned into colored runs, see style_line.
 
-    def write(self, text: str, debug_flag: bool = False):
-        """Write text to the terminal."""
-        self.terminal_lines.append(text)
+        :param markup: Parse inline color markup such as ``[red]error[/]``, defaults to self.markup
+        """
+        if not self.in_main_thread():
+            self.call_in_main_thread(self.write, text, debug_flag, markup)
+            return
+        line, _ = style_line(text, DEFAULT_STYLE, self.markup if markup is None else markup)
+        self.terminal_lines.append(line)
+        self.mark_lines_dirty()
         if debug_flag:
             print(f"Debug: {text}")
 
+    def write_many(self, texts: Iterable[str], markup: bool | None = None, style_state: list | None = None) -> int:
+        """
+        Write many lines to the terminal in bulk.
+
+        Accepts any iterable, including generators, and splits multi-line strings. The lines are
+        appended in chunks and the screen is redrawn once on the next frame. ANSI colors carry over
+        from one line to the next, as in a real terminal.
+
+        :param texts: The lines to write
+        :param markup: Parse inline color markup, defaults to self.markup
+        :param style_state: A one-item list holding the style to start with, updated with the style in
+            effect after the last line, to carry colors across calls
+        :return: The number of lines written
+        """
+        if not self.in_main_thread():
+            lines = list(self._split_lines(texts))
+            self.call_in_main_thread(self.write_many, lines, markup, style_state)
+            return len(lines)
+        appended_before = self.terminal_lines.total_appended
+        if style_state is None:
+            style_state = [DEFAULT_STYLE]
+        self.terminal_lines.extend(
+            self._style_lines(self._split_lines(texts), self.markup if markup is None else markup, style_state))
+        self.mark_lines_dirty()
+        return self.terminal_lines.total_appended - appended_before
+
+    @staticmethod
+    def _style_lines(lines: Iterable[str], markup: bool, style_state: list) -> Iterator[str]:
+        style = style_state[0]
+        for line in lines:
+            line, style = style_line(line, style, markup)
+            yield line
+        style_state[0] = style
+
+    @staticmethod
+    def _split_lines(texts: Iterable[str]) -> Iterator[str]:
+        for text in texts:
+            if "\n" in text:
+                yield from text.split("\n")
+            else:
+                yield text
+
+    def writer(self) -> TerminalWriter:
+        """Return a file-like object that streams text into the terminal."""
+        return TerminalWriter(self)
+
+    def attach_stream(self, file, name: str = "stream", **options) -> OutputStream:
+        """
+        Stream the lines of a pipe or file object into the terminal as they arrive.
+
+        :param file: A binary or text file object, read until end of file
+        :param name: The name used in messages about the stream
+        :param options: Passed on to OutputStream.start_reader
+        :return: The stream, close it to stop reading
+        """
+        stream = OutputStream(self, name)
+        stream.start_reader(file, **options)
+        self.streams.append(stream)
+        return stream
+
+    def run_process(self, args, name: str | None = None, merge_stderr: bool = True, stderr_prefix: str = "",
+                    **popen_options) -> OutputStream:
+        """
+        Start a subprocess and stream its output into the terminal without blocking the main loop.
+
+        Its exit code is written once both pipes are closed, Ctrl+C terminates it.
+
+        :param args: The program and its arguments, as for subprocess.Popen
+        :param merge_stderr: Interleave stderr with stdout, otherwise stderr is read separately
+        :param stderr_prefix: Prepended to stderr lines when they are read separately
+        :param popen_options: Passed on to subprocess.Popen
+        :return: The stream, its process attribute is the Popen object
+        """
+        if name is None:
+            name = args if isinstance(args, str) else os.path.basename(str(args[0]))
+        process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT if merge_stderr else subprocess.PIPE, **popen_options)
+        stream = OutputStream(self, name)
+        stream.process = process
+        stream.start_reader(process.stdout)
+        if not merge_stderr:
+            stream.start_reader(process.stderr, prefix=stderr_prefix)
+        self.streams.append(stream)
+        return stream
+
+    def tail_file(self, path: str, name: str | None = None, from_start: bool = False,
+                  poll_interval_ms: int = 250) -> OutputStream:
+        """
+        Follow a growing file like tail -f, until the stream is closed.
+
+        :param from_start: Stream the existing content too, not only the lines appended from now on
+        :param poll_interval_ms: How often the end of the file is checked for new lines
+        """
+        file = open(path, "rb")
+        if not from_start:
+            file.seek(0, os.SEEK_END)
+        return self.attach_stream(file, name or os.path.basename(path), follow=True,
+                                  poll_interval_ms=poll_interval_ms)
+
+    def state_store(self, path: str, schema: StateSchema) -> StateStore:
+        """The store of a snapshot file, it remembers what was saved so later saves can be incremental."""
+        store = self._state_stores.get(path)
+        if store is None or store.schema is not schema:
+            if store is not None:
+                store.close()
+            store = self._state_stores[path] = StateStore(path, schema)
+        return store
+
+    def save_state(self, path: str, schema: StateSchema, full: bool = False) -> Future:
+        """
+        Save app_state to a snapshot file, the file is written in the background.
+
+        After the first save, or a load, only the parts of the state that changed are appended.
+
+        :param path: The snapshot file
+        :param schema: The layout of app_state
+        :param full: Rewrite the whole snapshot
+        :raise ValueError: If a field of app_state can't be encoded, nothing is written
+        :return: A future resolving to the number of bytes written
+        """
+        return self.state_store(path, schema).save(self.app_state, full)
+
+    def load_state(self, path: str, schema: StateSchema) -> Any:
+        """
+        Replace app_state with the one saved in a snapshot file.
+
+        :raise ValueError: If the file isn't a snapshot of this schema version
+        :return: The loaded state
+        """
+        self.app_state = self.state_store(path, schema).load()
+        return self.app_state
+
+    def autosave_state(self, path: str, schema: StateSchema, interval_ms: int = 60_000) -> None:
+        """Save app_state incrementally at a regular interval until stop_autosave is called."""
+        self.stop_autosave(path)
+
+        def report(future: Future) -> None:
+            if future.exception() is not None:
+                self.write(f"Autosave to {path} failed: {future.exception()}")
+
+        def autosave():
+            self._autosave_timers[path] = self.schedule(interval_ms, autosave)
+            try:
+                self.save_state(path, schema).add_done_callback(report)
+            except ValueError as e:
+                self.write(f"Autosave to {path} failed: {e}")
+
+        self._autosave_timers[path] = self.schedule(interval_ms, autosave)
+
+    def stop_autosave(self, path: str) -> None:
+        timer = self._autosave_timers.pop(path, None)
+        if timer is not None:
+            self.cancel_timer(timer)
+
+    def drain_streams(self) -> None:
+        """Move queued stream lines into the scrollback, at most stream_lines_per_frame per call."""
+        budget = self.stream_lines_per_frame
+        for stream in list(self.streams):
+            if budget > 0:
+                lines = stream.take_lines(budget)
+                budget -= len(lines)
+                if lines:
+                    # Already styled by the reader threads
+                    self.terminal_lines.extend(lines)
+                    self.mark_lines_dirty()
+            if stream.finished:
+                self.streams.remove(stream)
+                if stream.process is not None:
+                    self.write(f"[{stream.name} exited with code {stream.returncode}]")
+
+    def close_streams(self) -> None:
+        """Stop every stream, terminating their processes."""
+        for stream in self.streams:
+            stream.close()
+
     @staticmethod
     def args_length(args):
         if args:
@@ -514,120 +4244,194 @@ class PygameTerminal:
 
     # --- Extensions ---
 
-    def create_illustration_window(self, width, height):
-        self.illustration_window = pygame.display.set_mode((width, height))
+    def create_illustration_window(self, width, height) -> ImageWidget | None:
+        """
+        Open an illustration panel centered over the terminal lines.
+
+        The panel is a widget drawn over the terminal, so the display mode and the text behind it
+        are left alone.
+        """
+        if self.headless:
+            return None
+        self.close_illustration_window()
+        rect = pygame.Rect(0, 0, min(width, self.width), min(height, self.height))
+        rect.center = self.lines_rect().center
+        self.illustration_window = self.add_widget(ImageWidget(rect, bg_color=self.bg_color))
+        return self.illustration_window
 
     def close_illustration_window(self):
         if self.illustration_window:
-            pygame.display.set_mode((self.width, self.height))  # Restore original window
+            self.remove_widget(self.illustration_window)
             self.illustration_window = None
 
     def show_illustration(self, image_path):
+        if self.headless:
+            return
         if self.illustration_window:
             try:
-                image = pygame.image.load(image_path)
-                self.illustration_window.blit(image, (0, 0))
-                pygame.display.flip()  # Update illustration window
+                self.illustration_window.set_image(pygame.image.load(image_path))
             except Exception as e:
                 self.write(f"Error loading illustration: {e}")
 
-    def register_event_handler(self, event_name, handler):
-        # Generate a unique event type id
-        event_type = pygame.USEREVENT + len(self.custom_event_handlers)
-        pygame.event.EventType(event_type, {'event_name': event_name})  # Register the event type
-        self.custom_event_handlers[event_name] = handler
+    def register_event_handler(self, event_name, handler) -> int:
+        """
+        Call a handler with the events triggered under a name, a name can have several handlers.
+
+        :return: The pygame event type allocated for the name
+        """
+        return self.event_bus.subscribe(event_name, handler)
 
     def trigger_event(self, event_name, *args, **kwargs):
-        # Find the event type id associated with the event name
-        for event_type in range(pygame.USEREVENT, pygame.NUMEVENTS):
-            if pygame.event.event_name(event_type) == event_name:
-                event = pygame.event.Event(event_type, *args, **kwargs)
-                pygame.event.post(event)
-                return
+        """Post an event to the handlers registered for a name, safe to call from background jobs."""
+        if event_name not in self.event_bus.types:
+            self.write(f"Error: Event '{event_name}' not registered.")
+            return
+        self.event_bus.post(event_name, **dict(*args, **kwargs))
+
+    def trigger_events(self, event_name, payloads: Iterable[dict]) -> None:
+        """Post one event per payload dict, the handlers run together on the next loop iteration."""
+        if event_name not in self.event_bus.types:
+            self.write(f"Error: Event '{event_name}' not registered.")
+            return
+        self.event_bus.post_many(event_name, payloads)
+
+    def add_widget(self, widget: Widget, focus: bool = False) -> Widget:
+        """
+        Show a widget over the terminal lines, it is drawn as part of every frame until removed.
+
+        :param focus: Send every key press to the widget until it is removed
+        :return: The widget
+        """
+        widget.terminal = self
+        self.widgets.append(widget)
+        if focus:
+            if not self.focused_widgets:
+                self._modal_key_handlers.append(self._handle_focused_keydown)
+            self.focused_widgets.append(widget)
+        widget.invalidate()
+        return widget
+
+    def remove_widget(self, widget: Widget) -> None:
+        """Take a widget added with add_widget off the screen."""
+        if widget not in self.widgets:
+            return
+        widget.invalidate()
+        self.widgets.remove(widget)
+        if widget in self.focused_widgets:
+            self.focused_widgets.remove(widget)
+            if not self.focused_widgets:
+                self._modal_key_handlers.remove(self._handle_focused_keydown)
+        widget.terminal = None
+
+    def _handle_focused_keydown(self, event) -> bool:
+        widget = self.focused_widgets[-1]
+        if widget.handle_keydown(event):
+            widget.invalidate()
+        return True
 
-        self.write(f"Error: Event '{event_name}' not registered.")
+    def _replace_legacy_widget(self, key: tuple, widget: Widget) -> Widget:
+        old_widget = self._legacy_widgets.get(key)
+        if old_widget is not None:
+            self.remove_widget(old_widget)
+        self._legacy_widgets[key] = widget
+        return self.add_widget(widget)
 
     def draw_table(self, data, headers, x=None, y=None, column_widths=None, cell_padding=5, border_width=1,
-                   border_color=pygame.Color('white'), header_bg_color=pygame.Color('gray')):
+                   border_color=pygame.Color('white'), header_bg_color=pygame.Color('gray')) -> TableView:
+        """
+        Show a table at a position, replacing the one previously drawn there.
+
+        Only the rows that fit on the screen are rendered. Use show_table for a table that can be
+        scrolled and sorted with the keyboard.
 
+        :return: The table widget, remove it with remove_widget
+        """
         # Calculate positions if not provided
         if x is None:
             x = self.terminal_margin_left
         if y is None:
             y = self.terminal_margin_top
 
-        num_columns = len(headers)
-        num_rows = len(data) + 1  # +1 for header row
-
-        # Calculate column widths automatically if not provided
-        if column_widths is None:
-            column_widths = [
-                self.font.size(str(max([row[i] for row in data + [headers]], key=lambda x: len(str(x)))))[0] +
-                2 * cell_padding for i in range(num_columns)]
+        table = TableView(data, headers, pygame.Rect(x, y, self.width - x, self.height - y),
+                          column_widths=column_widths, cell_padding=cell_padding, border_width=border_width,
+                          border_color=border_color, header_bg_color=header_bg_color)
+        self._replace_legacy_widget(("table", x, y), table)
+        self.refresh()
+        return table
 
-        # Calculate total table width and height
-        table_width = sum(column_widths) + (num_columns + 1) * border_width
-        table_height = num_rows * (self.font.get_height() + 2 * cell_padding) + (num_rows + 1) * border_width
+    def show_table(self, rows: Iterable[Sequence], headers: Sequence, **options) -> TableView:
+        """
+        Show a table over the terminal lines until Escape is pressed.
 
-        # Draw border
-        pygame.draw.rect(self.screen, border_color, (x, y, table_width, table_height), border_width)
+        The table takes the keyboard while it is shown: the arrows, PgUp/PgDn and Home/End scroll it
+        and the digit keys sort it by a column.
 
-        # Draw header row
-        current_x = x + border_width
-        for i, header in enumerate(headers):
-            header_rect = pygame.Rect(current_x, y + border_width, column_widths[i],
-                                      self.font.get_height() + 2 * cell_padding)
-            pygame.draw.rect(self.screen, header_bg_color, header_rect)
-
-            header_surface = self.font.render(str(header), True, self.fg_color)
-            header_rect.x += cell_padding  # Adjust for cell padding
-            header_rect.y += cell_padding
-            self.screen.blit(header_surface, header_rect)
-            current_x += column_widths[i] + border_width
-
-        # Draw data rows
-        current_y = y + self.font.get_height() + 2 * cell_padding + 2 * border_width
-        for row in data:
-            current_x = x + border_width
-            for i, cell in enumerate(row):
-                cell_rect = pygame.Rect(current_x, current_y, column_widths[i],
-                                        self.font.get_height() + 2 * cell_padding)
-                cell_surface = self.font.render(str(cell), True, self.fg_color)
-                cell_rect.x += cell_padding
-                cell_rect.y += cell_padding
-                self.screen.blit(cell_surface, cell_rect)
-                current_x += column_widths[i] + border_width
-            current_y += self.font.get_height() + 2 * cell_padding + border_width
-
-        pygame.display.flip()
+        :param rows: The rows, a sequence or an iterable consumed as the table scrolls
+        :param headers: The column headers
+        :param options: Passed on to TableView
+        :return: The table, which can also be scrolled and sorted from code
+        """
+        return self.add_widget(TableView(rows, headers, **options), focus=True)
 
     def draw_menu(self, menu_options, x=None, y=None, selected_index=0, item_padding=5,
                   border_width=1, border_color=pygame.Color('white'),
-                  selected_bg_color=pygame.Color('gray')):
+                  selected_bg_color=pygame.Color('gray')) -> MenuWidget:
+        """
+        Show a menu at a position, replacing the one previously drawn there.
+
+        The caller handles the input, see handle_menu_input. show_menu and choose_from_menu give a
+        menu driven by the terminal instead.
+
+        :return: The menu widget, remove it with remove_widget
+        """
         if x is None:
             x = self.terminal_margin_left
         if y is None:
             y = self.terminal_margin_top
 
-        menu_width = max(self.font.size(option)[0] for option in menu_options) + 2 * item_padding
-        menu_height = len(menu_options) * (self.font.get_height() + 2 * item_padding) + 2 * border_width
+        menu = self._legacy_widgets.get(("menu", x, y))
+        if not isinstance(menu, MenuWidget) or menu.terminal is not self:
+            menu = MenuWidget(menu_options, x, y, selected_index, item_padding=item_padding,
+                              border_width=border_width, border_color=border_color,
+                              selected_bg_color=selected_bg_color)
+            self._replace_legacy_widget(("menu", x, y), menu)
+        else:
+            menu.invalidate()  # The old area, in case the menu shrinks
+            menu.options = list(menu_options)
+            menu.select(selected_index)
+        self.refresh()
+        return menu
 
-        # Draw border
-        pygame.draw.rect(self.screen, border_color, (x, y, menu_width, menu_height), border_width)
+    def show_menu(self, menu_options: Sequence[str], on_select: Callable[[int, str], Any],
+                  on_cancel: Callable[[], Any] | None = None, x: int | None = None, y: int | None = None,
+                  **options) -> MenuWidget:
+        """
+        Show a menu that takes the keyboard until an option is picked with Return or Escape is pressed.
 
-        current_y = y + border_width + item_padding
-        for i, option in enumerate(menu_options):
-            if i == selected_index:
-                # Draw selected item background
-                pygame.draw.rect(self.screen, selected_bg_color,
-                                 (x + border_width, current_y - item_padding, menu_width - 2 * border_width,
-                                  self.font.get_height() + 2 * item_padding))
+        :param on_select: Called with the index and text of the picked option
+        :param on_cancel: Called when the menu is dismissed with Escape
+        :param options: Passed on to MenuWidget
+        """
+        menu = MenuWidget(menu_options, self.terminal_margin_left if x is None else x,
+                          self.terminal_margin_top if y is None else y, on_select=on_select, on_cancel=on_cancel,
+                          **options)
+        return self.add_widget(menu, focus=True)
 
-            option_surface = self.font.render(option, True, self.fg_color)
-            self.screen.blit(option_surface, (x + border_width + item_padding, current_y))
-            current_y += self.font.get_height() + 2 * item_padding
+    def choose_from_menu(self, menu_options: Sequence[str], **options) -> str | None:
+        """
+        Show a menu and wait for the user to pick an option, the main loop keeps running meanwhile.
 
-        pygame.display.flip()
+        :param options: Passed on to show_menu
+        :return: The picked option, None if the menu was dismissed
+        """
+        choice = []
+        menu = self.show_menu(menu_options, lambda _, option: choice.append(option),
+                              lambda: choice.append(None), **options)
+        try:
+            self.run_until(lambda: choice)
+        finally:
+            menu.close()
+        return choice[0] if choice else None
 
     @staticmethod
     def handle_menu_input(event, menu_options, selected_index):
@@ -642,47 +4446,111 @@ class PygameTerminal:
 
         return selected_index, None
 
+    def show_progress_bar(self, total: float, x: int | None = None, y: int | None = None,
+                          **options) -> ProgressBarWidget:
+        """
+        Show a progress bar, update it with its update method from any thread.
+
+        :param total: The value of a complete progress
+        :param options: Passed on to ProgressBarWidget
+        :return: The progress bar, remove it with remove_widget once done
+        """
+        bar = ProgressBarWidget(total, self.terminal_margin_left if x is None else x,
+                                self.terminal_margin_top if y is None else y, **options)
+        return self.add_widget(bar)
+
     def draw_progress_bar(self, current, total, x=None, y=None, width=200, height=20,
-                          bg_color=pygame.Color('gray'), fg_color=pygame.Color('green')):
+                          bg_color=pygame.Color('gray'), fg_color=pygame.Color('green')) -> ProgressBarWidget:
+        """
+        Show or update the progress bar at a position.
+
+        Calling this in a tight loop is cheap, the bar is redrawn at most once per frame.
+
+        :return: The progress bar widget, remove it with remove_widget once done
+        """
         if x is None:
             x = self.terminal_margin_left
         if y is None:
             y = self.terminal_margin_top
 
-        progress = current / total
-        progress_width = int(width * progress)
+        bar = self._legacy_widgets.get(("progress", x, y))
+        if (not isinstance(bar, ProgressBarWidget) or bar.terminal is not self
+                or bar.rect.size != (width, height) or (bar.bg_color, bar.fg_color) != (bg_color, fg_color)):
+            if not self.in_main_thread():
+                # Creating the widget touches the widget list, leave that to the main loop
+                return self.run_in_main_thread(self.draw_progress_bar, current, total, x, y, width, height,
+                                               bg_color, fg_color)
+            bar = ProgressBarWidget(total, x, y, width, height, bg_color, fg_color)
+            self._replace_legacy_widget(("progress", x, y), bar)
+        bar.update(current, total)
+        if self.in_main_thread():
+            self.refresh()
+        return bar
 
-        # Draw background
-        pygame.draw.rect(self.screen, bg_color, (x, y, width, height))
+    def update_progress_bar(self, current, total, x=None, y=None, width=200, height=20,
+                            bg_color=pygame.Color('gray'), fg_color=pygame.Color('green')) -> ProgressBarWidget:
+        return self.draw_progress_bar(current, total, x, y, width, height, bg_color, fg_color)
 
-        # Draw progress
-        pygame.draw.rect(self.screen, fg_color, (x, y, progress_width, height))
+    def handle_tab(self):
+        """
+        Handle tab key for command and argument completion.
 
-        # Display percentage (optional)
-        percentage_text = self.font.render(f"{int(progress * 100)}%", True, self.fg_color)
-        text_rect = percentage_text.get_rect(center=(x + width // 2, y + height // 2))
-        self.screen.blit(percentage_text, text_rect)
+        The word before the cursor is extended to the longest prefix shared by all candidates. When
+        it can't be extended any further the candidates are listed, and repeated presses cycle
+        through them.
+        """
+        if self._completion_cycle is not None:
+            line, cursor, candidates, index, word_start = self._completion_cycle
+            if line == self.current_line and cursor == self.cursor_pos:
+                index = (index + 1) % len(candidates)
+                self._replace_completed_word(word_start, candidates[index])
+                self._completion_cycle = (self.current_line, self.cursor_pos, candidates, index, word_start)
+                return
+            self._completion_cycle = None
 
-        pygame.display.flip()
+        before_cursor = self.current_line[:self.cursor_pos]
+        if not before_cursor:
+            return
+        word_start = before_cursor.rfind(" ") + 1
+        word = before_cursor[word_start:]
+        preceding = before_cursor[:word_start].split()
 
-    def update_progress_bar(self, current, total, x=None, y=None, width=200, height=20,
-                            bg_color=pygame.Color('gray'), fg_color=pygame.Color('green')):
-        self.draw_progress_bar(current, total, x, y, width, height, bg_color, fg_color)
+        if not preceding:
+            trie = self.command_trie
+        else:
+            trie = self._argument_completions(preceding, word)
+            if trie is None:
+                return
 
-    def handle_tab(self):
-        """Handle tab key for command completion."""
-        if not self.current_line:
-            return
+        candidates = list(islice(trie.words_with_prefix(word), self.max_listed_completions + 1))
+        if len(candidates) == 1:
+            self._replace_completed_word(word_start, candidates[0] + " ")
+        elif len(candidates) > 1:
+            common_prefix = trie.longest_common_prefix(word)
+            if len(common_prefix) > len(word):
+                self._replace_completed_word(word_start, common_prefix)
+                return
+            listed = candidates[:self.max_listed_completions]
+            more = " ..." if len(candidates) > self.max_listed_completions else ""
+            self.write(" ".join(listed) + more)
+            self._completion_cycle = (self.current_line, self.cursor_pos, listed, -1, word_start)
 
-        parts = self.current_line.split()
-        if len(parts) == 1:
-            # Complete command
-            possible_commands = [cmd for cmd in self.commands if cmd.startswith(parts[0])]
-            if len(possible_commands) == 1:
-                self.current_line = possible_commands[0] + " "
-                self.cursor_pos = len(self.current_line)
-            elif len(possible_commands) > 1:
-                self.write(" ".join(possible_commands))
+    def _argument_completions(self, preceding: list[str], word: str) -> CompletionTrie | None:
+        """Build the completion candidates of the argument being typed, if its command declares any."""
+        command = self.commands.get(preceding[0].lower())
+        position = len(preceding) - 1
+        if command is None or position >= command.number_of_arguments:
+            return None
+        argument = command.arguments[position]
+        if argument.completer is not None:
+            values = argument.completer(word, self)
+        elif argument.type == bool:
+            values = ("true", "false")
         else:
-            # Complete arguments (you'd need to implement this based on your command structure)
-            pass
\ No newline at end of file
+            return None
+        return CompletionTrie(value for value in values if value.startswith(word))
+
+    def _replace_completed_word(self, word_start: int, completion: str) -> None:
+        self.delete_text(word_start, self.cursor_pos - word_start)
+        self.cursor_pos = word_start
+        self.insert_text(completion)
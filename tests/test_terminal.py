@@ -0,0 +1,151 @@
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import pygame
+
+from src.pygameterm.terminal import PygameTerminal, StateRecord, StateSchema, StateStore
+
+
+def key(key_code, unicode=""):
+    return pygame.event.Event(pygame.KEYDOWN, key=key_code, unicode=unicode, mod=0)
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def run_until(terminal, condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        terminal.step()
+
+
+def test_nested_prompt_from_worker_does_not_break_the_main_loop():
+    terminal = PygameTerminal(app_state=None)
+    answers = []
+    asker = threading.Thread(target=lambda: answers.append(terminal.prompt_user("Continue?")))
+    writer = threading.Thread(target=lambda: terminal.write("from the other worker"))
+
+    # Queue the prompt first, so its nested loop runs the write queued behind it
+    asker.start()
+    wait_for(lambda: terminal._main_thread_calls.qsize() == 1)
+    writer.start()
+    wait_for(lambda: terminal._main_thread_calls.qsize() == 2)
+    terminal.schedule(50, lambda: terminal.handle_events([key(pygame.K_y, "y"), key(pygame.K_RETURN)]))
+
+    run_until(terminal, lambda: answers)
+    asker.join(5)
+    writer.join(5)
+
+    assert answers == ["y"]
+    assert "from the other worker" in list(terminal.terminal_lines)
+
+
+def test_async_prompts_take_turns_and_resolve_on_return():
+    terminal = PygameTerminal(app_state=None)
+    answers = []
+
+    async def ask(name):
+        answers.append((name, await terminal.prompt_user_async(f"{name}? ")))
+
+    async def type_answers():
+        for char in "xy":
+            await asyncio.sleep(0.05)
+            terminal.handle_events([key(ord(char), char), key(pygame.K_RETURN)])
+        await asyncio.sleep(0.05)
+        terminal.quit()
+
+    async def main():
+        tasks = [asyncio.create_task(ask("first")), asyncio.create_task(ask("second")),
+                 asyncio.create_task(type_answers())]
+        await terminal.run_async()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(asyncio.wait_for(main(), 5))
+    assert answers == [("first", "x"), ("second", "y")]
+
+
+class Item:
+    pass
+
+
+class Inventory:
+    pass
+
+
+INVENTORY_SCHEMA = StateSchema(1, StateRecord(Inventory, {
+    "owner": str,
+    "gold": int,
+    "weights": list[float],
+    "items": list[StateRecord(Item, {"name": str, "count": int, "rare": bool})],
+}), list_chunk_size=2)
+
+
+def make_inventory(gold=10):
+    inventory = Inventory()
+    inventory.owner = "hero"
+    inventory.gold = gold
+    inventory.weights = [0.5, 1.25, 3.0]
+    inventory.items = []
+    for name, count in [("potion", 3), ("sword", 1), ("key", 2)]:
+        item = Item()
+        item.name, item.count, item.rare = name, count, name == "key"
+        inventory.items.append(item)
+    return inventory
+
+
+def test_state_round_trip(tmp_path):
+    path = str(tmp_path / "inventory.sav")
+    store = StateStore(path, INVENTORY_SCHEMA)
+    inventory = make_inventory()
+    store.save(inventory).result()
+    inventory.gold = 25
+    inventory.items[2].count = 7
+    store.save(inventory).result()  # Incremental
+    store.close()
+
+    loaded = StateStore(path, INVENTORY_SCHEMA).load()
+    assert (loaded.owner, loaded.gold, loaded.weights) == ("hero", 25, [0.5, 1.25, 3.0])
+    assert [(item.name, item.count, item.rare) for item in loaded.items] == [
+        ("potion", 3, False), ("sword", 1, False), ("key", 7, True)]
+
+
+@pytest.mark.parametrize("change, field", [
+    (lambda inventory: setattr(inventory, "gold", 1.5), "gold"),
+    (lambda inventory: setattr(inventory, "gold", 2 ** 64), "gold"),
+    (lambda inventory: setattr(inventory, "owner", 3), "owner"),
+    (lambda inventory: setattr(inventory, "weights", ["heavy"]), "weights"),
+    (lambda inventory: setattr(inventory.items[1], "count", 2.5), "items.count"),
+])
+def test_state_bad_value_names_the_field(tmp_path, change, field):
+    path = str(tmp_path / "inventory.sav")
+    store = StateStore(path, INVENTORY_SCHEMA)
+    store.save(make_inventory()).result()
+    inventory = make_inventory(gold=99)
+    change(inventory)
+
+    with pytest.raises(ValueError, match=f"^{field}: "):
+        store.save(inventory)
+    store.close()
+    # Nothing was written, the last good save still loads
+    assert StateStore(path, INVENTORY_SCHEMA).load().gold == 10
+
+
+def test_autosave_reports_bad_values(tmp_path):
+    terminal = PygameTerminal(app_state=make_inventory())
+    terminal.app_state.gold = 0.5
+    terminal.autosave_state(str(tmp_path / "inventory.sav"), INVENTORY_SCHEMA, interval_ms=10)
+
+    run_until(terminal, lambda: any("Autosave" in line for line in terminal.terminal_lines))
+    terminal.stop_autosave(str(tmp_path / "inventory.sav"))
+    assert any(str(line).startswith("Autosave to ") and "gold: " in str(line) for line in terminal.terminal_lines)